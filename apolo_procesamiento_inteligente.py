@@ -17,22 +17,98 @@ Patrón de Activación:
 - Idempotencia por carpeta y por documento (generation)
 """
 
+from __future__ import annotations
+
 import os
+import copy
+import atexit
 import json
+import base64
+import io
 import uuid
 import time
+import random
 import hashlib
-import asyncio
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Set, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import socket
+import unicodedata
+import zlib
+import itertools
+import threading
+import contextlib
+import contextvars
+import functools
+import importlib
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
-from flask import jsonify
 import functions_framework
-from google.cloud import storage
-from google.cloud import firestore
-from google.cloud import documentai_v1 as documentai
-from google.cloud import pubsub_v1
+
+
+class _LazyModule:
+    """Módulo que se importa en el primer acceso a uno de sus atributos.
+
+    Las librerías cliente de GCP y sus árboles de protos generados tardan cientos de ms en
+    importarse; diferirlas saca ese costo del cold start y de los eventos que se descartan
+    sin llamar a GCP. El import lock de Python hace seguro el primer acceso concurrente.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Any = None
+
+    def __getattr__(self, attr: str) -> Any:
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "deferred"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+if TYPE_CHECKING:
+    import asyncio
+    from google.cloud import storage
+    from google.cloud import firestore
+    from google.cloud import documentai_v1 as documentai
+    from google.cloud import pubsub_v1
+    from google.api_core import exceptions as api_exceptions
+    from google.protobuf import field_mask_pb2
+    from cloudevents.http import CloudEvent
+    # Cliente de Firestore de las funciones que solo arman referencias y lotes (modo threads y asyncio)
+    _AnyFirestoreClient = Union[firestore.Client, firestore.AsyncClient]
+else:
+    # asyncio solo se usa con EXECUTION_MODE=asyncio
+    asyncio = _LazyModule("asyncio")
+    storage = _LazyModule("google.cloud.storage")
+    firestore = _LazyModule("google.cloud.firestore")
+    documentai = _LazyModule("google.cloud.documentai_v1")
+    pubsub_v1 = _LazyModule("google.cloud.pubsub_v1")
+    api_exceptions = _LazyModule("google.api_core.exceptions")
+    field_mask_pb2 = _LazyModule("google.protobuf.field_mask_pb2")
+
+
+@functools.lru_cache(maxsize=None)
+def _optional_module(name: str) -> Any:
+    """Importa un paquete opcional en su primer uso; None si no está instalado."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+# OpenTelemetry es opcional: sin el paquete, los tiempos por etapa siguen llegando al log estructurado
+def _otel_trace() -> Any:
+    return _optional_module("opentelemetry.trace")
+
+
+def _otel_metrics() -> Any:
+    return _optional_module("opentelemetry.metrics")
+
 
 import logging
 logging.basicConfig(level=logging.INFO, force=True)
@@ -47,12 +123,105 @@ CLASSIFIER_PROCESSOR_NAME = os.environ.get("CLASSIFIER_PROCESSOR_NAME", "apolo-p
 ER_EXTRACTOR_PROCESSOR_NAME = os.environ.get("ER_EXTRACTOR_PROCESSOR_NAME", "apolo-preavaluo-er-extractor-dev")
 ESF_EXTRACTOR_PROCESSOR_NAME = os.environ.get("ESF_EXTRACTOR_PROCESSOR_NAME", "apolo-preavaluo-esfextractor-dev")
 DLQ_TOPIC_NAME = os.environ.get("DLQ_TOPIC_NAME", "apolo-preavaluo-dlq")
+# Presupuesto de documentos en proceso para toda la instancia (compartido entre folios concurrentes)
 MAX_CONCURRENT_DOCS = int(os.environ.get("MAX_CONCURRENT_DOCS", "8"))
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "3"))
 RETRY_INITIAL_DELAY = float(os.environ.get("RETRY_INITIAL_DELAY", "1.0"))
 RETRY_MULTIPLIER = float(os.environ.get("RETRY_MULTIPLIER", "2.0"))
 RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "60.0"))
 FIRESTORE_DATABASE = os.environ.get("FIRESTORE_DATABASE", "(default)")
+# Rate limiting por processor de Document AI: token bucket + concurrencia adaptativa (AIMD)
+DOCAI_RATE_LIMIT_QPS = float(os.environ.get("DOCAI_RATE_LIMIT_QPS", "2.0"))
+DOCAI_RATE_LIMIT_BURST = int(os.environ.get("DOCAI_RATE_LIMIT_BURST", str(MAX_CONCURRENT_DOCS)))
+DOCAI_MIN_CONCURRENCY = int(os.environ.get("DOCAI_MIN_CONCURRENCY", "1"))
+DOCAI_MAX_CONCURRENCY = int(os.environ.get("DOCAI_MAX_CONCURRENCY", str(MAX_CONCURRENT_DOCS)))
+DOCAI_LATENCY_TARGET = float(os.environ.get("DOCAI_LATENCY_TARGET", "30.0"))
+# Field masks por llamada: Document AI solo devuelve (y el cliente solo deserializa) los campos usados
+DOCAI_FIELD_MASK_ENABLED = os.environ.get("DOCAI_FIELD_MASK_ENABLED", "true").lower() == "true"
+# Páginas iniciales que recibe el Classifier (process_options.from_start); 0 = documento completo
+CLASSIFIER_MAX_PAGES = int(os.environ.get("CLASSIFIER_MAX_PAGES", "0"))
+# Modo de ejecución del pipeline por folio: "threads" (ThreadPoolExecutor) o "asyncio"
+EXECUTION_MODE = os.environ.get("EXECUTION_MODE", "threads").lower()
+ASYNC_MAX_CONCURRENT_DOCS = int(os.environ.get("ASYNC_MAX_CONCURRENT_DOCS", "100"))
+# Batching de escrituras Firestore (límite duro de WriteBatch: 500 escrituras / 10 MiB)
+FIRESTORE_BATCH_MAX_WRITES = min(int(os.environ.get("FIRESTORE_BATCH_MAX_WRITES", "50")), 500)
+FIRESTORE_BATCH_MAX_BYTES = int(os.environ.get("FIRESTORE_BATCH_MAX_BYTES", str(8 * 1024 * 1024)))
+FIRESTORE_FLUSH_INTERVAL = float(os.environ.get("FIRESTORE_FLUSH_INTERVAL", "2.0"))
+# Referencias por llamada get_all en el pre-chequeo de idempotencia
+FIRESTORE_GET_ALL_CHUNK = int(os.environ.get("FIRESTORE_GET_ALL_CHUNK", "300"))
+# Timeout de la petición en Cloud Run (terraform: cloudrun_timeout); los plazos internos se dimensionan por debajo
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", "540"))
+# Modo batch de Document AI (batch_process_documents) para folios grandes.
+# Se activa si hay BATCH_OUTPUT_URI y el folio supera BATCH_MODE_MIN_DOCS o BATCH_MODE_MIN_TOTAL_BYTES (0 = criterio deshabilitado)
+BATCH_OUTPUT_URI = os.environ.get("BATCH_OUTPUT_URI", "").rstrip("/")
+BATCH_MODE_MIN_DOCS = int(os.environ.get("BATCH_MODE_MIN_DOCS", "25"))
+BATCH_MODE_MIN_TOTAL_BYTES = int(os.environ.get("BATCH_MODE_MIN_TOTAL_BYTES", str(200 * 1024 * 1024)))
+BATCH_MODE_MAX_DOCS_PER_REQUEST = int(os.environ.get("BATCH_MODE_MAX_DOCS_PER_REQUEST", "1000"))
+BATCH_MODE_POLL_INTERVAL = float(os.environ.get("BATCH_MODE_POLL_INTERVAL", "5.0"))
+# Plazo único para todo el flujo batch (Classifier + Extractores). El resto de la petición queda
+# para el respaldo online y la persistencia; nunca supera el 90% del timeout de la petición.
+BATCH_MODE_DEADLINE_SECONDS = min(
+    float(os.environ.get("BATCH_MODE_DEADLINE_SECONDS", str(REQUEST_TIMEOUT_SECONDS * 0.5))),
+    REQUEST_TIMEOUT_SECONDS * 0.9,
+)
+# Pre-clasificación local (nombre de archivo, metadata GCS, texto de la primera página)
+FAST_CLASSIFY_ENABLED = os.environ.get("FAST_CLASSIFY_ENABLED", "true").lower() == "true"
+FAST_CLASSIFY_MIN_CONFIDENCE = float(os.environ.get("FAST_CLASSIFY_MIN_CONFIDENCE", "0.8"))
+FAST_CLASSIFY_SCAN_BYTES = int(os.environ.get("FAST_CLASSIFY_SCAN_BYTES", str(512 * 1024)))
+# Caché de resultados Document AI direccionada por contenido (SHA-256 del PDF + processor)
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_BYPASS = os.environ.get("RESULT_CACHE_BYPASS", "false").lower() == "true"
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+RESULT_CACHE_LRU_SIZE = int(os.environ.get("RESULT_CACHE_LRU_SIZE", "256"))
+RESULT_CACHE_COLLECTION = os.environ.get("RESULT_CACHE_COLLECTION", "cache_resultados")
+# Cada cuánto se vuelve a consultar la versión por defecto de un processor (parte de la clave de caché)
+PROCESSOR_VERSION_TTL_SECONDS = float(os.environ.get("PROCESSOR_VERSION_TTL_SECONDS", "600"))
+# Tamaño de página del listado de la carpeta (el procesamiento arranca con la primera página)
+GCS_LIST_PAGE_SIZE = int(os.environ.get("GCS_LIST_PAGE_SIZE", "1000"))
+# Preflight con metadatos del listado: objetos más grandes se rechazan antes de Firestore/Document AI
+# (límite de contenido inline de Document AI en process_document: 40 MiB)
+MAX_PDF_BYTES = int(os.environ.get("MAX_PDF_BYTES", str(40 * 1024 * 1024)))
+# Pool HTTP de GCS: un worker por documento más margen para listados y reintentos
+GCS_HTTP_POOL_SIZE = int(os.environ.get("GCS_HTTP_POOL_SIZE", str(max(10, MAX_CONCURRENT_DOCS * 2))))
+# Telemetría: exportador de spans/métricas OpenTelemetry ("none", "otlp" o "prometheus")
+TELEMETRY_EXPORTER = os.environ.get("TELEMETRY_EXPORTER", "none").lower()
+TELEMETRY_SERVICE_NAME = os.environ.get("TELEMETRY_SERVICE_NAME", "apolo-procesamiento-inteligente")
+PROMETHEUS_PORT = int(os.environ.get("PROMETHEUS_PORT", "9464"))
+# Formato de extracciones en Firestore: "compact" (bbox enteros + line items columnares) o "standard" (v1.0)
+EXTRACTION_FORMAT = os.environ.get("EXTRACTION_FORMAT", "compact").lower()
+# Extracciones más grandes se guardan como JSON en GCS (límite de documento Firestore: 1 MiB)
+EXTRACTION_INLINE_MAX_BYTES = int(os.environ.get("EXTRACTION_INLINE_MAX_BYTES", str(512 * 1024)))
+# Destino gs://bucket/prefijo de esos JSON: un bucket dedicado, nunca el de carga (dispararía Eventarc).
+# Sin él, las extracciones se guardan inline mientras quepan en el documento (con un warning)
+EXTRACTION_SPILL_URI = os.environ.get("EXTRACTION_SPILL_URI", "").rstrip("/")
+# Tamaño máximo de fields inline: 1 MiB menos margen para metadata, huella y campos del documento
+FIRESTORE_INLINE_HARD_MAX_BYTES = 1024 * 1024 - 64 * 1024
+# PDFs con más páginas que EXTRACTION_CHUNK_PAGES se extraen por rangos de páginas en paralelo
+EXTRACTION_CHUNK_PAGES = int(os.environ.get("EXTRACTION_CHUNK_PAGES", "15"))
+EXTRACTION_CHUNK_CONCURRENCY = int(os.environ.get("EXTRACTION_CHUNK_CONCURRENCY", "4"))
+# Leases por documento: mientras un lease esté vigente ninguna otra entrega procesa ese doc_id
+DOCUMENT_LEASE_SECONDS = int(os.environ.get("DOCUMENT_LEASE_SECONDS", "600"))
+# Espera máxima a documentos con lease de otra entrega antes de diferir el cierre del folio
+LEASE_WAIT_SECONDS = float(os.environ.get("LEASE_WAIT_SECONDS", "60"))
+LEASE_POLL_INTERVAL = float(os.environ.get("LEASE_POLL_INTERVAL", "5.0"))
+# Identificador de la instancia en los leases (Cloud Run no lo expone como variable de entorno)
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+# Despacho del folio: "inline" (todo en la request del sentinel) o "fanout" (un work item por PDF)
+DISPATCH_MODE = os.environ.get("DISPATCH_MODE", "inline").lower()
+# Tópico de work items del modo fanout; vacío = cola en proceso (pruebas y desarrollo local)
+WORK_TOPIC_NAME = os.environ.get("WORK_TOPIC_NAME", "")
+# Un is_ready con generation nueva sobre un folio terminado re-procesa solo los PDFs nuevos o cambiados
+INCREMENTAL_REPROCESS_ENABLED = os.environ.get("INCREMENTAL_REPROCESS_ENABLED", "true").lower() == "true"
+# Una extracción idéntica (misma huella) a la de la generation anterior del archivo no se reescribe;
+# una distinta deja la anterior como delta por campo
+EXTRACTION_DEDUP_ENABLED = os.environ.get("EXTRACTION_DEDUP_ENABLED", "true").lower() == "true"
+# Batching del PublisherClient compartido (DLQ y work items)
+PUBSUB_BATCH_MAX_MESSAGES = int(os.environ.get("PUBSUB_BATCH_MAX_MESSAGES", "100"))
+PUBSUB_BATCH_MAX_BYTES = int(os.environ.get("PUBSUB_BATCH_MAX_BYTES", str(1024 * 1024)))
+PUBSUB_BATCH_MAX_LATENCY = float(os.environ.get("PUBSUB_BATCH_MAX_LATENCY", "0.1"))
+# La DLQ se publica en segundo plano; lo que Pub/Sub no acepta se respalda en un JSONL local
+DLQ_FLUSH_TIMEOUT = float(os.environ.get("DLQ_FLUSH_TIMEOUT", "5.0"))
+DLQ_SPILL_PATH = os.environ.get("DLQ_SPILL_PATH", "/tmp/apolo_dlq_spill.jsonl")
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -67,6 +236,16 @@ class AppError(Exception):
         self.details = details or {}
 
 
+class PdfObject(NamedTuple):
+    """PDF listado en la carpeta del folio (metadatos devueltos por list_blobs)."""
+    name: str
+    generation: str
+    size: int = 0
+    metadata: Optional[Dict[str, str]] = None
+    content_type: Optional[str] = None
+    crc32c: Optional[str] = None
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # UTILITIES: Funciones auxiliares
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -106,6 +285,11 @@ def _exponential_backoff_delay(attempt: int) -> float:
     return min(delay, RETRY_MAX_DELAY)
 
 
+def _jittered_backoff_delay(attempt: int) -> float:
+    """Backoff exponencial con full jitter, para que los threads no reintenten en sincronía."""
+    return random.uniform(0, _exponential_backoff_delay(attempt))
+
+
 def _json_log(payload: Dict[str, Any]) -> None:
     """Logging estructurado en JSON para Cloud Logging."""
     logging.info(json.dumps(payload, ensure_ascii=False))
@@ -136,14 +320,15 @@ def _is_ready_sentinel(object_name: str) -> Tuple[bool, str]:
 
 def _publish_to_dlq(folio_id: str, gcs_uri: str, error_type: str, error_message: str,
                     attempts: int, details: Optional[Dict[str, Any]] = None) -> None:
-    """Publica documento fallido al Dead Letter Queue para revisión manual."""
+    """Publica documento fallido al Dead Letter Queue para revisión manual.
+
+    No bloquea: el mensaje se entrega al publisher DLQ compartido, que lo confirma en
+    segundo plano (ver _DlqPublisher).
+    """
     try:
         if not PROJECT_ID or not DLQ_TOPIC_NAME:
             logger.warning("DLQ not configured, skipping publish")
             return
-            
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = publisher.topic_path(PROJECT_ID, DLQ_TOPIC_NAME)
         
         message_data = {
             "folio_id": folio_id,
@@ -155,38 +340,462 @@ def _publish_to_dlq(folio_id: str, gcs_uri: str, error_type: str, error_message:
             "details": details or {},
         }
         
-        message_bytes = json.dumps(message_data).encode("utf-8")
-        future = publisher.publish(topic_path, message_bytes)
-        future.result(timeout=5.0)
-        
-        logger.info(f"Published to DLQ: {gcs_uri}")
+        _get_dlq_publisher().publish(message_data)
+        logger.info(f"Queued for DLQ: {gcs_uri}")
     except Exception as e:
         logger.error(f"Failed to publish to DLQ: {e}")
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
-# GCS INTEGRATION
+# GCP CLIENTS: Registro compartido, inicializado bajo demanda y thread-safe
+# Cada cliente se construye en su primer uso (no al importar) y se reutiliza entre
+# requests y threads de la misma instancia, evitando repetir el descubrimiento de
+# credenciales y la apertura de canales gRPC / sesiones HTTP.
+# ═══════════════════════════════════════════════════════════════════════════════
+_CLIENTS: Dict[str, Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(key: str, factory: Callable[[], Any]) -> Any:
+    """Obtiene un cliente del registro, creándolo con double-checked locking."""
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = factory()
+                _CLIENTS[key] = client
+    return client
+
+
+def _build_storage_client() -> storage.Client:
+    from requests.adapters import HTTPAdapter
+    client = storage.Client()
+    # Ajusta el pool de conexiones HTTP al número de workers concurrentes
+    adapter = HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+    client._http.mount("https://", adapter)
+    return client
+
+
+def _get_storage_client() -> storage.Client:
+    return _get_client("storage", _build_storage_client)
+
+
+def _get_documentai_client() -> documentai.DocumentProcessorServiceClient:
+    return _get_client("documentai", documentai.DocumentProcessorServiceClient)
+
+
+def _build_publisher_client() -> pubsub_v1.PublisherClient:
+    return pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+        max_bytes=PUBSUB_BATCH_MAX_BYTES,
+        max_latency=PUBSUB_BATCH_MAX_LATENCY,
+    ))
+
+
+def _get_publisher_client() -> pubsub_v1.PublisherClient:
+    return _get_client("publisher", _build_publisher_client)
+
+
+def _get_firestore_client() -> firestore.Client:
+    return _get_client("firestore", lambda: firestore.Client(database=FIRESTORE_DATABASE))
+
+
+def _start_async_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="apolo-async-loop", daemon=True).start()
+    return loop
+
+
+def _get_async_loop() -> asyncio.AbstractEventLoop:
+    """Event loop persistente de la instancia para el modo asyncio.
+
+    Los clientes async (gRPC aio) quedan ligados al loop donde se crean, por lo que
+    todas las requests comparten este loop en lugar de crear uno con asyncio.run().
+    """
+    return _get_client("async_loop", _start_async_loop)
+
+
+def _run_async(coro: Any) -> Any:
+    """Ejecuta una corutina en el loop compartido y espera su resultado."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_async_loop()).result()
+
+
+# Los clientes async deben obtenerse desde corutinas que corren en _get_async_loop()
+def _get_documentai_async_client() -> documentai.DocumentProcessorServiceAsyncClient:
+    return _get_client("documentai_async", documentai.DocumentProcessorServiceAsyncClient)
+
+
+def _get_firestore_async_client() -> firestore.AsyncClient:
+    return _get_client("firestore_async", lambda: firestore.AsyncClient(database=FIRESTORE_DATABASE))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# DLQ PUBLISHER: Publicación en segundo plano con respaldo local
+# ═══════════════════════════════════════════════════════════════════════════════
+class _DlqPublisher:
+    """Publicación a la DLQ sin bloquear a los workers.
+
+    publish() entrega el mensaje al batcher del PublisherClient y retorna de inmediato.
+    Si la publicación falla (Pub/Sub inaccesible, timeout) el mensaje se agrega a
+    DLQ_SPILL_PATH y se vuelve a publicar en el siguiente flush(). Cloud Run limita la
+    CPU fuera de las requests, por eso flush() corre al terminar cada request y al
+    apagar la instancia.
+    """
+
+    def __init__(self, topic_path: str, spill_path: str):
+        self._topic_path = topic_path
+        self._spill_path = spill_path
+        self._lock = threading.Lock()
+        self._pending: Dict[Any, Dict[str, Any]] = {}
+        self._published = 0
+        self._spilled = 0
+
+    def publish(self, message: Dict[str, Any]) -> None:
+        try:
+            future = _get_publisher_client().publish(self._topic_path, json.dumps(message).encode("utf-8"))
+        except Exception as e:
+            logger.error(f"Failed to publish to DLQ, spilling locally: {e}")
+            self._spill([message])
+            return
+        with self._lock:
+            self._pending[future] = message
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future: Any) -> None:
+        with self._lock:
+            message = self._pending.pop(future, None)
+        error = future.exception()
+        if error is None:
+            with self._lock:
+                self._published += 1
+        elif message is not None:
+            logger.error(f"Failed to publish to DLQ, spilling locally: {error}")
+            self._spill([message])
+
+    def _spill(self, messages: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            try:
+                with open(self._spill_path, "a", encoding="utf-8") as spill:
+                    for message in messages:
+                        spill.write(json.dumps(message, ensure_ascii=False) + "\n")
+                self._spilled += len(messages)
+            except OSError as e:
+                logger.error(f"DLQ spill failed, {len(messages)} messages lost: {e}")
+
+    def _take_spilled(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            try:
+                with open(self._spill_path, encoding="utf-8") as spill:
+                    lines = spill.readlines()
+                os.remove(self._spill_path)
+            except FileNotFoundError:
+                return []
+            except OSError as e:
+                logger.error(f"Error reading DLQ spill file: {e}")
+                return []
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def flush(self, timeout: float = DLQ_FLUSH_TIMEOUT) -> None:
+        """Re-publica lo respaldado localmente y espera las publicaciones en curso hasta timeout."""
+        for message in self._take_spilled():
+            self.publish(message)
+        with self._lock:
+            pending = list(self._pending)
+        deadline = time.monotonic() + timeout
+        for future in pending:
+            try:
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except Exception:
+                # Los fallos se respaldan en _on_done; un timeout deja el mensaje en el batcher
+                pass
+        with self._lock:
+            if self._pending:
+                logger.warning(f"{len(self._pending)} DLQ messages still in flight after flush")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"published": self._published, "spilled": self._spilled, "in_flight": len(self._pending)}
+
+
+def _build_dlq_publisher() -> _DlqPublisher:
+    publisher = _DlqPublisher(f"projects/{PROJECT_ID}/topics/{DLQ_TOPIC_NAME}", DLQ_SPILL_PATH)
+    atexit.register(publisher.flush)
+    return publisher
+
+
+def _get_dlq_publisher() -> _DlqPublisher:
+    return _get_client("dlq_publisher", _build_dlq_publisher)
+
+
+def _flush_dlq() -> None:
+    """Confirma las publicaciones DLQ de la request antes de responder."""
+    publisher = _CLIENTS.get("dlq_publisher")
+    if publisher is not None:
+        publisher.flush()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TELEMETRY: Tiempos por etapa, spans y métricas
+# Etapas de documento: download, validate, classify, extract, persist.
+# Etapas de folio: list, precheck, commit (más la suma de las etapas de sus documentos).
+# Los tiempos son monotónicos y se emiten como spans/métricas OpenTelemetry cuando el
+# SDK está configurado; en cualquier caso se incluyen en el log estructurado.
 # ═══════════════════════════════════════════════════════════════════════════════
-def _list_pdfs_in_folder(bucket_name: str, folder_prefix: str) -> List[Tuple[str, str]]:
-    """Lista todos los PDFs en una carpeta de GCS con sus generation numbers.
+_TELEMETRY: Dict[str, Any] = {}
+_TELEMETRY_LOCK = threading.Lock()
+
+# Nombre -> (tipo, nombre OTel, unidad, descripción)
+_INSTRUMENT_SPECS: Dict[str, Tuple[str, str, str, str]] = {
+    "stage_duration": ("histogram", "apolo.stage.duration", "s", "Duration of a pipeline stage"),
+    "document_duration": ("histogram", "apolo.document.duration", "s", "End-to-end duration of a document"),
+    "folio_duration": ("histogram", "apolo.folio.duration", "s", "End-to-end duration of a folio"),
+    "documents": ("counter", "apolo.documents", "1", "Documents processed by final status"),
+    "retries": ("counter", "apolo.documentai.retries", "1", "Document AI retries"),
+    "bytes_downloaded": ("counter", "apolo.gcs.bytes_downloaded", "By", "PDF bytes downloaded from GCS"),
+    "scheduler_wait": ("histogram", "apolo.scheduler.wait", "s", "Time a document waited for a worker"),
+    "scheduler_queue_depth": ("updown_counter", "apolo.scheduler.queue_depth", "1", "Documents waiting for a worker"),
+}
+
+
+class _NoopInstrument:
+    def add(self, amount: float, attributes: Optional[Dict[str, Any]] = None) -> None:
+        pass
+
+    def record(self, amount: float, attributes: Optional[Dict[str, Any]] = None) -> None:
+        pass
+
+
+def configure_telemetry(span_exporter: Any = None, metric_reader: Any = None) -> bool:
+    """Configura el SDK de OpenTelemetry para este proceso.
+
+    Sin argumentos usa TELEMETRY_EXPORTER ("otlp" respeta las variables OTEL_EXPORTER_OTLP_*,
+    "prometheus" expone /metrics en PROMETHEUS_PORT). Las pruebas pueden pasar un
+    InMemorySpanExporter / InMemoryMetricReader como colector en proceso.
+    Retorna False si el SDK no está disponible.
+    """
+    if _otel_trace() is None:
+        logger.warning("OpenTelemetry API not installed, telemetry export disabled")
+        return False
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        
+        span_processor_cls = SimpleSpanProcessor
+        if span_exporter is None and metric_reader is None:
+            span_processor_cls = BatchSpanProcessor
+            if TELEMETRY_EXPORTER == "otlp":
+                from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+                from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+                span_exporter = OTLPSpanExporter()
+                metric_reader = PeriodicExportingMetricReader(OTLPMetricExporter())
+            elif TELEMETRY_EXPORTER == "prometheus":
+                from opentelemetry.exporter.prometheus import PrometheusMetricReader
+                from prometheus_client import start_http_server
+                start_http_server(PROMETHEUS_PORT)
+                metric_reader = PrometheusMetricReader()
+            else:
+                return False
+    except ImportError as e:
+        logger.warning(f"OpenTelemetry SDK/exporter not available, telemetry export disabled: {e}")
+        return False
     
-    Excluye el archivo 'is_ready' si está presente.
+    resource = Resource.create({"service.name": TELEMETRY_SERVICE_NAME})
+    tracer_provider = TracerProvider(resource=resource)
+    if span_exporter is not None:
+        tracer_provider.add_span_processor(span_processor_cls(span_exporter))
+    meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader] if metric_reader else [])
     
-    Returns:
-        List[(blob_name, generation)]
+    with _TELEMETRY_LOCK:
+        _TELEMETRY.clear()
+        _TELEMETRY["tracer"] = tracer_provider.get_tracer(__name__)
+        _TELEMETRY["meter"] = meter_provider.get_meter(__name__)
+        _TELEMETRY["providers"] = (tracer_provider, meter_provider)
+    logger.info(f"Telemetry configured (exporter: {TELEMETRY_EXPORTER if span_processor_cls is BatchSpanProcessor else 'custom'})")
+    return True
+
+
+def _get_tracer() -> Any:
+    tracer = _TELEMETRY.get("tracer")
+    if tracer is None and _otel_trace() is not None:
+        # Sin configure_telemetry se usa el provider global (no-op salvo auto-instrumentación)
+        tracer = _otel_trace().get_tracer(__name__)
+    return tracer
+
+
+def _get_instrument(name: str) -> Any:
+    instrument = _TELEMETRY.get(f"instrument:{name}")
+    if instrument is not None:
+        return instrument
+    with _TELEMETRY_LOCK:
+        instrument = _TELEMETRY.get(f"instrument:{name}")
+        if instrument is None:
+            otel_metrics = _otel_metrics()
+            meter = _TELEMETRY.get("meter") or (otel_metrics.get_meter(__name__) if otel_metrics else None)
+            kind, otel_name, unit, description = _INSTRUMENT_SPECS[name]
+            if meter is None:
+                instrument = _NoopInstrument()
+            elif kind == "histogram":
+                instrument = meter.create_histogram(otel_name, unit=unit, description=description)
+            elif kind == "updown_counter":
+                instrument = meter.create_up_down_counter(otel_name, unit=unit, description=description)
+            else:
+                instrument = meter.create_counter(otel_name, unit=unit, description=description)
+            _TELEMETRY[f"instrument:{name}"] = instrument
+    return instrument
+
+
+def _start_span(name: str, attributes: Optional[Dict[str, Any]] = None) -> Any:
+    tracer = _get_tracer()
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+class _StageTimer:
+    """Duraciones monotónicas por etapa, reintentos y bytes descargados de un documento o folio.
+
+    Al cerrarse, los totales de un documento se suman a los del folio que lo contiene.
+    """
+
+    def __init__(self, scope: str, attributes: Dict[str, Any]):
+        self.scope = scope
+        self.attributes = attributes
+        self.status = "DONE"
+        self.durations: Dict[str, float] = {}
+        self.retries = 0
+        self.bytes_downloaded = 0
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._elapsed: Optional[float] = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            with _start_span(f"apolo.{self.scope}.{name}", self.attributes):
+                yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.durations[name] = self.durations.get(name, 0.0) + elapsed
+            _get_instrument("stage_duration").record(elapsed, {"stage": name, "scope": self.scope})
+
+    def add_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def add_duration(self, name: str, seconds: float) -> None:
+        """Suma tiempo a una etapa medida fuera de stage() (p. ej. espera en el scheduler)."""
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def add_bytes(self, count: int) -> None:
+        with self._lock:
+            self.bytes_downloaded += count
+        _get_instrument("bytes_downloaded").add(count)
+
+    def merge(self, other: "_StageTimer") -> None:
+        with self._lock:
+            for name, seconds in other.durations.items():
+                self.durations[name] = self.durations.get(name, 0.0) + seconds
+            self.retries += other.retries
+            self.bytes_downloaded += other.bytes_downloaded
+
+    def elapsed(self) -> float:
+        return self._elapsed if self._elapsed is not None else time.monotonic() - self._started
+
+    def duration_ms(self, name: str) -> float:
+        return round(self.durations.get(name, 0.0) * 1000, 1)
+
+    def summary(self) -> Dict[str, Any]:
+        """Campos de duración para el log estructurado."""
+        with self._lock:
+            return {
+                "duration_ms": round(self.elapsed() * 1000, 1),
+                "stage_durations_ms": {name: round(s * 1000, 1) for name, s in self.durations.items()},
+                "retries": self.retries,
+                "bytes_downloaded": self.bytes_downloaded,
+            }
+
+    def finish(self, parent: Optional["_StageTimer"]) -> None:
+        self._elapsed = time.monotonic() - self._started
+        _get_instrument(f"{self.scope}_duration").record(self._elapsed, {"status": self.status})
+        if self.scope == "document":
+            _get_instrument("documents").add(1, {"status": self.status})
+        if parent is not None:
+            parent.merge(self)
+
+
+_CURRENT_TIMER: contextvars.ContextVar[Optional[_StageTimer]] = contextvars.ContextVar("apolo_stage_timer", default=None)
+
+
+@contextlib.contextmanager
+def _instrumented(scope: str, attributes: Dict[str, Any]) -> Iterator[_StageTimer]:
+    """Abre el span de un documento/folio y lo deja como timer actual del contexto.
+
+    Las etapas y reintentos registrados dentro del bloque (incluso desde funciones
+    profundas, vía _timed_stage/_record_retry) se acumulan en este timer.
     """
+    parent = _CURRENT_TIMER.get()
+    timer = _StageTimer(scope, attributes)
+    token = _CURRENT_TIMER.set(timer)
     try:
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=folder_prefix)
-        
-        pdfs = []
-        for blob in blobs:
-            blob_lower = blob.name.lower()
-            if blob_lower.endswith(".pdf") and not blob_lower.endswith("is_ready") and not blob.name.endswith("/"):
-                pdfs.append((blob.name, str(blob.generation)))
+        with _start_span(f"apolo.{scope}", attributes):
+            yield timer
+    except Exception:
+        timer.status = "ERROR"
+        raise
+    finally:
+        _CURRENT_TIMER.reset(token)
+        timer.finish(parent)
+
+
+def _timed_stage(name: str) -> Any:
+    """Mide una etapa sobre el timer actual; sin timer activo no mide nada."""
+    timer = _CURRENT_TIMER.get()
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+
+def _record_retry(processor_name: str) -> None:
+    timer = _CURRENT_TIMER.get()
+    if timer is not None:
+        timer.add_retry()
+    _get_instrument("retries").add(1, {"processor": processor_name.rsplit("/", 1)[-1]})
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# GCS INTEGRATION
+# ═══════════════════════════════════════════════════════════════════════════════
+def _iter_pdf_pages(bucket_name: str, folder_prefix: str) -> Iterator[List[PdfObject]]:
+    """Lista los PDFs de una carpeta de GCS página a página.
+
+    El filtro por extensión se hace del lado del servidor con match_glob y la respuesta se
+    proyecta con fields a los metadatos que usa el pipeline. Cada página se entrega en
+    cuanto llega, sin esperar al final del listado. Excluye el archivo 'is_ready'.
+    """
+    try:
+        client = _get_storage_client()
+        blobs = client.list_blobs(
+            bucket_name,
+            prefix=folder_prefix,
+            match_glob="**.[pP][dD][fF]",
+            fields="items(name,generation,size,metadata,contentType,crc32c),nextPageToken",
+            page_size=GCS_LIST_PAGE_SIZE,
+        )
         
-        return pdfs
+        for page in blobs.pages:
+            pdfs = []
+            for blob in page:
+                blob_lower = blob.name.lower()
+                if blob_lower.endswith(".pdf") and not blob_lower.endswith("is_ready") and not blob.name.endswith("/"):
+                    pdfs.append(PdfObject(blob.name, str(blob.generation), int(blob.size or 0), blob.metadata,
+                                          blob.content_type, blob.crc32c))
+            if pdfs:
+                yield pdfs
     except Exception as e:
         logger.error(f"Error listing PDFs: {e}")
         raise AppError(
@@ -197,247 +806,2496 @@ def _list_pdfs_in_folder(bucket_name: str, folder_prefix: str) -> List[Tuple[str
         )
 
 
-def _is_valid_pdf(blob_name: str, storage_client: storage.Client, bucket_name: str) -> Tuple[bool, str]:
-    """Valida PDF mediante magic bytes (%PDF-)."""
+def _list_pdfs_in_folder(bucket_name: str, folder_prefix: str) -> List[PdfObject]:
+    """Lista todos los PDFs en una carpeta de GCS con sus generation numbers y tamaños."""
+    return [pdf for page in _iter_pdf_pages(bucket_name, folder_prefix) for pdf in page]
+
+
+# Content-Types aceptados en el preflight: los clientes que no declaran tipo suben octet-stream
+PREFLIGHT_ALLOWED_CONTENT_TYPES = {
+    None, "", "application/pdf", "application/x-pdf", "application/octet-stream", "binary/octet-stream",
+}
+
+
+def _preflight_documents(page: List[PdfObject]) -> Tuple[List[PdfObject], List[Tuple[PdfObject, str, str]]]:
+    """Valida una página del listado solo con sus metadatos (tamaño y Content-Type).
+
+    Los objetos vacíos, demasiado grandes para Document AI o con un Content-Type que no
+    es PDF se rechazan sin descargar bytes ni consultar Firestore. Los aceptados se
+    devuelven de mayor a menor tamaño (LPT): los documentos largos arrancan primero y
+    no quedan rezagados al final del folio. Los magic bytes se siguen validando sobre
+    el contenido descargado (_is_valid_pdf).
+    
+    Returns:
+        (accepted, [(pdf, error_code, error_message)])
+    """
+    accepted: List[PdfObject] = []
+    rejected: List[Tuple[PdfObject, str, str]] = []
+    for pdf in page:
+        content_type = (pdf.content_type or "").split(";")[0].strip().lower()
+        if pdf.size <= 0:
+            rejected.append((pdf, "EMPTY_OBJECT", "Object is empty (0 bytes)"))
+        elif pdf.size > MAX_PDF_BYTES:
+            rejected.append((pdf, "PDF_TOO_LARGE",
+                             f"Object size {pdf.size} bytes exceeds MAX_PDF_BYTES ({MAX_PDF_BYTES})"))
+        elif content_type not in PREFLIGHT_ALLOWED_CONTENT_TYPES:
+            rejected.append((pdf, "NOT_PDF", f"Unexpected Content-Type: {pdf.content_type}"))
+        else:
+            accepted.append(pdf)
+    accepted.sort(key=lambda pdf: pdf.size, reverse=True)
+    return accepted, rejected
+
+
+def _is_valid_pdf(content: bytes) -> Tuple[bool, str]:
+    """Valida PDF mediante magic bytes (%PDF-) sobre el contenido ya descargado."""
+    header = content[:5]
+    if header == b'%PDF-':
+        return True, ""
+    return False, f"Invalid PDF header. Expected '%PDF-', got: {header[:10]!r}"
+
+
+def _fetch_document_content(storage_client: storage.Client, bucket_name: str, blob_name: str,
+                            generation: Optional[str] = None) -> bytes:
+    """Descarga el PDF una sola vez por documento.
+
+    Si se proporciona generation, la descarga se condiciona a esa generación para que
+    los bytes correspondan exactamente al doc_id calculado con _make_doc_id.
+    """
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
-        header = blob.download_as_bytes(start=0, end=5)
-        
-        if header == b'%PDF-':
-            return True, ""
-        else:
-            return False, f"Invalid PDF header. Expected '%PDF-', got: {header[:10]}"
+        if generation:
+            return blob.download_as_bytes(if_generation_match=int(generation))
+        return blob.download_as_bytes()
+    except api_exceptions.PreconditionFailed:
+        raise AppError(
+            code="GENERATION_MISMATCH",
+            message=f"Object was overwritten after listing (expected generation {generation})",
+            stage="DOWNLOAD",
+            details={"file": blob_name, "generation": generation}
+        )
     except Exception as e:
-        return False, f"Error reading file: {str(e)}"
+        raise AppError(
+            code="GCS_DOWNLOAD_ERROR",
+            message=f"Error reading file: {e}",
+            stage="DOWNLOAD",
+            details={"file": blob_name, "generation": generation}
+        )
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
-# DOCUMENT AI INTEGRATION con reintentos
+# RATE LIMITING: Control de cuota por processor de Document AI
+# Un limitador por processor (Classifier, ER Extractor, ESF Extractor) compartido por
+# todos los threads/corutinas de la instancia.
 # ═══════════════════════════════════════════════════════════════════════════════
-def _process_document_ai_with_retry(processor_name: str, gcs_uri: str) -> Optional[documentai.Document]:
-    """Procesa documento con Document AI con reintentos automáticos."""
-    if not PROJECT_ID or not processor_name:
-        logger.warning("Document AI not configured")
-        return None
-        
-    client = documentai.DocumentProcessorServiceClient()
-    
-    for attempt in range(MAX_RETRIES):
-        try:
-            # Leer documento desde GCS
-            storage_client = storage.Client()
-            bucket_name, blob_name = gcs_uri.replace("gs://", "").split("/", 1)
-            bucket = storage_client.bucket(bucket_name)
-            blob = bucket.blob(blob_name)
-            content = blob.download_as_bytes()
-            
-            raw_document = documentai.RawDocument(content=content, mime_type="application/pdf")
-            request = documentai.ProcessRequest(name=processor_name, raw_document=raw_document)
-            
-            result = client.process_document(request=request)
-            return result.document
-            
-        except Exception as e:
-            logger.warning(f"Document AI attempt {attempt + 1}/{MAX_RETRIES} failed: {e}")
-            if attempt < MAX_RETRIES - 1:
-                delay = _exponential_backoff_delay(attempt)
-                logger.info(f"Retrying in {delay:.2f} seconds...")
-                time.sleep(delay)
-            else:
-                logger.error(f"Document AI failed after {MAX_RETRIES} attempts")
-                return None
-    
-    return None
+@functools.lru_cache(maxsize=None)
+def _retryable_errors() -> Tuple[type, ...]:
+    # Se arma en el primer error: google.api_core (y grpc) no se importan al cargar el módulo
+    return (
+        api_exceptions.TooManyRequests,
+        api_exceptions.ResourceExhausted,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.InternalServerError,
+        api_exceptions.GatewayTimeout,
+        api_exceptions.Aborted,
+        ConnectionError,
+        TimeoutError,
+    )
 
 
-def classify_document(gcs_uri: str) -> Dict[str, Any]:
-    """Clasifica documento usando Document AI Classifier."""
-    try:
-        if not CLASSIFIER_PROCESSOR_NAME:
-            return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "not_configured"}
-        
-        processor_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{CLASSIFIER_PROCESSOR_NAME}"
-        document = _process_document_ai_with_retry(processor_name, gcs_uri)
-        
-        if not document:
-            return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "error"}
-        
-        doc_type = "UNKNOWN"
-        confidence = 0.0
-        
-        for entity in document.entities:
-            if entity.type_ in ["ESTADO_RESULTADOS", "ESTADO_SITUACION_FINANCIERA", "ESTADO_FLUJOS_EFECTIVO"]:
-                doc_type = entity.type_
-                confidence = entity.confidence
-                break
-        
-        return {
-            "document_type": doc_type,
-            "confidence": round(confidence, 3),
-            "classifier_version": processor_name,
-        }
-    except Exception as e:
-        logger.error(f"Classification error: {e}")
-        return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "error"}
+def _is_throttling_error(error: Exception) -> bool:
+    return isinstance(error, (api_exceptions.TooManyRequests, api_exceptions.ResourceExhausted))
 
 
-def extract_document_data(gcs_uri: str, doc_type: str) -> Dict[str, Any]:
-    """Extrae datos estructurados con Document AI Extractor con trazabilidad completa."""
-    try:
-        # Seleccionar el processor apropiado basado en el tipo de documento
-        if doc_type == "ESTADO_RESULTADOS":
-            processor_name_env = ER_EXTRACTOR_PROCESSOR_NAME
-        elif doc_type == "ESTADO_SITUACION_FINANCIERA":
-            processor_name_env = ESF_EXTRACTOR_PROCESSOR_NAME
+def _is_retryable_error(error: Exception) -> bool:
+    """Solo cuota, indisponibilidad y timeouts se reintentan; INVALID_ARGUMENT, NOT_FOUND, etc. no."""
+    return isinstance(error, _retryable_errors())
+
+
+class _ProcessorRateLimiter:
+    """Token bucket + límite de concurrencia adaptativo (AIMD) para un processor.
+
+    - Token bucket: DOCAI_RATE_LIMIT_QPS sostenido con ráfagas de DOCAI_RATE_LIMIT_BURST.
+    - Concurrencia: sube +1/limit por respuesta rápida (aditivo) y se reduce a la mitad
+      ante 429/RESOURCE_EXHAUSTED (multiplicativo); latencias sobre DOCAI_LATENCY_TARGET
+      la reducen un 10%.
+    - Un throttling vacía el bucket y pausa a todos los llamadores durante el backoff,
+      en lugar de que cada thread reintente por su cuenta.
+    """
+
+    def __init__(self, name: str, qps: float, burst: int, min_limit: int, max_limit: int):
+        self.name = name
+        self._qps = qps
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last_refill = time.monotonic()
+        self._min_limit = max(1, min_limit)
+        self._max_limit = max(self._min_limit, max_limit)
+        self._limit = float(self._max_limit)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._throttle_count = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        if self._qps > 0:
+            self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._qps)
         else:
-            # Para otros tipos o desconocido, usar ER por defecto (o manejar error)
-            logger.warning(f"No specific extractor for doc_type {doc_type}, using ER extractor")
-            processor_name_env = ER_EXTRACTOR_PROCESSOR_NAME
-        
-        if not processor_name_env:
-            return _generate_fallback_extraction()
-        
-        processor_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{processor_name_env}"
-        document = _process_document_ai_with_retry(processor_name, gcs_uri)
-        
-        if not document:
-            return _generate_fallback_extraction()
-        
-        fields = {}
-        line_items = []
-        
-        for entity in document.entities:
-            text_value = entity.mention_text if hasattr(entity, 'mention_text') else ""
-            confidence = entity.confidence if hasattr(entity, 'confidence') else 0.0
-            
-            # Extraer page_refs y bounding boxes
-            page_refs = []
-            if hasattr(entity, 'page_anchor') and entity.page_anchor:
-                for page_ref in entity.page_anchor.page_refs:
-                    page_info = {"page": page_ref.page if hasattr(page_ref, 'page') else 0}
-                    if hasattr(page_ref, 'bounding_poly') and page_ref.bounding_poly:
-                        vertices = [{"x": v.x, "y": v.y} for v in page_ref.bounding_poly.normalized_vertices]
-                        page_info["bounding_box"] = vertices
-                    page_refs.append(page_info)
-            
-            field_data = {
-                "value": text_value,
-                "confidence": round(confidence, 3),
-                "page_refs": page_refs,
-            }
-            
-            # Organizar por tipo de entidad
-            entity_type = entity.type_
-            if entity_type in ["LINE_ITEM_NAME", "LINE_ITEM_VALUE", "COLUMN_YEAR",
-                              "SECTION_HEADER", "TOTAL_LABEL"]:
-                line_items.append({"type": entity_type, **field_data})
-            else:
-                fields[entity_type] = field_data
-        
-        if line_items:
-            fields["line_items"] = line_items
-        
-        return {
-            "fields": fields,
-            "metadata": {
-                "page_count": len(document.pages) if hasattr(document, 'pages') else 0,
-                "processor_version": processor_name,
-                "extraction_schema_version": "v1.0",
+            self._tokens = float(self._burst)
+        self._last_refill = now
+
+    def _try_acquire(self) -> float:
+        """Intenta tomar un slot. Retorna 0 si lo obtuvo, o los segundos sugeridos de espera."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= int(self._limit):
+            return 0.05
+        self._refill(now)
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self._qps
+        self._tokens -= 1.0
+        self._in_flight += 1
+        return 0.0
+
+    def acquire(self) -> None:
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if wait <= 0:
+                    return
+                self._cond.wait(timeout=wait)
+
+    async def acquire_async(self) -> None:
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, latency: float, error: Optional[Exception] = None, retry_attempt: int = 0) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if error is not None and _is_throttling_error(error):
+                self._throttle_count += 1
+                self._limit = max(self._min_limit, self._limit / 2)
+                self._tokens = 0.0
+                self._paused_until = max(self._paused_until, time.monotonic() + _jittered_backoff_delay(retry_attempt))
+                logger.warning(f"Document AI throttled on {self.name}, concurrency limit now {int(self._limit)}")
+            elif error is None:
+                if latency > DOCAI_LATENCY_TARGET:
+                    self._limit = max(self._min_limit, self._limit * 0.9)
+                else:
+                    self._limit = min(self._max_limit, self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "processor": self.name,
+                "concurrency_limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "tokens": round(self._tokens, 2),
+                "throttle_count": self._throttle_count,
             }
-        }
-    except Exception as e:
-        logger.error(f"Extraction error: {e}")
-        return _generate_fallback_extraction()
 
 
-def _generate_fallback_extraction() -> Dict[str, Any]:
-    """Genera extracción mínima cuando Document AI no está disponible."""
-    return {
-        "fields": {},
-        "metadata": {
-            "page_count": 0,
-            "processor_version": "fallback",
-            "extraction_schema_version": "v1.0",
-        }
-    }
+def _get_rate_limiter(processor_name: str) -> _ProcessorRateLimiter:
+    return _get_client(f"rate_limiter:{processor_name}", lambda: _ProcessorRateLimiter(
+        processor_name, DOCAI_RATE_LIMIT_QPS, DOCAI_RATE_LIMIT_BURST, DOCAI_MIN_CONCURRENCY, DOCAI_MAX_CONCURRENCY,
+    ))
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
-# FIRESTORE PERSISTENCE: Esquema jerárquico según spec
-# folios/{folioId}/documentos/{docId}/extracciones/{extractionId}
+# SCHEDULER: Pool de workers compartido por todos los folios de la instancia
+# Cloud Run atiende varios eventos a la vez en una instancia; en lugar de un pool por
+# request, todos los documentos pasan por una cola por folio y MAX_CONCURRENT_DOCS
+# workers las atienden en round-robin. Un folio de 2 PDFs que llega detrás de uno de
+# 300 espera como máximo un documento por folio activo, no al folio completo.
 # ═══════════════════════════════════════════════════════════════════════════════
-def _get_firestore_client() -> firestore.Client:
-    return firestore.Client(database=FIRESTORE_DATABASE)
-
+class _FairScheduler:
+    """Workers de la instancia con colas FIFO por folio atendidas en round-robin.
 
-def _ensure_folio_document(db: firestore.Client, folio_id: str, bucket: str, folder_prefix: str) -> bool:
-    """Crea o actualiza documento de folio en Firestore.
-    
-    Returns:
-        True si debe procesar, False si ya está completo.
+    submit() captura el contexto del llamador (span/timer del folio) y retorna un
+    concurrent.futures.Future. La espera en cola se acumula como etapa "queue" del folio.
     """
-    try:
-        folio_ref = db.collection("folios").document(folio_id)
-        folio_doc = folio_ref.get()
-        
-        if not folio_doc.exists:
-            folio_ref.set({
-                "bucket": bucket,
-                "folder_prefix": folder_prefix,
-                "status": "PROCESSING",
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max(1, max_workers)
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._idle = 0
+        self._queued = 0
+        self._active = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, folio_id: str, fn: Callable[..., Any], *args: Any) -> Future:
+        future: Future = Future()
+        task = (future, contextvars.copy_context(), fn, args, time.monotonic())
+        with self._cond:
+            self._queues.setdefault(folio_id, deque()).append(task)
+            self._queued += 1
+            if self._idle < self._queued and len(self._workers) < self._max_workers:
+                worker = threading.Thread(target=self._run_worker, name=f"apolo-worker-{len(self._workers)}", daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._cond.notify()
+        _get_instrument("scheduler_queue_depth").add(1)
+        return future
+
+    def _next_task(self) -> Tuple[Any, ...]:
+        # El folio atendido pasa al final de la rotación si le quedan documentos
+        folio_id, queue = next(iter(self._queues.items()))
+        task = queue.popleft()
+        del self._queues[folio_id]
+        if queue:
+            self._queues[folio_id] = queue
+        self._queued -= 1
+        self._active += 1
+        return task
+
+    def _run_worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                future, context, fn, args, enqueued = self._next_task()
+                waited = time.monotonic() - enqueued
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            _get_instrument("scheduler_queue_depth").add(-1)
+            _get_instrument("scheduler_wait").record(waited)
+            try:
+                if future.set_running_or_notify_cancel():
+                    timer = context.get(_CURRENT_TIMER)
+                    if timer is not None:
+                        timer.add_duration("queue", waited)
+                    try:
+                        future.set_result(context.run(fn, *args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._completed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            started = self._completed + self._active
+            return {
+                "max_workers": self._max_workers,
+                "active": self._active,
+                "queue_depth": self._queued,
+                "queued_folios": len(self._queues),
+                "avg_wait_ms": round(self._wait_total / started * 1000, 1) if started else 0.0,
+                "max_wait_ms": round(self._wait_max * 1000, 1),
+            }
+
+
+def _get_scheduler() -> _FairScheduler:
+    return _get_client("scheduler", lambda: _FairScheduler(MAX_CONCURRENT_DOCS))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RESULT CACHE: Resultados de Document AI por contenido
+# Clave = SHA-256(bytes del PDF) + versión del processor, de modo que el mismo PDF subido
+# con otro nombre o en otro folio no vuelve a pagar Classifier/Extractor, y un cambio de
+# la versión por defecto del processor invalida los resultados anteriores.
+# Nivel 1: LRU en memoria de la instancia. Nivel 2: Firestore (colección
+# RESULT_CACHE_COLLECTION) con expires_at, compatible con una política TTL de Firestore.
+# Por documento, las claves se leen en un solo get_all y las escrituras viajan en el
+# WriteBatch del folio; los resultados grandes quedan en GCS como result_uri.
+# ═══════════════════════════════════════════════════════════════════════════════
+RESULT_CACHE_SCHEMA_VERSION = "v2"
+
+
+class _LruCache:
+    """LRU thread-safe con expiración por entrada."""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return copy.deepcopy(value)
+
+    def put(self, key: str, value: Any, ttl_seconds: float) -> None:
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl_seconds, copy.deepcopy(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+
+_RESULT_LRU = _LruCache(RESULT_CACHE_LRU_SIZE)
+_PROCESSOR_VERSIONS = _LruCache(64)
+_PROCESSOR_VERSIONS_LOCK = threading.Lock()
+
+
+def _processor_version(processor_name: str) -> Optional[str]:
+    """Versión del processor que atiende las llamadas: processorVersions/... completo.
+
+    Un nombre que ya es una versión se usa tal cual; si no, se resuelve la versión por
+    defecto con get_processor y se guarda PROCESSOR_VERSION_TTL_SECONDS. None si no se
+    pudo resolver (la caché de resultados no se usa para ese processor); el fallo se
+    recuerda un minuto para no consultar get_processor en cada documento.
+    """
+    if "/processorVersions/" in processor_name:
+        return processor_name
+    version = _PROCESSOR_VERSIONS.get(processor_name)
+    if version is not None:
+        return version or None
+    with _PROCESSOR_VERSIONS_LOCK:
+        version = _PROCESSOR_VERSIONS.get(processor_name)
+        if version is not None:
+            return version or None
+        try:
+            version = _get_documentai_client().get_processor(name=processor_name).default_processor_version
+        except Exception as e:
+            logger.warning(f"Could not resolve default version of {processor_name}: {e}")
+            version = ""
+        ttl = PROCESSOR_VERSION_TTL_SECONDS if version else min(60.0, PROCESSOR_VERSION_TTL_SECONDS)
+        _PROCESSOR_VERSIONS.put(processor_name, version, ttl)
+        return version or None
+
+
+def _result_cache_key(stage: str, processor_version: str, content: bytes) -> str:
+    content_hash = hashlib.sha256(content).hexdigest()
+    combined = f"{RESULT_CACHE_SCHEMA_VERSION}:{stage}:{processor_version}:{content_hash}"
+    return hashlib.sha256(combined.encode()).hexdigest()
+
+
+class _ResultCacheSession:
+    """Caché de resultados durante el procesamiento de un documento.
+
+    prefetch lee en un solo get_all las claves que el documento puede consultar
+    (clasificación y extracción completa con cada Extractor): los aciertos pasan al LRU y
+    las ausencias se recuerdan para no releerlas. Las escrituras se acumulan en writes y
+    enqueue las pasa al _FirestoreWriteBatcher del folio, junto con el resultado del documento.
+    """
+
+    def __init__(self):
+        self.misses: Set[str] = set()
+        self.writes: List[Tuple[str, Dict[str, Any]]] = []
+
+    def prefetch(self, content: bytes, classify: bool = True) -> None:
+        if not RESULT_CACHE_ENABLED or RESULT_CACHE_BYPASS:
+            return
+        stages: List[Tuple[str, str]] = []
+        if classify and CLASSIFIER_PROCESSOR_NAME:
+            stages.append((_classification_cache_stage(), _processor_path(CLASSIFIER_PROCESSOR_NAME)))
+        for doc_type in EXTRACTOR_DOC_TYPES:
+            extractor = _select_extractor(doc_type)
+            if extractor:
+                stages.append((_extraction_cache_stage(None), _processor_path(extractor)))
+        keys = []
+        for stage, processor_name in dict.fromkeys(stages):
+            processor_version = _processor_version(processor_name)
+            if processor_version is None:
+                continue
+            key = _result_cache_key(stage, processor_version, content)
+            if key not in self.misses and _RESULT_LRU.get(key) is None:
+                keys.append(key)
+        if not keys:
+            return
+        try:
+            db = _get_firestore_client()
+            collection = db.collection(RESULT_CACHE_COLLECTION)
+            found = set()
+            for snap in db.get_all([collection.document(key) for key in keys]):
+                result = _cached_result(snap.to_dict() or {}) if snap.exists else None
+                if result is not None:
+                    _RESULT_LRU.put(snap.id, result, RESULT_CACHE_TTL_SECONDS)
+                    found.add(snap.id)
+            self.misses.update(key for key in keys if key not in found)
+        except Exception as e:
+            logger.warning(f"Result cache prefetch failed: {e}")
+
+    def enqueue(self, writer: "_FirestoreWriteBatcher", db: "_AnyFirestoreClient") -> None:
+        collection = db.collection(RESULT_CACHE_COLLECTION)
+        writes, self.writes = self.writes, []
+        for key, entry in writes:
+            writer.set(collection.document(key), entry)
+
+
+_RESULT_CACHE_SESSION: contextvars.ContextVar[Optional[_ResultCacheSession]] = \
+    contextvars.ContextVar("apolo_result_cache_session", default=None)
+
+
+@contextlib.contextmanager
+def _result_cache_session() -> Iterator[_ResultCacheSession]:
+    session = _ResultCacheSession()
+    token = _RESULT_CACHE_SESSION.set(session)
+    try:
+        yield session
+    finally:
+        _RESULT_CACHE_SESSION.reset(token)
+
+
+def _cached_result(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Resultado de una entrada de caché en Firestore; None si expiró."""
+    expires_at = data.get("expires_at")
+    # La política TTL de Firestore borra con retraso; se valida la expiración al leer
+    if expires_at is not None and expires_at < datetime.now(timezone.utc):
+        return None
+    result_uri = data.get("result_uri")
+    if result_uri:
+        bucket_name, _, blob_name = result_uri.replace("gs://", "").partition("/")
+        return json.loads(_get_storage_client().bucket(bucket_name).blob(blob_name).download_as_bytes())
+    return data.get("result")
+
+
+def _result_cache_get(stage: str, processor_name: str, content: bytes) -> Optional[Dict[str, Any]]:
+    """Busca un resultado previo (LRU y luego Firestore). None si no existe, expiró o hay bypass.
+
+    Con una _ResultCacheSession activa, las claves que su prefetch ya encontró ausentes
+    no se vuelven a leer.
+    """
+    if not RESULT_CACHE_ENABLED or RESULT_CACHE_BYPASS:
+        return None
+    processor_version = _processor_version(processor_name)
+    if processor_version is None:
+        return None
+    key = _result_cache_key(stage, processor_version, content)
+    cached = _RESULT_LRU.get(key)
+    if cached is not None:
+        logger.info(f"Result cache hit (memory): {stage}")
+        return cached
+    session = _RESULT_CACHE_SESSION.get()
+    if session is not None and key in session.misses:
+        return None
+    try:
+        snap = _get_firestore_client().collection(RESULT_CACHE_COLLECTION).document(key).get()
+        result = _cached_result(snap.to_dict() or {}) if snap.exists else None
+        if result is None:
+            return None
+        _RESULT_LRU.put(key, result, RESULT_CACHE_TTL_SECONDS)
+        logger.info(f"Result cache hit (firestore): {stage}")
+        return result
+    except Exception as e:
+        logger.warning(f"Result cache read failed: {e}")
+        return None
+
+
+def _result_cache_put(stage: str, processor_name: str, content: bytes, result: Dict[str, Any],
+                      gcs_uri: str = "") -> None:
+    """Guarda un resultado exitoso en ambos niveles de caché.
+
+    Con una _ResultCacheSession activa la escritura en Firestore se encola para el writer
+    del folio; sin sesión se escribe directamente. Un resultado mayor que
+    EXTRACTION_INLINE_MAX_BYTES se sube a EXTRACTION_SPILL_URI y la entrada solo guarda
+    result_uri; sin bucket de spill se queda únicamente en el LRU.
+    """
+    if not RESULT_CACHE_ENABLED:
+        return
+    processor_version = _processor_version(processor_name)
+    if processor_version is None:
+        return
+    key = _result_cache_key(stage, processor_version, content)
+    _RESULT_LRU.put(key, result, RESULT_CACHE_TTL_SECONDS)
+    entry: Dict[str, Any] = {
+        "stage": stage,
+        "processor": processor_name,
+        "processor_version": processor_version,
+        "content_sha256": hashlib.sha256(content).hexdigest(),
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=RESULT_CACHE_TTL_SECONDS),
+    }
+    try:
+        payload_bytes = len(json.dumps(result, default=str))
+        if payload_bytes > EXTRACTION_INLINE_MAX_BYTES:
+            source_bucket = gcs_uri.replace("gs://", "").split("/", 1)[0]
+            if not _spill_bucket(source_bucket):
+                logger.info(f"Result cache entry of {payload_bytes} bytes kept in memory only "
+                            "(EXTRACTION_SPILL_URI is not configured)")
+                return
+            entry["result_uri"] = _spill_extraction_to_gcs(result, source_bucket, "_cache", "", key)
+        else:
+            entry["result"] = result
+        session = _RESULT_CACHE_SESSION.get()
+        if session is not None:
+            session.writes.append((key, entry))
+            return
+        _get_firestore_client().collection(RESULT_CACHE_COLLECTION).document(key).set(entry)
+    except Exception as e:
+        logger.warning(f"Result cache write failed: {e}")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PRE-CLASSIFICATION: Inferencia local del tipo de documento
+# Si el tipo se resuelve con suficiente confianza a partir de convenciones de nombre,
+# metadata del objeto GCS o texto de la primera página, se omite el Classifier.
+# ═══════════════════════════════════════════════════════════════════════════════
+_DOC_TYPE_PHRASES: Dict[str, List[str]] = {
+    "ESTADO_RESULTADOS": [
+        "estado de resultados", "estado resultados", "edo resultados", "estado de perdidas y ganancias",
+        "perdidas y ganancias",
+    ],
+    "ESTADO_SITUACION_FINANCIERA": [
+        "estado de situacion financiera", "situacion financiera", "balance general", "estado de posicion financiera",
+    ],
+    "ESTADO_FLUJOS_EFECTIVO": [
+        "estado de flujos de efectivo", "estado de flujo de efectivo", "flujos de efectivo", "flujo de efectivo",
+    ],
+}
+# Abreviaturas usadas por los brokers como token aislado en el nombre del archivo
+_DOC_TYPE_TOKENS: Dict[str, Set[str]] = {
+    "ESTADO_RESULTADOS": {"er", "edoresultados", "pyg"},
+    "ESTADO_SITUACION_FINANCIERA": {"esf", "balance"},
+    "ESTADO_FLUJOS_EFECTIVO": {"efe"},
+}
+_METADATA_DOC_TYPE_KEYS = ("doc_type", "tipo_documento", "document_type")
+_PDF_STREAM_RE = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.S)
+_PDF_TEXT_RE = re.compile(rb"\(((?:[^()\\]|\\.)*)\)\s*Tj|\[((?:[^\]]*))\]\s*TJ", re.S)
+_PDF_TJ_PART_RE = re.compile(rb"\(((?:[^()\\]|\\.)*)\)")
+
+
+def _normalize_text(text: str) -> str:
+    """Minúsculas, sin acentos y con separadores colapsados a un espacio."""
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.split(r"[^a-z0-9]+", text)).strip()
+
+
+def _match_doc_types(text: str, use_tokens: bool) -> Dict[str, float]:
+    normalized = _normalize_text(text)
+    tokens = set(normalized.split())
+    matches: Dict[str, float] = {}
+    for doc_type, phrases in _DOC_TYPE_PHRASES.items():
+        if any(phrase in normalized for phrase in phrases):
+            matches[doc_type] = 0.9
+        elif use_tokens and tokens & _DOC_TYPE_TOKENS[doc_type]:
+            matches[doc_type] = 0.8
+    return matches
+
+
+def _first_page_text(content: bytes) -> str:
+    """Extrae texto literal (operadores Tj/TJ) de los primeros streams del PDF.
+
+    Heurística barata: descomprime streams FlateDecode dentro de FAST_CLASSIFY_SCAN_BYTES;
+    PDFs escaneados o con fuentes CID simplemente no devuelven texto útil.
+    """
+    chunks = []
+    for match in _PDF_STREAM_RE.finditer(content[:FAST_CLASSIFY_SCAN_BYTES]):
+        raw = match.group(1)
+        try:
+            data = zlib.decompress(raw)
+        except zlib.error:
+            data = raw
+        for text_match in _PDF_TEXT_RE.finditer(data):
+            if text_match.group(1) is not None:
+                chunks.append(text_match.group(1))
+            else:
+                chunks.extend(_PDF_TJ_PART_RE.findall(text_match.group(2)))
+        if len(chunks) > 2000:
+            break
+    return b" ".join(chunks).decode("latin-1", errors="ignore")
+
+
+def _infer_document_type(file_name: str, object_metadata: Optional[Dict[str, str]],
+                         content: Optional[bytes]) -> Optional[Dict[str, Any]]:
+    """Intenta resolver el tipo de documento sin llamar al Classifier.
+
+    Orden: metadata GCS explícita > nombre de archivo > texto de la primera página.
+    Retorna None si no hay señal, es ambigua o la confianza es menor a
+    FAST_CLASSIFY_MIN_CONFIDENCE.
+    """
+    if not FAST_CLASSIFY_ENABLED:
+        return None
+    
+    candidates: List[Tuple[str, str, float]] = []
+    for key in _METADATA_DOC_TYPE_KEYS:
+        value = (object_metadata or {}).get(key)
+        if value:
+            upper = value.strip().upper()
+            if upper in _DOC_TYPE_PHRASES:
+                candidates.append(("metadata", upper, 1.0))
+            else:
+                matches = _match_doc_types(value, use_tokens=True)
+                if len(matches) == 1:
+                    doc_type, score = next(iter(matches.items()))
+                    candidates.append(("metadata", doc_type, max(score, 0.95)))
+            break
+    
+    if not candidates:
+        matches = _match_doc_types(file_name.split("/")[-1].rsplit(".", 1)[0], use_tokens=True)
+        if len(matches) == 1:
+            doc_type, score = next(iter(matches.items()))
+            candidates.append(("filename", doc_type, score))
+    
+    if not candidates and content:
+        matches = _match_doc_types(_first_page_text(content), use_tokens=False)
+        if len(matches) == 1:
+            doc_type, score = next(iter(matches.items()))
+            candidates.append(("text", doc_type, score - 0.05))
+    
+    if not candidates:
+        return None
+    source, doc_type, confidence = candidates[0]
+    if confidence < FAST_CLASSIFY_MIN_CONFIDENCE:
+        return None
+    return {
+        "document_type": doc_type,
+        "confidence": round(confidence, 3),
+        "classifier_version": f"fast_path:{source}",
+        "classification_source": source,
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# STATEMENT TABLES: Reconstrucción de la tabla de estados financieros
+# Agrupa LINE_ITEM_NAME / LINE_ITEM_VALUE / COLUMN_YEAR / SECTION_HEADER / TOTAL_LABEL en
+# renglones (misma página y altura) y columnas (posición x del encabezado de año), parsea
+# los importes y valida los renglones de total contra la suma de su sección. En el estado
+# de resultados las utilidades (bruta, de operación, antes de impuestos, neta) se validan
+# como resultado anterior + ingresos - costos y gastos, no como suma. En el balance los
+# grandes totales (Total activo, Total pasivo, Total capital) se validan contra sus subtotales.
+# ═══════════════════════════════════════════════════════════════════════════════
+STATEMENT_TABLE_DOC_TYPES = {"ESTADO_RESULTADOS", "ESTADO_SITUACION_FINANCIERA"}
+# Tolerancia de los cruces de totales: absoluta (redondeo a unidades) o relativa, la mayor
+TABLE_CHECK_ABS_TOLERANCE = 1.0
+TABLE_CHECK_REL_TOLERANCE = 0.001
+# Separación vertical mínima (coordenadas normalizadas) para abrir un renglón nuevo
+TABLE_MIN_ROW_GAP = 0.004
+
+_MX_AMOUNT_NOISE = re.compile(r"(?i)mxn|m\.n\.|pesos|\$|[^\S\n]")
+# Un match por línea de la columna: guion solo | (paréntesis)(signo)(enteros)(decimales)(signo)(paréntesis)
+# | cualquier otro texto (no numérico)
+_MX_AMOUNT_LINE = re.compile(
+    r"(?m)^(?:([-−–—])|(\()?([-−])?(\d{1,3}(?:,\d{3})+|\d+)?(\.\d+)?([-−])?(\))?)$|^.*$"
+)
+# Clases de renglón del estado de resultados (texto normalizado por _normalize_text)
+_ER_SUM_TOTAL_PREFIXES = ("total", "suma")
+_ER_RESULT_TERMS = ("utilidad", "perdida", "resultado", "ebitda", "margen")
+_ER_EXPENSE_TERMS = ("costo", "gasto", "impuesto", "isr", "ptu", "depreciacion", "amortizacion",
+                     "devolucion", "descuento", "bonificacion", "perdida")
+_ER_INCOME_TERMS = ("ingreso", "venta", "producto", "utilidad")
+# Clases del balance y palabras que puede llevar un gran total ("Total del activo",
+# "Total pasivo y capital contable"); cualquier otra palabra lo vuelve subtotal
+_BALANCE_CLASS_TERMS = {"activo": "activo", "activos": "activo", "pasivo": "pasivo", "pasivos": "pasivo",
+                        "capital": "capital", "patrimonio": "capital"}
+_BALANCE_GRAND_TOTAL_WORDS = {"total", "suma", "de", "del", "el", "la", "los", "las", "y", "e", "contable"}
+_BALANCE_ASSETS = frozenset({"activo"})
+_BALANCE_LIABILITIES = frozenset({"pasivo"})
+_BALANCE_EQUITY = frozenset({"capital"})
+_BALANCE_LIABILITIES_EQUITY = frozenset({"pasivo", "capital"})
+
+
+def _parse_mx_amounts(values: List[str]) -> List[Optional[float]]:
+    """Parsea una columna completa de importes en formato mexicano.
+
+    Acepta separadores de miles con coma, punto decimal, "$", "MXN"/"M.N." y negativos
+    con paréntesis o signo. Un guion solo equivale a cero; lo no numérico es None.
+    La columna se procesa como un solo texto (un importe por línea): una pasada de
+    limpieza, un findall y la conversión a float en lote de los importes válidos.
+    """
+    column = "\n".join((value or "").replace("\n", " ") for value in values)
+    matches = _MX_AMOUNT_LINE.findall(_MX_AMOUNT_NOISE.sub("", column))
+    parsed: List[Optional[float]] = [0.0 if match[0] else None for match in matches]
+    # Con dígitos y paréntesis balanceados
+    numeric = [i for i, match in enumerate(matches) if (match[3] or match[4]) and bool(match[1]) == bool(match[6])]
+    amounts = map(float, [matches[i][3].replace(",", "") + matches[i][4] for i in numeric])
+    for i, amount in zip(numeric, amounts):
+        match = matches[i]
+        parsed[i] = -amount if match[1] or match[2] or match[5] else amount
+    return parsed
+
+
+def _entity_geometry(item: Dict[str, Any]) -> Optional[Tuple[int, float, float, float]]:
+    """(página, x_centro, y_centro, alto) de la primera page_ref con bounding box."""
+    for ref in item.get("page_refs") or []:
+        vertices = ref.get("bounding_box") or []
+        if vertices:
+            xs = [v.get("x", 0.0) for v in vertices]
+            ys = [v.get("y", 0.0) for v in vertices]
+            return int(ref.get("page", 0)), (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2, max(ys) - min(ys)
+    return None
+
+
+def _group_rows(placed: List[Tuple[int, float, float, float, Dict[str, Any]]]) -> List[Tuple[int, List[Tuple[float, Dict[str, Any]]]]]:
+    """Agrupa entidades en renglones por página y altura (y) y ordena cada renglón por x.
+
+    Returns:
+        [(página, [(x, item)])] en orden de lectura.
+    """
+    heights = sorted(h for _, _, _, h, _ in placed if h > 0)
+    tolerance = max(TABLE_MIN_ROW_GAP, 0.6 * heights[len(heights) // 2]) if heights else TABLE_MIN_ROW_GAP
+    
+    rows: List[Tuple[int, List[Tuple[float, Dict[str, Any]]]]] = []
+    anchor: Optional[Tuple[int, float]] = None
+    for page, x, y, _, item in sorted(placed, key=lambda p: (p[0], p[2], p[1])):
+        if anchor is None or page != anchor[0] or y - anchor[1] > tolerance:
+            rows.append((page, []))
+            anchor = (page, y)
+        rows[-1][1].append((x, item))
+    for _, entries in rows:
+        entries.sort(key=lambda entry: entry[0])
+    return rows
+
+
+def _column_positions(headers: List[Tuple[int, float, Dict[str, Any]]]) -> Tuple[List[str], Dict[int, List[Tuple[float, int]]]]:
+    """Etiquetas de columna (en orden de aparición por x) y posiciones x por página."""
+    labels: List[str] = []
+    by_page: Dict[int, List[Tuple[float, int]]] = {}
+    for page, x, item in sorted(headers, key=lambda h: (h[0], h[1])):
+        label = (item.get("value") or "").strip()
+        if label not in labels:
+            labels.append(label)
+        by_page.setdefault(page, []).append((x, labels.index(label)))
+    return labels, by_page
+
+
+def _nearest_column(page: int, x: float, by_page: Dict[int, List[Tuple[float, int]]]) -> Optional[int]:
+    # Páginas sin encabezados usan los de la página previa más cercana
+    candidates = [p for p in by_page if p <= page] or list(by_page)
+    if not candidates:
+        return None
+    positions = by_page[max(candidates)]
+    return min(positions, key=lambda pos: abs(pos[0] - x))[1]
+
+
+def _within_tolerance(expected: float, computed: float) -> bool:
+    return abs(expected - computed) <= max(TABLE_CHECK_ABS_TOLERANCE, abs(expected) * TABLE_CHECK_REL_TOLERANCE)
+
+
+def _er_term_classes(text: str) -> List[int]:
+    """Clase de cada término de costo/gasto (-1) o de ingreso (1) del texto, en orden."""
+    classes = []
+    for word in _normalize_text(text).split():
+        if any(word.startswith(term) for term in _ER_EXPENSE_TERMS):
+            classes.append(-1)
+        elif any(word.startswith(term) for term in _ER_INCOME_TERMS):
+            classes.append(1)
+    return classes
+
+
+def _er_row_sign(row: Dict[str, Any]) -> int:
+    """Signo con el que un renglón entra a los cruces del estado de resultados.
+
+    -1 = costo o gasto (se resta su valor absoluto); 1 = entra con el signo impreso.
+    Una etiqueta mixta la decide su primer término ("Costo de ventas" resta, "Otros
+    ingresos (gastos)" va como está impreso); una etiqueta con costo o gasto resta; si no,
+    decide la sección ("De venta" dentro de "Gastos de operación" resta).
+    """
+    label = _er_term_classes(row["label"])
+    if -1 in label:
+        return label[0]
+    section = _er_term_classes(row["section"])
+    if section and section[0] < 0:
+        return -1
+    return 1
+
+
+def _signed(sign: int, value: float) -> float:
+    return -abs(value) if sign < 0 else value
+
+
+def _column_terms(parts: List[Tuple[int, List[Optional[float]]]], index: int, signed: bool) -> List[float]:
+    """Valores no nulos de la columna index; con signed, con el signo de su clase de renglón."""
+    terms: List[float] = []
+    for sign, values in parts:
+        value = values[index]
+        if value is not None:
+            terms.append(_signed(sign, value) if signed else value)
+    return terms
+
+
+def _total_row_kind(row: Dict[str, Any], doc_type: str) -> Optional[str]:
+    """"sum" si el total es la suma de su sección, "result" si es una utilidad del estado
+    de resultados, None si no se puede validar. En el balance todos los totales son sumas."""
+    if doc_type != "ESTADO_RESULTADOS":
+        return "sum"
+    label = _normalize_text(row["label"])
+    if label.startswith(_ER_SUM_TOTAL_PREFIXES):
+        return "sum"
+    if any(term in label.split() for term in _ER_RESULT_TERMS):
+        return "result"
+    return None
+
+
+def _balance_classes(text: str) -> FrozenSet[str]:
+    """Clases del balance (activo, pasivo, capital) que menciona el texto."""
+    return frozenset(_BALANCE_CLASS_TERMS[word] for word in _normalize_text(text).split() if word in _BALANCE_CLASS_TERMS)
+
+
+def _balance_grand_total(label: str) -> FrozenSet[str]:
+    """Clases de un gran total del balance ("Total activo", "Total pasivo y capital");
+    vacío si el renglón es un subtotal ("Total activo circulante")."""
+    words = _normalize_text(label).split()
+    if any(word not in _BALANCE_CLASS_TERMS and word not in _BALANCE_GRAND_TOTAL_WORDS for word in words):
+        return frozenset()
+    return _balance_classes(label)
+
+
+def _total_check(kind: str, section: str, label: str, column: str, expected: float, computed: float) -> Dict[str, Any]:
+    return {
+        "kind": kind,
+        "section": section,
+        "label": label,
+        "column": column,
+        "expected": expected,
+        "computed": round(computed, 2),
+        "difference": round(expected - computed, 2),
+        "ok": _within_tolerance(expected, computed),
+    }
+
+
+def _statement_checks(rows: List[Dict[str, Any]], columns: List[str], doc_type: str) -> List[Dict[str, Any]]:
+    """Cruces de totales.
+
+    - Totales de suma ("Total ...", y los subtotales del balance): contra la suma de los
+      renglones de detalle de su sección desde el total anterior. En el estado de
+      resultados con signo por clase de renglón ("Total ingresos" resta devoluciones;
+      "Total gastos" suma gastos impresos positivos o entre paréntesis).
+    - Utilidades del estado de resultados: contra la utilidad anterior más los renglones
+      desde ella, con los costos y gastos restando (_er_row_sign); una sección cerrada por
+      su total entra con el total, no con sus detalles.
+    - Grandes totales del balance: contra los subtotales y renglones de su clase aún no
+      absorbidos ("Total activo" = circulante + no circulante; "Total pasivo y capital" =
+      Total pasivo + Total capital). Los renglones sin clase entran al siguiente gran total.
+    - Balance: Total activo = Total pasivo y capital (o Total pasivo + Total capital).
+    """
+    checks: List[Dict[str, Any]] = []
+    width = len(columns)
+    balance = doc_type == "ESTADO_SITUACION_FINANCIERA"
+    # Detalles desde el último total de cada sección: {sección: [(signo, valores)]}
+    pending: Dict[str, List[Tuple[int, List[Optional[float]]]]] = {}
+    # Aportes al siguiente resultado por sección, mismo formato
+    contributions: Dict[str, List[Tuple[int, List[Optional[float]]]]] = {}
+    previous_result: List[Optional[float]] = [None] * width
+    # Balance: renglones y subtotales aún no absorbidos por un gran total, con su clase
+    units: List[Tuple[FrozenSet[str], List[Optional[float]]]] = []
+    grand_totals: Dict[FrozenSet[str], Dict[str, Any]] = {}
+    for row in rows:
+        section = row["section"]
+        if not row["is_total"]:
+            sign = _er_row_sign(row)
+            pending.setdefault(section, []).append((sign, row["values"]))
+            contributions.setdefault(section, []).append((sign, row["values"]))
+            if balance:
+                units.append((_balance_classes(section), row["values"]))
+            continue
+        grand = _balance_grand_total(row["label"]) if balance else frozenset()
+        if grand:
+            pending.pop(section, None)
+            covered = [(1, values) for classes, values in units if classes <= grand]
+            units = [unit for unit in units if not unit[0] <= grand]
+            for index, expected in enumerate(row["values"]):
+                column_values = _column_terms(covered, index, signed=False)
+                if expected is None or not column_values:
+                    continue
+                checks.append(_total_check("grand_total", section, row["label"],
+                                           columns[index] if index < len(columns) else "",
+                                           expected, sum(column_values)))
+            units.append((grand, row["values"]))
+            grand_totals[grand] = row
+            continue
+        kind = _total_row_kind(row, doc_type)
+        if kind == "sum":
+            details = pending.pop(section, [])
+            total_sign = _er_row_sign(row)
+            contributions[section] = [(total_sign, row["values"])]
+            if balance:
+                # El subtotal reemplaza a sus renglones de detalle en el siguiente gran total
+                covered_ids = {id(values) for _, values in details}
+                units = [unit for unit in units if id(unit[1]) not in covered_ids]
+                units.append((_balance_classes(row["label"]) or _balance_classes(section), row["values"]))
+            for index, expected in enumerate(row["values"]):
+                income_statement = doc_type == "ESTADO_RESULTADOS"
+                column_values = _column_terms(details, index, signed=income_statement)
+                # El total se compara en la orientación en que está impreso
+                orientation = -1 if income_statement and total_sign < 0 and expected is not None and expected > 0 else 1
+                if expected is None or not column_values:
+                    continue
+                checks.append(_total_check("section_total", section, row["label"],
+                                           columns[index] if index < len(columns) else "",
+                                           expected, orientation * sum(column_values)))
+        elif kind == "result":
+            parts = [part for section_parts in contributions.values() for part in section_parts]
+            for index, expected in enumerate(row["values"]):
+                terms = _column_terms(parts, index, signed=True)
+                if expected is None or not terms:
+                    continue
+                checks.append(_total_check("result", section, row["label"],
+                                           columns[index] if index < len(columns) else "",
+                                           expected, (previous_result[index] or 0.0) + sum(terms)))
+            previous_result = list(row["values"])
+            pending.clear()
+            contributions.clear()
+    
+    assets = grand_totals.get(_BALANCE_ASSETS)
+    combined = grand_totals.get(_BALANCE_LIABILITIES_EQUITY)
+    sides = [combined] if combined else [grand_totals.get(_BALANCE_LIABILITIES), grand_totals.get(_BALANCE_EQUITY)]
+    liabilities_equity = [side for side in sides if side is not None]
+    if assets and liabilities_equity and len(liabilities_equity) == len(sides):
+        label = f"{assets['label']} = {' + '.join(side['label'] for side in liabilities_equity)}"
+        for index, expected in enumerate(assets["values"]):
+            values = _column_terms([(1, side["values"]) for side in liabilities_equity], index, signed=False)
+            if expected is None or len(values) != len(liabilities_equity):
+                continue
+            checks.append(_total_check("balance", "", label, columns[index] if index < len(columns) else "",
+                                       expected, sum(values)))
+    return checks
+
+
+def _build_statement_table(line_items: List[Dict[str, Any]], doc_type: str) -> Optional[Dict[str, Any]]:
+    """Reconstruye la tabla del estado financiero a partir de los line_items v1.0.
+
+    Retorna {"columns", "rows", "checks", "checks_passed", "unplaced_items"} o None si no
+    hay geometría suficiente. Cada renglón: label, section, is_total, page, values (float
+    o None por columna) y raw (texto original por columna).
+    """
+    placed = []
+    headers = []
+    unplaced = 0
+    for item in line_items:
+        geometry = _entity_geometry(item)
+        if geometry is None:
+            unplaced += 1
+            continue
+        page, x, y, height = geometry
+        if item.get("type") == "COLUMN_YEAR":
+            headers.append((page, x, item))
+        else:
+            placed.append((page, x, y, height, item))
+    if not placed:
+        return None
+    
+    columns, column_positions = _column_positions(headers)
+    value_items = [item for _, _, _, _, item in placed if item.get("type") == "LINE_ITEM_VALUE"]
+    amounts = dict(zip(map(id, value_items), _parse_mx_amounts([i.get("value", "") for i in value_items])))
+    
+    rows: List[Dict[str, Any]] = []
+    section = ""
+    for page, entries in _group_rows(placed):
+        names = [item for _, item in entries if item.get("type") == "LINE_ITEM_NAME"]
+        totals = [item for _, item in entries if item.get("type") == "TOTAL_LABEL"]
+        sections = [item for _, item in entries if item.get("type") == "SECTION_HEADER"]
+        values = [(x, item) for x, item in entries if item.get("type") == "LINE_ITEM_VALUE"]
+        if sections and not values:
+            section = " ".join((item.get("value") or "").strip() for item in sections)
+            continue
+        if not values and not names and not totals:
+            continue
+        
+        if not columns:
+            # Sin encabezados de año: las columnas son el orden de los importes en el renglón
+            while len(columns) < len(values):
+                columns.append(f"col_{len(columns) + 1}")
+        row_values: List[Optional[float]] = [None] * len(columns)
+        row_raw: List[str] = [""] * len(columns)
+        for position, (x, item) in enumerate(values):
+            index = _nearest_column(page, x, column_positions) if column_positions else position
+            if index is None or index >= len(columns) or row_raw[index]:
+                continue
+            row_values[index] = amounts.get(id(item))
+            row_raw[index] = item.get("value", "")
+        
+        label_items = names or totals
+        rows.append({
+            "label": " ".join((item.get("value") or "").strip() for item in label_items),
+            "section": section,
+            "is_total": bool(totals),
+            "page": page,
+            "values": row_values,
+            "raw": row_raw,
+        })
+    
+    # Renglones creados antes de conocer todas las columnas (modo sin encabezados)
+    for row in rows:
+        missing = len(columns) - len(row["values"])
+        row["values"].extend([None] * missing)
+        row["raw"].extend([""] * missing)
+    
+    checks = _statement_checks(rows, columns, doc_type)
+    return {
+        "columns": columns,
+        "rows": rows,
+        "checks": checks,
+        "checks_passed": all(check["ok"] for check in checks),
+        "unplaced_items": unplaced,
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# DOCUMENT AI INTEGRATION con reintentos
+# ═══════════════════════════════════════════════════════════════════════════════
+def _processor_path(processor_id: str) -> str:
+    return f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{processor_id}"
+
+
+# Campos del Document que lee cada llamada. Document AI solo acepta campos de primer nivel
+# o pages.{campo}; sin máscara la respuesta trae text, tokens, líneas, párrafos e imágenes.
+# Classifier: entities (tipo, confianza, page_anchor) y len(pages) para page_count.
+CLASSIFIER_FIELD_MASK = ["entities", "pages.page_number"]
+# Extractor: entities completas y pages.page_number para remapear rangos de páginas.
+EXTRACTOR_FIELD_MASK = ["entities", "pages.page_number"]
+
+
+def _build_process_request(processor_name: str, content: bytes, pages: Optional[List[int]] = None,
+                           field_mask: Optional[List[str]] = None, from_start: int = 0) -> documentai.ProcessRequest:
+    """pages (1-based) limita el procesamiento a esas páginas con individual_page_selector;
+    from_start, a las primeras N páginas. field_mask recorta la respuesta a esos campos."""
+    raw_document = documentai.RawDocument(content=content, mime_type="application/pdf")
+    request = documentai.ProcessRequest(name=processor_name, raw_document=raw_document)
+    if pages:
+        request.process_options = documentai.ProcessOptions(
+            individual_page_selector=documentai.ProcessOptions.IndividualPageSelector(pages=pages)
+        )
+    elif from_start:
+        request.process_options = documentai.ProcessOptions(from_start=from_start)
+    if field_mask and DOCAI_FIELD_MASK_ENABLED:
+        request.field_mask = field_mask_pb2.FieldMask(paths=list(field_mask))
+    return request
+
+
+def _process_document_ai_with_retry(processor_name: str, content: bytes, pages: Optional[List[int]] = None,
+                                    field_mask: Optional[List[str]] = None,
+                                    from_start: int = 0) -> Optional[documentai.Document]:
+    """Procesa documento con Document AI con reintentos automáticos.
+
+    El contenido se recibe ya descargado y se reutiliza en todos los intentos.
+    """
+    if not PROJECT_ID or not processor_name:
+        logger.warning("Document AI not configured")
+        return None
+        
+    client = _get_documentai_client()
+    limiter = _get_rate_limiter(processor_name)
+    request = _build_process_request(processor_name, content, pages, field_mask, from_start)
+    
+    for attempt in range(MAX_RETRIES):
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            result = client.process_document(request=request)
+            limiter.release(time.monotonic() - started)
+            return result.document
+            
+        except Exception as e:
+            limiter.release(time.monotonic() - started, error=e, retry_attempt=attempt)
+            if not _is_retryable_error(e):
+                logger.error(f"Document AI non-retryable error: {e}")
+                return None
+            logger.warning(f"Document AI attempt {attempt + 1}/{MAX_RETRIES} failed: {e}")
+            if attempt < MAX_RETRIES - 1:
+                _record_retry(processor_name)
+                if _is_throttling_error(e):
+                    # El limitador ya pausó el processor con backoff; el siguiente acquire espera esa pausa
+                    logger.info(f"Retrying after {processor_name} throttling pause...")
+                    continue
+                delay = _jittered_backoff_delay(attempt)
+                logger.info(f"Retrying in {delay:.2f} seconds...")
+                time.sleep(delay)
+            else:
+                logger.error(f"Document AI failed after {MAX_RETRIES} attempts")
+                return None
+    
+    return None
+
+
+async def _process_document_ai_with_retry_async(processor_name: str, content: bytes,
+                                                pages: Optional[List[int]] = None,
+                                                field_mask: Optional[List[str]] = None,
+                                                from_start: int = 0) -> Optional[documentai.Document]:
+    """Equivalente async de _process_document_ai_with_retry (DocumentProcessorServiceAsyncClient)."""
+    if not PROJECT_ID or not processor_name:
+        logger.warning("Document AI not configured")
+        return None
+    
+    client = _get_documentai_async_client()
+    limiter = _get_rate_limiter(processor_name)
+    request = _build_process_request(processor_name, content, pages, field_mask, from_start)
+    
+    for attempt in range(MAX_RETRIES):
+        await limiter.acquire_async()
+        started = time.monotonic()
+        try:
+            result = await client.process_document(request=request)
+            limiter.release(time.monotonic() - started)
+            return result.document
+        except Exception as e:
+            limiter.release(time.monotonic() - started, error=e, retry_attempt=attempt)
+            if not _is_retryable_error(e):
+                logger.error(f"Document AI non-retryable error: {e}")
+                return None
+            logger.warning(f"Document AI attempt {attempt + 1}/{MAX_RETRIES} failed: {e}")
+            if attempt < MAX_RETRIES - 1:
+                _record_retry(processor_name)
+                if _is_throttling_error(e):
+                    # El limitador ya pausó el processor con backoff; el siguiente acquire espera esa pausa
+                    logger.info(f"Retrying after {processor_name} throttling pause...")
+                    continue
+                delay = _jittered_backoff_delay(attempt)
+                logger.info(f"Retrying in {delay:.2f} seconds...")
+                await asyncio.sleep(delay)
+            else:
+                logger.error(f"Document AI failed after {MAX_RETRIES} attempts")
+                return None
+    
+    return None
+
+
+def _parse_classification(document: Optional[documentai.Document], processor_name: str,
+                          max_pages: int = 0) -> Dict[str, Any]:
+    """Convierte la respuesta del Classifier en el dict de clasificación.
+
+    Si el Classifier solo vio las primeras max_pages páginas y el PDF puede tener más,
+    no se reportan page_count ni page_map (serían parciales).
+    """
+    if not document:
+        return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "error"}
+    
+    doc_type = "UNKNOWN"
+    confidence = 0.0
+    page_map: Dict[str, List[int]] = {}
+    
+    for entity in document.entities:
+        if entity.type_ in ["ESTADO_RESULTADOS", "ESTADO_SITUACION_FINANCIERA", "ESTADO_FLUJOS_EFECTIVO"]:
+            if doc_type == "UNKNOWN":
+                doc_type = entity.type_
+                confidence = entity.confidence
+            # Splitter/Classifier con page_anchor: páginas (1-based) de cada estado en el PDF
+            pages = page_map.setdefault(entity.type_, [])
+            for page_ref in entity.page_anchor.page_refs:
+                if page_ref.page + 1 not in pages:
+                    pages.append(page_ref.page + 1)
+    
+    classification = {
+        "document_type": doc_type,
+        "confidence": round(confidence, 3),
+        "classifier_version": processor_name,
+        "classification_source": "classifier",
+    }
+    if max_pages and len(document.pages) >= max_pages:
+        return classification
+    classification["page_count"] = len(document.pages)
+    page_map = {t: sorted(pages) for t, pages in page_map.items() if pages}
+    if page_map:
+        classification["page_map"] = page_map
+    return classification
+
+
+def _classification_cache_stage() -> str:
+    return "classification" if not CLASSIFIER_MAX_PAGES else f"classification:first{CLASSIFIER_MAX_PAGES}"
+
+
+def classify_document(gcs_uri: str, content: bytes) -> Dict[str, Any]:
+    """Clasifica documento usando Document AI Classifier."""
+    try:
+        if not CLASSIFIER_PROCESSOR_NAME:
+            return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "not_configured"}
+        
+        processor_name = _processor_path(CLASSIFIER_PROCESSOR_NAME)
+        stage = _classification_cache_stage()
+        cached = _result_cache_get(stage, processor_name, content)
+        if cached is not None:
+            return cached
+        
+        document = _process_document_ai_with_retry(processor_name, content, field_mask=CLASSIFIER_FIELD_MASK,
+                                                   from_start=CLASSIFIER_MAX_PAGES)
+        classification = _parse_classification(document, processor_name, CLASSIFIER_MAX_PAGES)
+        if document:
+            _result_cache_put(stage, processor_name, content, classification, gcs_uri)
+        return classification
+    except Exception as e:
+        logger.error(f"Classification error: {e}")
+        return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "error"}
+
+
+async def classify_document_async(gcs_uri: str, content: bytes) -> Dict[str, Any]:
+    """Equivalente async de classify_document."""
+    try:
+        if not CLASSIFIER_PROCESSOR_NAME:
+            return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "not_configured"}
+        
+        processor_name = _processor_path(CLASSIFIER_PROCESSOR_NAME)
+        stage = _classification_cache_stage()
+        cached = await asyncio.to_thread(_result_cache_get, stage, processor_name, content)
+        if cached is not None:
+            return cached
+        
+        document = await _process_document_ai_with_retry_async(processor_name, content, field_mask=CLASSIFIER_FIELD_MASK,
+                                                               from_start=CLASSIFIER_MAX_PAGES)
+        classification = _parse_classification(document, processor_name, CLASSIFIER_MAX_PAGES)
+        if document:
+            await asyncio.to_thread(_result_cache_put, stage, processor_name, content, classification, gcs_uri)
+        return classification
+    except Exception as e:
+        logger.error(f"Classification error: {e}")
+        return {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "error"}
+
+
+# Tipos con Extractor propio; son los únicos que se enrutan por página en PDFs multi-estado
+EXTRACTOR_DOC_TYPES = ("ESTADO_RESULTADOS", "ESTADO_SITUACION_FINANCIERA")
+
+
+def _select_extractor(doc_type: str) -> str:
+    """Selecciona el processor apropiado basado en el tipo de documento."""
+    if doc_type == "ESTADO_RESULTADOS":
+        return ER_EXTRACTOR_PROCESSOR_NAME
+    if doc_type == "ESTADO_SITUACION_FINANCIERA":
+        return ESF_EXTRACTOR_PROCESSOR_NAME
+    # Para otros tipos o desconocido, usar ER por defecto (o manejar error)
+    logger.warning(f"No specific extractor for doc_type {doc_type}, using ER extractor")
+    return ER_EXTRACTOR_PROCESSOR_NAME
+
+
+def _parse_extraction(document: Optional[documentai.Document], processor_name: str,
+                      doc_type: str = "") -> Dict[str, Any]:
+    """Convierte la respuesta del Extractor en campos con trazabilidad (page_refs + bounding boxes).
+
+    Para ESTADO_RESULTADOS / ESTADO_SITUACION_FINANCIERA agrega fields["statement_table"]
+    con la tabla reconstruida y sus cruces de totales.
+    """
+    if not document:
+        return _generate_fallback_extraction()
+    
+    fields = {}
+    line_items = []
+    
+    for entity in document.entities:
+        text_value = entity.mention_text if hasattr(entity, 'mention_text') else ""
+        confidence = entity.confidence if hasattr(entity, 'confidence') else 0.0
+        
+        # Extraer page_refs y bounding boxes
+        page_refs = []
+        if hasattr(entity, 'page_anchor') and entity.page_anchor:
+            for page_ref in entity.page_anchor.page_refs:
+                page_info = {"page": page_ref.page if hasattr(page_ref, 'page') else 0}
+                if hasattr(page_ref, 'bounding_poly') and page_ref.bounding_poly:
+                    vertices = [{"x": v.x, "y": v.y} for v in page_ref.bounding_poly.normalized_vertices]
+                    page_info["bounding_box"] = vertices
+                page_refs.append(page_info)
+        
+        field_data = {
+            "value": text_value,
+            "confidence": round(confidence, 3),
+            "page_refs": page_refs,
+        }
+        
+        # Organizar por tipo de entidad
+        entity_type = entity.type_
+        if entity_type in ["LINE_ITEM_NAME", "LINE_ITEM_VALUE", "COLUMN_YEAR",
+                          "SECTION_HEADER", "TOTAL_LABEL"]:
+            line_items.append({"type": entity_type, **field_data})
+        else:
+            fields[entity_type] = field_data
+    
+    if line_items:
+        fields["line_items"] = line_items
+        if doc_type in STATEMENT_TABLE_DOC_TYPES:
+            try:
+                table = _build_statement_table(line_items, doc_type)
+            except Exception as e:
+                logger.warning(f"Statement table reconstruction failed: {e}")
+                table = None
+            if table:
+                fields["statement_table"] = table
+    
+    return {
+        "fields": fields,
+        "metadata": {
+            "page_count": len(document.pages) if hasattr(document, 'pages') else 0,
+            "processor_version": processor_name,
+            "extraction_schema_version": "v1.0",
+        }
+    }
+
+
+class _PageChunk(NamedTuple):
+    """Rango de páginas a extraer en una llamada.
+
+    pages son las páginas originales (1-based, ordenadas). content es un PDF con solo esas
+    páginas cuando se pudo partir en memoria (selector None), o el PDF completo con
+    individual_page_selector cuando no.
+    """
+    pages: List[int]
+    content: bytes
+    selector: Optional[List[int]]
+
+
+def _pdf_reader(content: bytes) -> Optional[Any]:
+    """PdfReader de pypdf sobre el contenido; None si pypdf no está o el PDF no se puede leer."""
+    pypdf = _optional_module("pypdf")
+    if pypdf is None:
+        return None
+    try:
+        reader = pypdf.PdfReader(io.BytesIO(content))
+        len(reader.pages)
+        return reader
+    except Exception as e:
+        logger.warning(f"Could not parse PDF page tree, extracting without splitting: {e}")
+        return None
+
+
+def _split_pdf(reader: Any, pages: List[int]) -> bytes:
+    """PDF nuevo con solo esas páginas (1-based) del original."""
+    writer = _optional_module("pypdf").PdfWriter()
+    for page in pages:
+        writer.add_page(reader.pages[page - 1])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def _plan_page_chunks(content: bytes, pages: Optional[List[int]], page_count: int) -> Optional[List[_PageChunk]]:
+    """Rangos de páginas (1-based) a procesar en llamadas separadas.
+
+    None = una sola llamada con el documento completo. pages restringe a las páginas
+    del estado (ruteo del Classifier); sin pages se parte el documento completo si
+    supera EXTRACTION_CHUNK_PAGES. Las páginas se cuentan con el árbol de páginas del
+    PDF (pypdf) y cada rango se envía como un PDF propio. Si el PDF no se puede leer,
+    solo se parte con el page_count del Classifier y individual_page_selector.
+    """
+    if not pages and 0 < page_count <= EXTRACTION_CHUNK_PAGES:
+        return None
+    reader = _pdf_reader(content)
+    known_pages = len(reader.pages) if reader is not None else page_count
+    if pages:
+        pages = sorted({page for page in pages if page >= 1 and (not known_pages or page <= known_pages)})
+        if not pages:
+            return None
+    else:
+        if known_pages <= EXTRACTION_CHUNK_PAGES:
+            return None
+        pages = list(range(1, known_pages + 1))
+    ranges = [pages[i:i + EXTRACTION_CHUNK_PAGES] for i in range(0, len(pages), EXTRACTION_CHUNK_PAGES)]
+    if reader is None:
+        return [_PageChunk(chunk, content, chunk) for chunk in ranges]
+    try:
+        return [_PageChunk(chunk, _split_pdf(reader, chunk), None) for chunk in ranges]
+    except Exception as e:
+        logger.warning(f"Could not split PDF, using page selectors on the full document: {e}")
+        return [_PageChunk(chunk, content, chunk) for chunk in ranges]
+
+
+def _merge_page_chunks(chunks: List[_PageChunk],
+                       documents: List[Optional[documentai.Document]]) -> Tuple[Optional[documentai.Document], List[int]]:
+    """Une las respuestas por rango de páginas en un solo Document.
+
+    La respuesta de cada rango solo contiene sus páginas, en orden, y los page_refs
+    indexan esa lista; se reescriben al índice de página original (0-based). Los rangos
+    que fallaron no descartan a los demás: sus páginas se retornan como faltantes.
+
+    Returns:
+        (Document con los rangos exitosos o None si fallaron todos, páginas faltantes)
+    """
+    merged = documentai.Document()
+    missing: List[int] = []
+    for chunk, document in zip(chunks, documents):
+        if document is None:
+            missing.extend(chunk.pages)
+            continue
+        original = [
+            (chunk.pages[i] if i < len(chunk.pages) else i + 1) - 1
+            for i in range(len(document.pages))
+        ]
+        for entity in document.entities:
+            for page_ref in entity.page_anchor.page_refs:
+                if page_ref.page < len(original):
+                    page_ref.page = original[page_ref.page]
+            merged.entities.append(entity)
+        for i, page in enumerate(document.pages):
+            if i < len(original):
+                page.page_number = original[i] + 1
+        merged.pages.extend(document.pages)
+    if len(missing) == sum(len(chunk.pages) for chunk in chunks):
+        return None, missing
+    return merged, missing
+
+
+def _process_document_pages(processor_name: str, content: bytes,
+                            chunks: Optional[List[_PageChunk]]) -> Tuple[Optional[documentai.Document], List[int]]:
+    """Procesa el documento completo o sus rangos de páginas en paralelo y los une."""
+    if chunks is None:
+        return _process_document_ai_with_retry(processor_name, content, field_mask=EXTRACTOR_FIELD_MASK), []
+    if len(chunks) == 1:
+        return _merge_page_chunks(chunks, [
+            _process_document_ai_with_retry(processor_name, chunks[0].content, chunks[0].selector, EXTRACTOR_FIELD_MASK)
+        ])
+    with ThreadPoolExecutor(max_workers=min(len(chunks), EXTRACTION_CHUNK_CONCURRENCY)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, _process_document_ai_with_retry,
+                            processor_name, chunk.content, chunk.selector, EXTRACTOR_FIELD_MASK)
+            for chunk in chunks
+        ]
+        documents = [future.result() for future in futures]
+    return _merge_page_chunks(chunks, documents)
+
+
+async def _process_document_pages_async(processor_name: str, content: bytes,
+                                        chunks: Optional[List[_PageChunk]]) -> Tuple[Optional[documentai.Document], List[int]]:
+    """Equivalente async de _process_document_pages."""
+    if chunks is None:
+        document = await _process_document_ai_with_retry_async(processor_name, content, field_mask=EXTRACTOR_FIELD_MASK)
+        return document, []
+    semaphore = asyncio.Semaphore(EXTRACTION_CHUNK_CONCURRENCY)
+    
+    async def _bounded(chunk: _PageChunk) -> Optional[documentai.Document]:
+        async with semaphore:
+            return await _process_document_ai_with_retry_async(processor_name, chunk.content, chunk.selector,
+                                                               EXTRACTOR_FIELD_MASK)
+    
+    documents = await asyncio.gather(*(_bounded(chunk) for chunk in chunks))
+    return _merge_page_chunks(chunks, list(documents))
+
+
+def _extraction_plan(doc_type: str, classification: Optional[Dict[str, Any]]) -> List[Tuple[str, Optional[List[int]]]]:
+    """Estados a extraer con sus páginas (1-based); el tipo principal va primero.
+
+    Sin page_map del Classifier se extrae el documento completo con el Extractor del tipo.
+    En un PDF multi-estado cada Extractor recibe solo las páginas de su estado.
+    """
+    page_map = (classification or {}).get("page_map") or {}
+    plan: List[Tuple[str, Optional[List[int]]]] = [(doc_type, page_map.get(doc_type))]
+    for other_type, pages in page_map.items():
+        if other_type != doc_type and other_type in EXTRACTOR_DOC_TYPES:
+            plan.append((other_type, pages))
+    return plan
+
+
+def _extraction_cache_stage(pages: Optional[List[int]]) -> str:
+    return "extraction" if not pages else "extraction:" + ",".join(map(str, pages))
+
+
+def _attach_statements(extraction: Dict[str, Any], statements: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Agrega los campos de los otros estados del PDF en fields["statements"][doc_type].
+
+    Los errores de extracción de los otros estados se suman a los del principal.
+    """
+    for other in statements.values():
+        for error in other.get("metadata", {}).get("extraction_errors", []):
+            extraction.setdefault("metadata", {}).setdefault("extraction_errors", []).append(error)
+    statements = {t: e["fields"] for t, e in statements.items() if e.get("fields")}
+    if statements:
+        extraction.setdefault("fields", {})["statements"] = statements
+    return extraction
+
+
+def _mark_extraction_failed(extraction: Dict[str, Any], doc_type: str, reason: str,
+                            missing_pages: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Registra en metadata.extraction_errors que la extracción de un estado falló o quedó parcial.
+
+    _persist_document_result guarda los campos obtenidos pero deja el documento en ERROR.
+    """
+    extraction.setdefault("metadata", {}).setdefault("extraction_errors", []).append({
+        "doc_type": doc_type,
+        "reason": reason,
+        "missing_pages": list(missing_pages or []),
+    })
+    return extraction
+
+
+def _checked_extraction(document: Optional[documentai.Document], missing_pages: List[int],
+                        extraction: Dict[str, Any], doc_type: str) -> Dict[str, Any]:
+    if document is None:
+        return _mark_extraction_failed(extraction, doc_type, "Document AI returned no result", missing_pages)
+    if missing_pages:
+        return _mark_extraction_failed(extraction, doc_type, "Document AI failed on some page ranges", missing_pages)
+    return extraction
+
+
+def _extract_statement(gcs_uri: str, doc_type: str, content: bytes, pages: Optional[List[int]],
+                       page_count: int) -> Dict[str, Any]:
+    processor_name_env = _select_extractor(doc_type)
+    if not processor_name_env:
+        return _generate_fallback_extraction()
+    
+    processor_name = _processor_path(processor_name_env)
+    stage = _extraction_cache_stage(pages)
+    cached = _result_cache_get(stage, processor_name, content)
+    if cached is not None:
+        return cached
+    
+    document, missing = _process_document_pages(processor_name, content, _plan_page_chunks(content, pages, page_count))
+    extraction = _parse_extraction(document, processor_name, doc_type)
+    if document is None or missing:
+        return _checked_extraction(document, missing, extraction, doc_type)
+    _result_cache_put(stage, processor_name, content, extraction, gcs_uri)
+    return extraction
+
+
+async def _extract_statement_async(gcs_uri: str, doc_type: str, content: bytes, pages: Optional[List[int]],
+                                   page_count: int) -> Dict[str, Any]:
+    processor_name_env = _select_extractor(doc_type)
+    if not processor_name_env:
+        return _generate_fallback_extraction()
+    
+    processor_name = _processor_path(processor_name_env)
+    stage = _extraction_cache_stage(pages)
+    cached = await asyncio.to_thread(_result_cache_get, stage, processor_name, content)
+    if cached is not None:
+        return cached
+    
+    # Contar y partir el PDF es CPU: fuera del event loop
+    chunks = await asyncio.to_thread(_plan_page_chunks, content, pages, page_count)
+    document, missing = await _process_document_pages_async(processor_name, content, chunks)
+    extraction = _parse_extraction(document, processor_name, doc_type)
+    if document is None or missing:
+        return _checked_extraction(document, missing, extraction, doc_type)
+    await asyncio.to_thread(_result_cache_put, stage, processor_name, content, extraction, gcs_uri)
+    return extraction
+
+
+def extract_document_data(gcs_uri: str, doc_type: str, content: bytes,
+                          classification: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Extrae datos estructurados con Document AI Extractor con trazabilidad completa.
+
+    PDFs grandes se procesan por rangos de páginas en paralelo; si la clasificación trae
+    page_map, cada estado se extrae solo de sus páginas. Si Document AI falla (completo o
+    en algún rango) la extracción lleva metadata.extraction_errors y no se cachea.
+    """
+    try:
+        page_count = (classification or {}).get("page_count", 0)
+        plan = _extraction_plan(doc_type, classification)
+        extraction = _extract_statement(gcs_uri, doc_type, content, plan[0][1], page_count)
+        others = {t: _extract_statement(gcs_uri, t, content, pages, page_count) for t, pages in plan[1:]}
+        return _attach_statements(extraction, others)
+    except Exception as e:
+        logger.error(f"Extraction error: {e}")
+        return _mark_extraction_failed(_generate_fallback_extraction(), doc_type, str(e))
+
+
+async def extract_document_data_async(gcs_uri: str, doc_type: str, content: bytes,
+                                      classification: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Equivalente async de extract_document_data."""
+    try:
+        page_count = (classification or {}).get("page_count", 0)
+        plan = _extraction_plan(doc_type, classification)
+        results = await asyncio.gather(*(
+            _extract_statement_async(gcs_uri, t, content, pages, page_count) for t, pages in plan
+        ))
+        return _attach_statements(results[0], dict(zip((t for t, _ in plan[1:]), results[1:])))
+    except Exception as e:
+        logger.error(f"Extraction error: {e}")
+        return _mark_extraction_failed(_generate_fallback_extraction(), doc_type, str(e))
+
+
+def _should_use_batch_mode(doc_count: int, total_bytes: int) -> bool:
+    """Decide el modo batch por número de documentos o tamaño total del folio."""
+    if not BATCH_OUTPUT_URI or not doc_count:
+        return False
+    if BATCH_MODE_MIN_DOCS and doc_count >= BATCH_MODE_MIN_DOCS:
+        return True
+    return bool(BATCH_MODE_MIN_TOTAL_BYTES and total_bytes >= BATCH_MODE_MIN_TOTAL_BYTES)
+
+
+def _merge_document_shards(shards: List[documentai.Document]) -> documentai.Document:
+    """Une los shards de salida de un documento, corrigiendo los índices de página.
+
+    Cada shard numera sus page_refs relativos a sus propias páginas; se desplazan por
+    el número de páginas de los shards anteriores (ordenados por shard_index).
+    """
+    if len(shards) == 1:
+        return shards[0]
+    merged = documentai.Document()
+    page_offset = 0
+    for shard in sorted(shards, key=lambda d: d.shard_info.shard_index):
+        for entity in shard.entities:
+            for page_ref in entity.page_anchor.page_refs:
+                page_ref.page = page_ref.page + page_offset
+            merged.entities.append(entity)
+        merged.pages.extend(shard.pages)
+        page_offset += len(shard.pages)
+    return merged
+
+
+def _read_batch_output(storage_client: storage.Client, output_gcs_uri: str) -> Optional[documentai.Document]:
+    """Lee y une los shards JSON que Document AI escribió para un documento."""
+    bucket_name, prefix = output_gcs_uri.replace("gs://", "").split("/", 1)
+    bucket = storage_client.bucket(bucket_name)
+    shards = []
+    for blob in bucket.list_blobs(prefix=prefix.rstrip("/") + "/"):
+        if blob.name.endswith(".json"):
+            shards.append(documentai.Document.from_json(blob.download_as_bytes(), ignore_unknown_fields=True))
+    return _merge_document_shards(shards) if shards else None
+
+
+def _batch_timeout(processor_name: str, operations: List[Any]) -> AppError:
+    """Cancela las operaciones que siguen en curso y arma el error BATCH_TIMEOUT."""
+    for operation in operations:
+        try:
+            if not operation.done():
+                operation.cancel()
+        except Exception as e:
+            logger.warning(f"Could not cancel batch operation: {e}")
+    return AppError(
+        code="BATCH_TIMEOUT",
+        message=f"Batch processing did not finish within {BATCH_MODE_DEADLINE_SECONDS:g}s",
+        stage="BATCH_PROCESS",
+        details={"processor": processor_name, "operations": len(operations)}
+    )
+
+
+def _run_batch_process(processor_name: str, gcs_uris: List[str], output_prefix: str,
+                       deadline: float) -> Dict[str, Optional[documentai.Document]]:
+    """Ejecuta batch_process_documents sobre una lista de PDFs y recolecta sus resultados.
+
+    Envía todas las operaciones (en trozos de BATCH_MODE_MAX_DOCS_PER_REQUEST), sondea
+    las LRO y lee la salida desde GCS. deadline (time.monotonic) es el plazo compartido
+    por todo el flujo batch del folio: al vencer se cancelan las operaciones pendientes
+    y se lanza AppError BATCH_TIMEOUT.
+    
+    Returns:
+        {gcs_uri: Document | None si el documento falló}
+    """
+    results: Dict[str, Optional[documentai.Document]] = {uri: None for uri in gcs_uris}
+    if not PROJECT_ID or not processor_name or not gcs_uris:
+        return results
+    if time.monotonic() >= deadline:
+        raise _batch_timeout(processor_name, [])
+    
+    client = _get_documentai_client()
+    operations = []
+    for i in range(0, len(gcs_uris), BATCH_MODE_MAX_DOCS_PER_REQUEST):
+        chunk = gcs_uris[i:i + BATCH_MODE_MAX_DOCS_PER_REQUEST]
+        request = documentai.BatchProcessRequest(
+            name=processor_name,
+            input_documents=documentai.BatchDocumentsInputConfig(
+                gcs_documents=documentai.GcsDocuments(documents=[
+                    documentai.GcsDocument(gcs_uri=uri, mime_type="application/pdf") for uri in chunk
+                ])
+            ),
+            document_output_config=documentai.DocumentOutputConfig(
+                gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(
+                    gcs_uri=f"{output_prefix}/{i // BATCH_MODE_MAX_DOCS_PER_REQUEST}/"
+                )
+            ),
+        )
+        operations.append(client.batch_process_documents(request=request))
+    
+    storage_client = _get_storage_client()
+    for operation in operations:
+        while not operation.done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise _batch_timeout(processor_name, operations)
+            time.sleep(min(BATCH_MODE_POLL_INTERVAL, remaining))
+        
+        if operation.exception():
+            logger.error(f"Batch operation failed: {operation.exception()}")
+        
+        # metadata ya viene deserializado como BatchProcessMetadata
+        for status in operation.metadata.individual_process_statuses:
+            if status.status.code != 0:
+                logger.warning(f"Batch document failed: {status.input_gcs_source} - {status.status.message}")
+                continue
+            try:
+                results[status.input_gcs_source] = _read_batch_output(storage_client, status.output_gcs_destination)
+            except Exception as e:
+                logger.error(f"Error reading batch output for {status.input_gcs_source}: {e}")
+    
+    return results
+
+
+def _generate_fallback_extraction() -> Dict[str, Any]:
+    """Genera extracción mínima cuando Document AI no está disponible."""
+    return {
+        "fields": {},
+        "metadata": {
+            "page_count": 0,
+            "processor_version": "fallback",
+            "extraction_schema_version": "v1.0",
+        }
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FIRESTORE PERSISTENCE: Esquema jerárquico según spec
+# folios/{folioId}/documentos/{docId}/extracciones/{extractionId}
+# ═══════════════════════════════════════════════════════════════════════════════
+class _FirestoreWriteBatcher:
+    """Agrupa las escrituras por documento de un folio en WriteBatch.
+
+    - Las escrituras de documentos y extracciones se encolan y se confirman juntas
+      cuando se alcanza FIRESTORE_BATCH_MAX_WRITES / FIRESTORE_BATCH_MAX_BYTES o
+      pasan FIRESTORE_FLUSH_INTERVAL segundos desde el último commit.
+    - Los incrementos de processed_docs se acumulan y se aplican como un único
+      Increment(n) por commit, evitando el hot-spot sobre el documento del folio.
+    - Los commits se serializan para preservar el orden de escrituras sobre un mismo doc.
+    """
+
+    def __init__(self, db: _AnyFirestoreClient, folio_id: str,
+                 previous_extractions: Optional[Dict[str, Dict[str, Any]]] = None,
+                 track_processed: bool = True):
+        self._db = db
+        self._folio_ref = db.collection("folios").document(folio_id)
+        # file_id -> extracción vigente de la generation anterior (dedupe y deltas al persistir)
+        self.previous_extractions = previous_extractions or {}
+        # False: no se escribe processed_docs en el folio (work items del modo fanout)
+        self._track_processed = track_processed
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._ops: List[Tuple[Any, Dict[str, Any], bool]] = []
+        self._ops_bytes = 0
+        self._pending_processed = 0
+        self._last_flush = time.monotonic()
+
+    def set(self, ref: Any, data: Dict[str, Any], merge: bool = False) -> None:
+        """Encola un set() y confirma el lote si alcanzó algún umbral."""
+        size = len(json.dumps(data, default=str))
+        with self._lock:
+            self._ops.append((ref, data, merge))
+            self._ops_bytes += size
+        self._maybe_flush()
+
+    def increment_processed(self, count: int = 1) -> None:
+        if not self._track_processed:
+            return
+        with self._lock:
+            self._pending_processed += count
+        self._maybe_flush()
+
+    def _is_due(self) -> bool:
+        with self._lock:
+            return (
+                len(self._ops) >= FIRESTORE_BATCH_MAX_WRITES
+                or self._ops_bytes >= FIRESTORE_BATCH_MAX_BYTES
+                or time.monotonic() - self._last_flush >= FIRESTORE_FLUSH_INTERVAL
+            )
+
+    def _maybe_flush(self) -> None:
+        if self._is_due():
+            try:
+                self.flush()
+            except Exception as e:
+                # Las escrituras quedan encoladas para el siguiente flush
+                logger.error(f"Error flushing Firestore batch: {e}")
+
+    def _take_pending(self, folio_updates: Optional[Dict[str, Any]]) -> Tuple[List[Tuple[Any, Dict[str, Any], bool]], int, int, Dict[str, Any]]:
+        with self._lock:
+            ops, self._ops = self._ops, []
+            ops_bytes, self._ops_bytes = self._ops_bytes, 0
+            processed, self._pending_processed = self._pending_processed, 0
+            self._last_flush = time.monotonic()
+        
+        folio_data: Dict[str, Any] = {}
+        if processed:
+            folio_data["processed_docs"] = firestore.Increment(processed)
+            folio_data["last_update_at"] = firestore.SERVER_TIMESTAMP
+        if folio_updates:
+            folio_data.update(folio_updates)
+        return ops, ops_bytes, processed, folio_data
+
+    def _requeue(self, ops: List[Tuple[Any, Dict[str, Any], bool]], ops_bytes: int, processed: int) -> None:
+        with self._lock:
+            self._ops = ops + self._ops
+            self._ops_bytes += ops_bytes
+            self._pending_processed += processed
+
+    def _build_batches(self, ops: List[Tuple[Any, Dict[str, Any], bool]],
+                       folio_data: Dict[str, Any]) -> List[Tuple[Any, int]]:
+        """Trocea las escrituras en WriteBatch; el update del folio va en el último lote."""
+        batches = []
+        for i in range(0, len(ops), FIRESTORE_BATCH_MAX_WRITES):
+            chunk = ops[i:i + FIRESTORE_BATCH_MAX_WRITES]
+            batch = self._db.batch()
+            for ref, data, merge in chunk:
+                batch.set(ref, data, merge=merge)
+            batches.append((batch, len(chunk)))
+        if folio_data:
+            if not batches or batches[-1][1] >= 500:
+                batches.append((self._db.batch(), 0))
+            batches[-1][0].update(self._folio_ref, folio_data)
+        return batches
+
+    def flush(self, folio_updates: Optional[Dict[str, Any]] = None) -> None:
+        """Confirma todas las escrituras pendientes.
+
+        folio_updates se aplica en el mismo commit que el último lote, de modo que
+        el estado final del folio nunca se escribe antes que sus documentos.
+        Lanza la excepción del commit si falla; las escrituras se re-encolan.
+        """
+        with self._commit_lock:
+            ops, ops_bytes, processed, folio_data = self._take_pending(folio_updates)
+            try:
+                for batch, size in self._build_batches(ops, folio_data):
+                    batch.commit()
+                    ops = ops[size:]
+            except Exception:
+                self._requeue(ops, ops_bytes, processed)
+                raise
+
+
+class _AsyncFirestoreWriteBatcher(_FirestoreWriteBatcher):
+    """Variante del writer para el modo asyncio, sobre firestore.AsyncClient.
+
+    Encolar sigue siendo síncrono (sin I/O); los commits se hacen con await desde
+    el event loop mediante maybe_aflush()/aflush().
+    """
+
+    def __init__(self, db: firestore.AsyncClient, folio_id: str,
+                 previous_extractions: Optional[Dict[str, Dict[str, Any]]] = None):
+        super().__init__(db, folio_id, previous_extractions)
+        self._async_commit_lock = asyncio.Lock()
+
+    def _maybe_flush(self) -> None:
+        # El flush se dispara explícitamente desde las corutinas (maybe_aflush)
+        pass
+
+    async def maybe_aflush(self) -> None:
+        if self._is_due():
+            try:
+                await self.aflush()
+            except Exception as e:
+                logger.error(f"Error flushing Firestore batch: {e}")
+
+    async def aflush(self, folio_updates: Optional[Dict[str, Any]] = None) -> None:
+        async with self._async_commit_lock:
+            ops, ops_bytes, processed, folio_data = self._take_pending(folio_updates)
+            try:
+                for batch, size in self._build_batches(ops, folio_data):
+                    await batch.commit()
+                    ops = ops[size:]
+            except Exception:
+                self._requeue(ops, ops_bytes, processed)
+                raise
+
+
+def _is_newer_sentinel(generation: str, stored_generation: Optional[str]) -> bool:
+    """True si la generation del is_ready es posterior a la que procesó el folio.
+
+    Un folio sin sentinel_generation (anterior al modo incremental) acepta cualquiera.
+    """
+    if not generation:
+        return False
+    if not stored_generation:
+        return True
+    try:
+        return int(generation) > int(stored_generation)
+    except ValueError:
+        return generation != stored_generation
+
+
+def _ensure_folio_document(db: firestore.Client, folio_id: str, bucket: str, folder_prefix: str,
+                           sentinel_generation: str = "") -> Optional[str]:
+    """Crea o actualiza documento de folio en Firestore.
+
+    Un folio terminado se re-abre en modo incremental cuando llega un is_ready con una
+    generation posterior (el broker reemplazó o agregó PDFs); la re-entrega del mismo
+    evento se sigue ignorando.
+    
+    Returns:
+        "full" | "incremental" si debe procesar, None si ya está completo.
+    """
+    try:
+        folio_ref = db.collection("folios").document(folio_id)
+        folio_doc = folio_ref.get()
+        
+        if not folio_doc.exists:
+            folio_ref.set({
+                "bucket": bucket,
+                "folder_prefix": folder_prefix,
+                "status": "PROCESSING",
+                "run_mode": "full",
+                "sentinel_generation": sentinel_generation,
                 "total_docs": 0,
                 "processed_docs": 0,
                 "created_at": firestore.SERVER_TIMESTAMP,
                 "started_at": firestore.SERVER_TIMESTAMP,
             })
-            return True
+            return "full"
+        else:
+            data = folio_doc.to_dict()
+            status = data.get("status")
+            if status in ["DONE", "DONE_WITH_ERRORS"]:
+                if INCREMENTAL_REPROCESS_ENABLED and _is_newer_sentinel(sentinel_generation, data.get("sentinel_generation")):
+                    logger.info(f"Folio {folio_id} re-opened for incremental processing (is_ready generation {sentinel_generation})")
+                    folio_ref.update({
+                        "status": "PROCESSING",
+                        "run_mode": "incremental",
+                        "sentinel_generation": sentinel_generation,
+                        "started_at": firestore.SERVER_TIMESTAMP,
+                        "last_update_at": firestore.SERVER_TIMESTAMP,
+                    })
+                    return "incremental"
+                logger.info(f"Folio {folio_id} already completed with status {status}, ignoring re-processing")
+                return None
+            if status == "PROCESSING":
+                # Re-entrega o entrega duplicada: se reanudan solo los documentos sin terminar
+                # o con lease vencido; started_at conserva el inicio original
+                logger.info(f"Resuming folio {folio_id}")
+                folio_ref.update({
+                    "resumed_at": firestore.SERVER_TIMESTAMP,
+                    "last_update_at": firestore.SERVER_TIMESTAMP,
+                })
+                return data.get("run_mode") or "full"
+            # ERROR: re-procesar
+            folio_ref.update({
+                "status": "PROCESSING",
+                "run_mode": "full",
+                "sentinel_generation": sentinel_generation,
+                "started_at": firestore.SERVER_TIMESTAMP,
+                "last_update_at": firestore.SERVER_TIMESTAMP,
+            })
+            return "full"
+    except Exception as e:
+        logger.error(f"Error creating folio document: {e}")
+        return "full"  # Por defecto, procesar
+
+
+_LEASE_OWNER: contextvars.ContextVar[str] = contextvars.ContextVar("apolo_lease_owner", default=INSTANCE_ID)
+
+
+def _lease_is_live(data: Dict[str, Any], owner: str) -> bool:
+    """True si el documento está IN_PROGRESS con un lease vigente de otra entrega."""
+    expires_at = data.get("lease_expires_at")
+    return (
+        data.get("status") == "IN_PROGRESS"
+        and data.get("lease_owner") not in (None, owner)
+        and isinstance(expires_at, datetime)
+        and expires_at > datetime.now(timezone.utc)
+    )
+
+
+def _acquire_document_lease(db: firestore.Client, folio_id: str, doc_id: str, doc_fields: Dict[str, Any],
+                            lease_seconds: int = DOCUMENT_LEASE_SECONDS) -> Tuple[str, Dict[str, Any]]:
+    """Toma el lease de un documento en una transacción y lo marca IN_PROGRESS.
+
+    Un lease vencido (instancia caída o timeout) se puede volver a tomar; uno vigente
+    de otra entrega no. La misma lectura sirve como chequeo de idempotencia.
+    
+    Returns:
+        ("ACQUIRED" | "DONE" | "LEASED", datos previos del documento)
+    """
+    doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
+    owner = _LEASE_OWNER.get()
+    
+    @firestore.transactional
+    def _claim(transaction: Any) -> Tuple[str, Dict[str, Any]]:
+        snap = doc_ref.get(transaction=transaction)
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        if data.get("status") == "DONE":
+            return "DONE", data
+        if _lease_is_live(data, owner):
+            return "LEASED", data
+        transaction.set(doc_ref, {
+            **doc_fields,
+            "status": "IN_PROGRESS",
+            "lease_owner": owner,
+            "lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=lease_seconds),
+            "lease_attempts": firestore.Increment(1),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        return "ACQUIRED", data
+    
+    return _claim(db.transaction())
+
+
+def _renew_document_lease(db: firestore.Client, folio_id: str, doc_id: str) -> bool:
+    """Extiende el lease propio. False si venció y otra entrega ya lo tomó."""
+    doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
+    owner = _LEASE_OWNER.get()
+    
+    @firestore.transactional
+    def _extend(transaction: Any) -> bool:
+        snap = doc_ref.get(transaction=transaction)
+        # La entrega que terminó el documento borra lease_owner (DELETE_FIELD)
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        if data.get("lease_owner") != owner:
+            return False
+        transaction.update(doc_ref, {
+            "lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=DOCUMENT_LEASE_SECONDS),
+        })
+        return True
+    
+    return _extend(db.transaction())
+
+
+def _keep_document_lease(db: firestore.Client, folio_id: str, doc_id: str, acquired_at: float) -> float:
+    """Renueva el lease si ya consumió la mitad de su duración (entre etapas de Document AI).
+
+    Retorna el instante monotónico de la última renovación; lanza AppError LEASE_LOST si
+    otra entrega tomó el documento, para no pagar Document AI dos veces.
+    """
+    if time.monotonic() - acquired_at < DOCUMENT_LEASE_SECONDS / 2:
+        return acquired_at
+    if not _renew_document_lease(db, folio_id, doc_id):
+        raise AppError(
+            code="LEASE_LOST",
+            message="Document lease expired and was taken by another delivery",
+            stage="LEASE",
+            details={"doc_id": doc_id}
+        )
+    return time.monotonic()
+
+
+def _document_lease_lost(db: firestore.Client, folio_id: str, doc_id: str) -> bool:
+    """True si el lease de esta entrega ya no está vigente (otra entrega lo tomó o terminó el documento).
+
+    Se consulta antes de persistir un ERROR, para no escribirlo sobre el resultado de otra entrega.
+    """
+    doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
+    try:
+        snap = doc_ref.get()
+    except Exception as e:
+        logger.warning(f"Could not verify lease for {doc_id}: {e}")
+        return False
+    data = (snap.to_dict() or {}) if snap.exists else {}
+    return data.get("lease_owner") != _LEASE_OWNER.get()
+
+
+def _leased_result(file_name: str, gcs_uri: str, generation: str,
+                   object_metadata: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    """Resultado de un documento que procesa otra entrega; el folio espera a que termine."""
+    return {
+        "file_name": file_name,
+        "gcs_uri": gcs_uri,
+        "status": "LEASED",
+        "pdf": PdfObject(file_name, generation, 0, object_metadata),
+    }
+
+
+def _precheck_processed_documents(db: firestore.Client, folio_id: str, documents: List[PdfObject],
+                                  bucket_name: str) -> Tuple[List[PdfObject], List[Dict[str, Any]]]:
+    """Pre-chequeo de idempotencia en bloque para todo el folio.
+
+    Calcula el doc_id de cada PDF y lee todos los snapshots con db.get_all (en trozos de
+    FIRESTORE_GET_ALL_CHUNK), de modo que un re-envío del evento no haga una lectura
+    por documento dentro de los workers.
+    
+    Los documentos con lease vigente de otra entrega no se re-procesan: se devuelven como
+    resultados LEASED para que el folio espere a que terminen.
+    
+    Returns:
+        (pending_documents, cached_results)
+    """
+    documentos = db.collection("folios").document(folio_id).collection("documentos")
+    refs_by_doc: Dict[str, PdfObject] = {}
+    refs = []
+    for pdf in documents:
+        doc_id = _make_doc_id(folio_id, pdf.name.split("/")[-1], pdf.generation)
+        refs_by_doc[doc_id] = pdf
+        refs.append(documentos.document(doc_id))
+    
+    done: Dict[str, Dict[str, Any]] = {}
+    leased: Set[str] = set()
+    owner = _LEASE_OWNER.get()
+    try:
+        for i in range(0, len(refs), FIRESTORE_GET_ALL_CHUNK):
+            chunk = refs[i:i + FIRESTORE_GET_ALL_CHUNK]
+            for snap in db.get_all(chunk, field_paths=["status", "doc_type", "lease_owner", "lease_expires_at"]):
+                if snap.exists:
+                    data = snap.to_dict() or {}
+                    if data.get("status") == "DONE":
+                        done[snap.id] = data
+                    elif _lease_is_live(data, owner):
+                        leased.add(snap.id)
+    except Exception as e:
+        # Sin pre-chequeo se procesa todo; la escritura es idempotente por doc_id
+        logger.error(f"Error prechecking documents: {e}")
+        return list(documents), []
+    
+    pending = []
+    cached_results = []
+    for doc_id, pdf in refs_by_doc.items():
+        if doc_id in done:
+            cached_results.append({
+                "file_name": pdf.name,
+                "gcs_uri": f"gs://{bucket_name}/{pdf.name}",
+                "status": "DONE",
+                "from_cache": True,
+                "doc_type": done[doc_id].get("doc_type", "UNKNOWN"),
+            })
+        elif doc_id in leased:
+            cached_results.append(_leased_result(pdf.name, f"gs://{bucket_name}/{pdf.name}", pdf.generation, pdf.metadata))
+        else:
+            pending.append(pdf)
+    
+    return pending, cached_results
+
+
+def _load_folio_documents(db: firestore.Client, folio_id: str) -> Dict[str, Dict[str, Any]]:
+    """Lee los documentos ya registrados del folio (solo los campos del diff incremental).
+
+    Returns:
+        {doc_id: {status, file_id, generation, doc_type, completion_status,
+                  latest_extraction, extraction_fingerprint}}
+    """
+    documentos = db.collection("folios").document(folio_id).collection("documentos")
+    query = documentos.select([
+        "status", "file_id", "generation", "doc_type", "completion_status",
+        "latest_extraction", "extraction_fingerprint",
+    ])
+    return {snap.id: snap.to_dict() or {} for snap in query.stream()}
+
+
+def _split_unchanged_documents(folio_id: str, documents: List[PdfObject], known: Dict[str, Dict[str, Any]],
+                               seen: Set[str]) -> Tuple[List[PdfObject], List[Tuple[PdfObject, str]]]:
+    """Separa los PDFs cuya generation ya terminó (DONE o ERROR) en una corrida anterior.
+
+    Registra en seen el doc_id de cada PDF listado para detectar después los reemplazados.
+    
+    Returns:
+        (changed_documents, [(pdf, doc_id) sin cambios])
+    """
+    changed: List[PdfObject] = []
+    unchanged: List[Tuple[PdfObject, str]] = []
+    for pdf in documents:
+        doc_id = _make_doc_id(folio_id, pdf.name.split("/")[-1], pdf.generation)
+        seen.add(doc_id)
+        if known.get(doc_id, {}).get("status") in ("DONE", "ERROR"):
+            unchanged.append((pdf, doc_id))
+        else:
+            changed.append(pdf)
+    return changed, unchanged
+
+
+def _unchanged_result(pdf: PdfObject, bucket_name: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    result = {
+        "file_name": pdf.name,
+        "gcs_uri": f"gs://{bucket_name}/{pdf.name}",
+        "status": data["status"],
+        "from_cache": True,
+        "doc_type": data.get("doc_type", "UNKNOWN"),
+    }
+    if data["status"] == "ERROR":
+        result["error"] = "Unchanged since previous run"
+    return result
+
+
+def _supersede_documents(writer: _FirestoreWriteBatcher, db: firestore.Client, folio_id: str,
+                         known: Dict[str, Dict[str, Any]], seen: Set[str]) -> List[str]:
+    """Marca SUPERSEDED los documentos registrados que ya no están en el listado.
+
+    Cubre las generations reemplazadas y los objetos borrados. Sus extracciones se
+    conservan como historial; processed_docs deja de contarlos.
+    
+    Returns:
+        doc_ids marcados.
+    """
+    documentos = db.collection("folios").document(folio_id).collection("documentos")
+    superseded = []
+    for doc_id, data in known.items():
+        if doc_id in seen or data.get("status") == "SUPERSEDED":
+            continue
+        writer.set(documentos.document(doc_id), {
+            "status": "SUPERSEDED",
+            # Deja de contar para el cierre del modo fanout
+            "completion_status": firestore.DELETE_FIELD,
+            "superseded_at": firestore.SERVER_TIMESTAMP,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        if data.get("status") in ("DONE", "ERROR"):
+            writer.increment_processed(-1)
+        superseded.append(doc_id)
+    if superseded:
+        _json_log({
+            "event_type": "documents_superseded",
+            "folio_id": folio_id,
+            "superseded_docs": len(superseded),
+            "file_ids": sorted({known[doc_id].get("file_id", "") for doc_id in superseded}),
+            "timestamp": _utc_iso(),
+        })
+    return superseded
+
+
+EXTRACTION_COMPACT_SCHEMA_VERSION = "v2.1-compact"
+# Las coordenadas normalizadas (0..1) se guardan como enteros en unidades de 1/BBOX_SCALE
+BBOX_SCALE = 10000
+_NO_BBOX = [-1, -1, -1, -1]
+
+
+def _pack_page_refs(page_refs: List[Dict[str, Any]]) -> Tuple[List[int], List[int]]:
+    """Empaqueta page_refs en (páginas, bboxes) con bbox plano [x_min, y_min, x_max, y_max] por ref.
+
+    Firestore no admite arrays anidados, por eso las cajas van en un único array con
+    paso 4; una ref sin bounding box se marca con -1.
+    """
+    pages: List[int] = []
+    bboxes: List[int] = []
+    for ref in page_refs:
+        pages.append(int(ref.get("page", 0)))
+        vertices = ref.get("bounding_box") or []
+        if vertices:
+            xs = [v.get("x", 0.0) for v in vertices]
+            ys = [v.get("y", 0.0) for v in vertices]
+            bboxes.extend(round(c * BBOX_SCALE) for c in (min(xs), min(ys), max(xs), max(ys)))
         else:
-            data = folio_doc.to_dict()
-            status = data.get("status")
-            if status in ["DONE", "DONE_WITH_ERRORS"]:
-                logger.info(f"Folio {folio_id} already completed with status {status}, ignoring re-processing")
-                return False
-            # Si está PROCESSING o ERROR, re-procesar
-            folio_ref.update({
-                "status": "PROCESSING",
-                "started_at": firestore.SERVER_TIMESTAMP,
-                "last_update_at": firestore.SERVER_TIMESTAMP,
-            })
-            return True
-    except Exception as e:
-        logger.error(f"Error creating folio document: {e}")
-        return True  # Por defecto, procesar
+            bboxes.extend(_NO_BBOX)
+    return pages, bboxes
+
 
+def _compact_extraction(extraction: Dict[str, Any]) -> Dict[str, Any]:
+    """Convierte una extracción v1.0 al formato compacto (EXTRACTION_COMPACT_SCHEMA_VERSION).
 
-def _check_document_processed(db: firestore.Client, folio_id: str, doc_id: str) -> Tuple[bool, Optional[Dict]]:
-    """Verifica si un documento ya fue procesado (idempotencia).
+    - Cada campo: {"value", "confidence", "pages": [...], "bbox": [...]} con bbox entero.
+    - line_items columnar: arrays paralelos type/value/confidence/page y bbox con paso 4
+      con la primera page_ref de cada línea. Las demás (una línea que cruza páginas o
+      columnas) van en ref_line/ref_page/ref_bbox, solo si existen; v2.0-compact las perdía.
+    """
+    fields = extraction.get("fields", {})
+    compact: Dict[str, Any] = {}
+    for name, data in fields.items():
+        if name == "line_items":
+            continue
+        if name == "statements":
+            compact[name] = {t: _compact_extraction({"fields": f})["fields"] for t, f in data.items()}
+            continue
+        if not isinstance(data, dict) or "page_refs" not in data:
+            compact[name] = data
+            continue
+        pages, bboxes = _pack_page_refs(data.get("page_refs") or [])
+        compact[name] = {
+            "value": data.get("value", ""),
+            "confidence": data.get("confidence", 0.0),
+            "pages": pages,
+            "bbox": bboxes,
+        }
     
-    Returns:
-        (already_processed, cached_data)
+    line_items = fields.get("line_items") or []
+    if line_items:
+        columns: Dict[str, List[Any]] = {"type": [], "value": [], "confidence": [], "page": [], "bbox": []}
+        # page_refs después de la primera: índice de la línea, página y bbox con paso 4
+        extra_refs: Dict[str, List[int]] = {"ref_line": [], "ref_page": [], "ref_bbox": []}
+        for index, item in enumerate(line_items):
+            pages, bboxes = _pack_page_refs(item.get("page_refs") or [])
+            columns["type"].append(item.get("type", ""))
+            columns["value"].append(item.get("value", ""))
+            columns["confidence"].append(item.get("confidence", 0.0))
+            columns["page"].append(pages[0] if pages else -1)
+            columns["bbox"].extend(bboxes[:4] or _NO_BBOX)
+            if len(pages) > 1:
+                extra_refs["ref_line"].extend([index] * (len(pages) - 1))
+                extra_refs["ref_page"].extend(pages[1:])
+                extra_refs["ref_bbox"].extend(bboxes[4:])
+        if extra_refs["ref_line"]:
+            columns.update(extra_refs)
+        compact["line_items"] = columns
+    
+    metadata = dict(extraction.get("metadata", {}))
+    metadata["extraction_schema_version"] = EXTRACTION_COMPACT_SCHEMA_VERSION
+    metadata["bbox_scale"] = BBOX_SCALE
+    return {"fields": compact, "metadata": metadata}
+
+
+def _spill_bucket(source_bucket: str) -> Optional[str]:
+    """Bucket de EXTRACTION_SPILL_URI, o None si no está configurado o es el bucket de carga."""
+    bucket_name = EXTRACTION_SPILL_URI.replace("gs://", "").partition("/")[0]
+    if not bucket_name or bucket_name == source_bucket:
+        return None
+    return bucket_name
+
+
+def _spill_extraction_to_gcs(payload: Dict[str, Any], source_bucket: str, folio_id: str, doc_id: str,
+                             extraction_id: str) -> str:
+    """Sube el payload de una extracción como JSON a GCS y retorna su URI.
+
+    Requiere _spill_bucket(source_bucket): cada objeto escrito en el bucket de carga
+    sería un object.finalize más para el trigger de Eventarc.
     """
+    bucket_name = _spill_bucket(source_bucket)
+    if not bucket_name:
+        raise AppError(
+            code="EXTRACTION_SPILL_NOT_CONFIGURED",
+            message=f"EXTRACTION_SPILL_URI must point to a dedicated bucket (got {EXTRACTION_SPILL_URI or 'nothing'})",
+            stage="PERSIST",
+            details={"spill_uri": EXTRACTION_SPILL_URI, "source_bucket": source_bucket}
+        )
+    prefix = EXTRACTION_SPILL_URI.replace("gs://", "").partition("/")[2]
+    blob_name = "/".join(part for part in (prefix, folio_id, doc_id, f"{extraction_id}.json") if part)
     try:
-        doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
-        doc_snap = doc_ref.get()
-        
-        if doc_snap.exists:
-            data = doc_snap.to_dict()
-            if data.get("status") == "DONE":
-                return True, data
-        
-        return False, None
+        blob = _get_storage_client().bucket(bucket_name).blob(blob_name)
+        blob.upload_from_string(json.dumps(payload, ensure_ascii=False, default=str), content_type="application/json")
     except Exception as e:
-        logger.error(f"Error checking document: {e}")
-        return False, None
+        raise AppError(
+            code="EXTRACTION_SPILL_ERROR",
+            message=f"Failed to store extraction payload in GCS: {e}",
+            stage="PERSIST",
+            details={"bucket": bucket_name, "blob": blob_name}
+        )
+    return f"gs://{bucket_name}/{blob_name}"
+
 
+def _extraction_fingerprint(fields: Dict[str, Any]) -> str:
+    """Huella del contenido de una extracción: sha256 del JSON canónico de sus campos.
 
-def _persist_document_result(db: firestore.Client, folio_id: str, doc_id: str, file_id: str, 
-                             gcs_uri: str, generation: str, classification: Dict[str, Any],
-                             extraction: Dict[str, Any], status: str, error: Optional[Dict] = None) -> None:
-    """Persiste resultado de documento con estructura jerárquica completa."""
+    La metadata (versión del processor, conteo de páginas) no entra en la huella.
+    """
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _build_extraction_record(payload: Dict[str, Any], fingerprint: str, gcs_uri: str, folio_id: str,
+                             doc_id: str, extraction_id: str) -> Dict[str, Any]:
+    """Arma el documento de extracciones/{extractionId} a partir del payload ya formateado.
+
+    Si el payload supera EXTRACTION_INLINE_MAX_BYTES se guarda en GCS y el documento
+    solo conserva la referencia (fields_uri), la huella y la metadata. Sin bucket de
+    spill configurado se guarda inline mientras quepa en FIRESTORE_INLINE_HARD_MAX_BYTES.
+    """
+    record: Dict[str, Any] = {
+        "fields": payload.get("fields", {}),
+        "metadata": payload.get("metadata", {}),
+        "fingerprint": fingerprint,
+        "created_at": firestore.SERVER_TIMESTAMP,
+    }
+    
+    payload_bytes = len(json.dumps(record["fields"], default=str))
+    if payload_bytes > EXTRACTION_INLINE_MAX_BYTES:
+        source_bucket = gcs_uri.replace("gs://", "").split("/", 1)[0]
+        if not _spill_bucket(source_bucket):
+            if payload_bytes > FIRESTORE_INLINE_HARD_MAX_BYTES:
+                raise AppError(
+                    code="EXTRACTION_TOO_LARGE",
+                    message=(
+                        f"Extraction payload of {payload_bytes} bytes does not fit in Firestore "
+                        "and EXTRACTION_SPILL_URI is not configured"
+                    ),
+                    stage="PERSIST",
+                    details={"spill_uri": EXTRACTION_SPILL_URI, "source_bucket": source_bucket}
+                )
+            logger.warning(
+                f"EXTRACTION_SPILL_URI not configured, storing {payload_bytes} bytes extraction inline: {doc_id}"
+            )
+            return record
+        record["fields_uri"] = _spill_extraction_to_gcs(
+            {"fields": record["fields"], "metadata": record["metadata"]},
+            source_bucket, folio_id, doc_id, extraction_id,
+        )
+        record["fields"] = {}
+        record["fields_bytes"] = payload_bytes
+        logger.info(f"Extraction payload spilled to GCS ({payload_bytes} bytes): {record['fields_uri']}")
+    return record
+
+
+def _previous_extractions(known: Optional[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Extracción vigente de cada file_id según los documentos de corridas anteriores.
+
+    Returns:
+        {file_id: {latest_extraction, extraction_fingerprint}}
+    """
+    previous: Dict[str, Dict[str, Any]] = {}
+    for data in (known or {}).values():
+        if data.get("status") == "DONE" and data.get("latest_extraction") and data.get("extraction_fingerprint"):
+            previous[data.get("file_id", "")] = {
+                "latest_extraction": data["latest_extraction"],
+                "extraction_fingerprint": data["extraction_fingerprint"],
+            }
+    return previous
+
+
+def _store_extraction_delta(writer: _FirestoreWriteBatcher, db: _AnyFirestoreClient, previous_path: str,
+                            record: Dict[str, Any], new_path: str) -> int:
+    """Reescribe la extracción anterior como delta por campo contra la nueva.
+
+    La extracción vigente siempre queda completa; la anterior conserva solo los campos
+    de primer nivel que difieren (fields_delta.set) y los que no tenía (fields_delta.removed),
+    con base_extraction apuntando a la nueva. Si alguna de las dos está en GCS (fields_uri)
+    o la anterior ya es un delta, solo se enlaza con superseded_by.
+
+    Returns:
+        Campos distintos entre ambas versiones (-1 si solo se enlazó).
+    """
+    link = {"superseded_by": new_path, "superseded_at": firestore.SERVER_TIMESTAMP}
+    previous = None
+    if not record.get("fields_uri"):
+        # Lectura síncrona también en modo asyncio: esta función corre en un thread
+        snap = _get_firestore_client().document(previous_path).get()
+        previous = snap.to_dict() if snap.exists else None
+    if not previous or previous.get("fields_uri") or "fields" not in previous:
+        writer.set(db.document(previous_path), link, merge=True)
+        return -1
+
+    old_fields = previous["fields"]
+    new_fields = record["fields"]
+    changed = {name: value for name, value in old_fields.items() if new_fields.get(name) != value}
+    removed = sorted(name for name in new_fields if name not in old_fields)
+    writer.set(db.document(previous_path), {
+        "fields_delta": {"set": changed, "removed": removed},
+        "base_extraction": new_path,
+        "metadata": previous.get("metadata", {}),
+        "fingerprint": previous.get("fingerprint", ""),
+        "created_at": previous.get("created_at") or firestore.SERVER_TIMESTAMP,
+        **link,
+    })
+    return len(changed) + len(removed)
+
+
+def _persist_document_result(writer: _FirestoreWriteBatcher, db: _AnyFirestoreClient, folio_id: str, doc_id: str,
+                             file_id: str, gcs_uri: str, generation: str, classification: Dict[str, Any],
+                             extraction: Dict[str, Any], status: str, error: Optional[Dict] = None) -> str:
+    """Persiste resultado de documento con estructura jerárquica completa.
+
+    Las escrituras se encolan en el writer del folio; el contador processed_docs se
+    acumula y se aplica en el siguiente flush. Retorna el status persistido, que pasa
+    a ERROR si la extracción no se pudo guardar.
+    
+    El documento apunta a su extracción vigente (latest_extraction). Si la generation
+    anterior del mismo archivo dio el mismo resultado (misma huella) no se escribe una
+    extracción nueva: el puntero reutiliza la anterior. Si cambió, la anterior se
+    reescribe como delta por campo contra la nueva.
+    """
     try:
         doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
         
+        # Extracción fallida o parcial: se guardan los campos obtenidos, pero nunca como DONE
+        extraction_errors = (extraction or {}).get("metadata", {}).get("extraction_errors")
+        if extraction_errors and status == "DONE":
+            status = "ERROR"
+            error = {
+                "code": "EXTRACTION_INCOMPLETE",
+                "message": "; ".join(
+                    f"{e['doc_type']}: {e['reason']}" + (f" ({len(e['missing_pages'])} pages missing)" if e["missing_pages"] else "")
+                    for e in extraction_errors
+                ),
+            }
+        
+        # Preparar la extracción antes del documento: si no se puede guardar, el documento queda en ERROR
+        extraction_id = None
+        extraction_record = None
+        extraction_pointer: Dict[str, Any] = {}
+        previous = writer.previous_extractions.get(file_id) if EXTRACTION_DEDUP_ENABLED else None
+        if extraction and extraction.get("fields"):
+            payload = _compact_extraction(extraction) if EXTRACTION_FORMAT == "compact" else extraction
+            fingerprint = _extraction_fingerprint(payload.get("fields", {}))
+            if previous and previous["extraction_fingerprint"] == fingerprint:
+                extraction_pointer = {
+                    "latest_extraction": previous["latest_extraction"],
+                    "extraction_fingerprint": fingerprint,
+                }
+                _json_log({
+                    "event_type": "extraction_unchanged",
+                    "folio_id": folio_id,
+                    "doc_id": doc_id,
+                    "latest_extraction": previous["latest_extraction"],
+                    "fingerprint": fingerprint,
+                    "timestamp": _utc_iso(),
+                })
+            else:
+                extraction_id = f"extraction-{_utc_iso()}"
+                try:
+                    extraction_record = _build_extraction_record(
+                        payload, fingerprint, gcs_uri, folio_id, doc_id, extraction_id
+                    )
+                    extraction_pointer = {
+                        "latest_extraction": f"{doc_ref.path}/extracciones/{extraction_id}",
+                        "extraction_fingerprint": fingerprint,
+                    }
+                except AppError as e:
+                    logger.error(f"Error storing extraction for {doc_id}: {e.message}")
+                    status = "ERROR"
+                    error = {"code": e.code, "message": e.message}
+        
         doc_data = {
             "gcs_uri": gcs_uri,
             "generation": generation,
@@ -446,6 +3304,7 @@ def _persist_document_result(db: firestore.Client, folio_id: str, doc_id: str, f
             "doc_type": classification.get("document_type", "UNKNOWN"),
             "classifier_confidence": classification.get("confidence", 0.0),
             "classifier_version": classification.get("classifier_version", ""),
+            "classification_source": classification.get("classification_source", "classifier"),
             "updated_at": firestore.SERVER_TIMESTAMP,
         }
         
@@ -456,215 +3315,994 @@ def _persist_document_result(db: firestore.Client, folio_id: str, doc_id: str, f
             doc_data["error_type"] = error.get("code", "")
             doc_data["error_message"] = error.get("message", "")
         
-        doc_ref.set(doc_data, merge=True)
+        doc_data.update(extraction_pointer)
         
-        # Guardar extracción en sub-colección
-        if extraction and extraction.get("fields"):
-            extraction_id = f"extraction-{_utc_iso()}"
+        # El estado final libera el lease en la misma escritura
+        doc_data["lease_owner"] = firestore.DELETE_FIELD
+        doc_data["lease_expires_at"] = firestore.DELETE_FIELD
+        
+        writer.set(doc_ref, doc_data, merge=True)
+        
+        # Guardar extracción en sub-colección (antes del delta de la anterior, que la referencia)
+        if extraction_record is not None:
             extraction_ref = doc_ref.collection("extracciones").document(extraction_id)
-            extraction_ref.set({
-                "fields": extraction.get("fields", {}),
-                "metadata": extraction.get("metadata", {}),
-                "created_at": firestore.SERVER_TIMESTAMP,
-            })
+            writer.set(extraction_ref, extraction_record)
+            if previous:
+                changed_fields = _store_extraction_delta(
+                    writer, db, previous["latest_extraction"], extraction_record,
+                    extraction_pointer["latest_extraction"],
+                )
+                _json_log({
+                    "event_type": "extraction_changed",
+                    "folio_id": folio_id,
+                    "doc_id": doc_id,
+                    "latest_extraction": extraction_pointer["latest_extraction"],
+                    "previous_extraction": previous["latest_extraction"],
+                    "changed_fields": changed_fields,
+                    "timestamp": _utc_iso(),
+                })
         
-        # Actualizar contadores del folio
-        folio_ref = db.collection("folios").document(folio_id)
-        folio_ref.update({
-            "processed_docs": firestore.Increment(1),
-            "last_update_at": firestore.SERVER_TIMESTAMP,
-        })
+        # Actualizar contadores del folio (agregados por el writer)
+        writer.increment_processed()
         
     except Exception as e:
         logger.error(f"Error persisting document: {e}")
+    return status
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # DOCUMENT PROCESSING: Con procesamiento paralelo
 # ═══════════════════════════════════════════════════════════════════════════════
 def _process_single_document(folio_id: str, file_name: str, generation: str, bucket_name: str, 
-                             db: firestore.Client) -> Dict[str, Any]:
-    """Procesa un documento individual con manejo de errores y reintentos."""
+                             db: firestore.Client, writer: _FirestoreWriteBatcher,
+                             object_metadata: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Procesa un documento individual con manejo de errores y reintentos.
+
+    Antes de llamar a Document AI toma el lease del documento (que también verifica
+    idempotencia) y lo renueva entre etapas. object_metadata es la metadata GCS del
+    listado, usada por la pre-clasificación local.
+    """
     file_id = file_name.split("/")[-1]
     doc_id = _make_doc_id(folio_id, file_id, generation)
     gcs_uri = f"gs://{bucket_name}/{file_name}"
     
+    with _instrumented("document", {"folio_id": folio_id, "doc_id": doc_id, "gcs_uri": gcs_uri}) as timer, \
+            _result_cache_session() as cache_session:
+        lease = None
+        try:
+            # Tomar el lease (verifica idempotencia y marca IN_PROGRESS)
+            lease, cached = _acquire_document_lease(db, folio_id, doc_id, {
+                "gcs_uri": gcs_uri,
+                "generation": generation,
+                "file_id": file_id,
+            })
+            lease_at = time.monotonic()
+            if lease == "LEASED":
+                logger.info(f"Document leased by another delivery: {file_id}")
+                timer.status = "LEASED"
+                return _leased_result(file_name, gcs_uri, generation, object_metadata)
+            if lease == "DONE":
+                logger.info(f"Document already processed (from cache): {file_id}")
+                _json_log({
+                    "event_type": "document_already_processed",
+                    "folio_id": folio_id,
+                    "doc_id": doc_id,
+                    "gcs_uri": gcs_uri,
+                    "generation": generation,
+                    "doc_type": cached.get("doc_type", "UNKNOWN"),
+                    "timestamp": _utc_iso(),
+                })
+                return {
+                    "file_name": file_name,
+                    "gcs_uri": gcs_uri,
+                    "status": "DONE",
+                    "from_cache": True,
+                    "doc_type": cached.get("doc_type", "UNKNOWN"),
+                }
+            
+            _json_log({
+                "event_type": "document_processing_start",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "generation": generation,
+                "timestamp": _utc_iso(),
+            })
+            
+            # Descargar una sola vez (fijado a la generation del doc_id) y validar PDF en memoria
+            storage_client = _get_storage_client()
+            with timer.stage("download"):
+                content = _fetch_document_content(storage_client, bucket_name, file_name, generation)
+            timer.add_bytes(len(content))
+            with timer.stage("validate"):
+                is_valid, error_msg = _is_valid_pdf(content)
+            if not is_valid:
+                raise AppError(
+                    code="INVALID_PDF",
+                    message=error_msg,
+                    stage="VALIDATION",
+                    details={"file": file_name}
+                )
+            
+            # Clasificar
+            _json_log({
+                "event_type": "document_classification_start",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "timestamp": _utc_iso(),
+            })
+            logger.info(f"Classifying: {file_id}")
+            lease_at = _keep_document_lease(db, folio_id, doc_id, lease_at)
+            with timer.stage("classify"):
+                inferred = _infer_document_type(file_name, object_metadata, content)
+                cache_session.prefetch(content, classify=inferred is None)
+                classification = inferred or classify_document(gcs_uri, content)
+            _json_log({
+                "event_type": "document_classification_done",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "doc_type": classification["document_type"],
+                "confidence": classification["confidence"],
+                "classification_source": classification.get("classification_source", "classifier"),
+                "duration_ms": timer.duration_ms("classify"),
+                "timestamp": _utc_iso(),
+            })
+            
+            # Extraer
+            _json_log({
+                "event_type": "document_extraction_start",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "doc_type": classification["document_type"],
+                "timestamp": _utc_iso(),
+            })
+            logger.info(f"Extracting: {file_id}")
+            lease_at = _keep_document_lease(db, folio_id, doc_id, lease_at)
+            with timer.stage("extract"):
+                extraction = extract_document_data(gcs_uri, classification["document_type"], content, classification)
+            _json_log({
+                "event_type": "document_extraction_done",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "doc_type": classification["document_type"],
+                "duration_ms": timer.duration_ms("extract"),
+                "timestamp": _utc_iso(),
+            })
+            
+            # Persistir (las entradas nuevas de la caché de resultados van en el mismo batch)
+            with timer.stage("persist"):
+                cache_session.enqueue(writer, db)
+                status = _persist_document_result(
+                    writer, db, folio_id, doc_id, file_id, gcs_uri, generation,
+                    classification, extraction, "DONE"
+                )
+            timer.status = status
+            
+            _json_log({
+                "event_type": "document_processing_done",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "doc_type": classification["document_type"],
+                **timer.summary(),
+                "timestamp": _utc_iso(),
+            })
+            
+            return {
+                "file_name": file_name,
+                "gcs_uri": gcs_uri,
+                "status": status,
+                "from_cache": False,
+                "doc_type": classification["document_type"],
+                "confidence": classification["confidence"],
+                "classification_source": classification.get("classification_source", "classifier"),
+            }
+            
+        except Exception as e:
+            lease_lost = isinstance(e, AppError) and e.code == "LEASE_LOST"
+            if not lease_lost and lease == "ACQUIRED":
+                lease_lost = _document_lease_lost(db, folio_id, doc_id)
+            if lease_lost:
+                # Otra entrega tiene (o ya terminó) el documento: no se escribe ni se publica nada
+                logger.warning(f"Lease lost for {file_id}, leaving it to the other delivery")
+                timer.status = "LEASED"
+                return _leased_result(file_name, gcs_uri, generation, object_metadata)
+            
+            logger.error(f"Error processing {file_id}: {e}")
+            timer.status = "ERROR"
+            
+            # Persistir error (conservando los resultados ya cacheados de este documento)
+            cache_session.enqueue(writer, db)
+            _persist_document_result(
+                writer, db, folio_id, doc_id, file_id, gcs_uri, generation,
+                {"document_type": "UNKNOWN", "confidence": 0.0},
+                {}, "ERROR",
+                error={"code": "PROCESSING_ERROR", "message": str(e)}
+            )
+            
+            # Publicar a DLQ
+            _publish_to_dlq(folio_id, gcs_uri, "PROCESSING_ERROR", str(e), MAX_RETRIES)
+            
+            _json_log({
+                "event_type": "document_error",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "error_type": "PROCESSING_ERROR",
+                "error_message": str(e),
+                "error_stage": e.stage if isinstance(e, AppError) else "",
+                **timer.summary(),
+                "timestamp": _utc_iso(),
+            })
+            
+            return {
+                "file_name": file_name,
+                "gcs_uri": gcs_uri,
+                "status": "ERROR",
+                "error": str(e),
+            }
+
+
+def _reject_documents(writer: _FirestoreWriteBatcher, db: firestore.Client, folio_id: str, bucket_name: str,
+                      rejected: List[Tuple[PdfObject, str, str]]) -> List[Dict[str, Any]]:
+    """Persiste en ERROR los documentos rechazados por el preflight y los publica a la DLQ.
+
+    No toman lease: el rechazo depende solo de los metadatos de la generation listada.
+    """
+    results = []
+    for pdf, code, message in rejected:
+        file_id = pdf.name.split("/")[-1]
+        doc_id = _make_doc_id(folio_id, file_id, pdf.generation)
+        gcs_uri = f"gs://{bucket_name}/{pdf.name}"
+        _persist_document_result(
+            writer, db, folio_id, doc_id, file_id, gcs_uri, pdf.generation,
+            {"document_type": "UNKNOWN", "confidence": 0.0},
+            {}, "ERROR",
+            error={"code": code, "message": message}
+        )
+        _publish_to_dlq(folio_id, gcs_uri, code, message, 0, details={
+            "size": pdf.size,
+            "content_type": pdf.content_type,
+            "crc32c": pdf.crc32c,
+            "generation": pdf.generation,
+        })
+        _json_log({
+            "event_type": "document_rejected",
+            "folio_id": folio_id,
+            "doc_id": doc_id,
+            "gcs_uri": gcs_uri,
+            "error_type": code,
+            "error_message": message,
+            "size": pdf.size,
+            "content_type": pdf.content_type,
+            "timestamp": _utc_iso(),
+        })
+        results.append({
+            "file_name": pdf.name,
+            "gcs_uri": gcs_uri,
+            "status": "ERROR",
+            "error": message,
+        })
+    return results
+
+
+def _stream_pending_documents(db: firestore.Client, folio_id: str, bucket_name: str, folder_prefix: str,
+                              listing: Dict[str, Any], writer: _FirestoreWriteBatcher,
+                              known: Optional[Dict[str, Dict[str, Any]]] = None) -> Iterator[PdfObject]:
+    """Generador del pipeline de listado: página de GCS -> preflight -> pre-chequeo -> pendientes.
+
+    Actualiza total_docs del folio de forma incremental por página y acumula en
+    listing["total_docs"] / listing["cached_results"] / listing["rejected_results"] los
+    totales, los documentos ya DONE y los rechazados por el preflight. Cada página se
+    entrega de mayor a menor tamaño.
+    
+    En modo incremental (known = documentos de corridas anteriores) los PDFs sin cambios
+    se reutilizan tal cual y, al terminar el listado, los ausentes se marcan SUPERSEDED
+    (listing["superseded"]).
+    """
+    folio_ref = db.collection("folios").document(folio_id)
+    pages = _iter_pdf_pages(bucket_name, folder_prefix)
+    seen: Set[str] = set()
+    while True:
+        # Solo se mide la espera de cada página: el consumidor trabaja entre yields
+        with _timed_stage("list"):
+            page = next(pages, None)
+        if page is None:
+            if known is not None:
+                listing["superseded"] = len(_supersede_documents(writer, db, folio_id, known, seen))
+            return
+        listing["total_docs"] += len(page)
+        try:
+            folio_ref.update({"total_docs": firestore.Increment(len(page))})
+        except Exception as e:
+            logger.warning(f"Error updating total_docs: {e}")
+        
+        if known is not None:
+            page, unchanged = _split_unchanged_documents(folio_id, page, known, seen)
+            listing["cached_results"].extend(
+                _unchanged_result(pdf, bucket_name, known[doc_id]) for pdf, doc_id in unchanged
+            )
+        
+        with _timed_stage("preflight"):
+            accepted, rejected = _preflight_documents(page)
+            listing["rejected_results"].extend(_reject_documents(writer, db, folio_id, bucket_name, rejected))
+        
+        with _timed_stage("precheck"):
+            pending, cached_results = _precheck_processed_documents(db, folio_id, accepted, bucket_name)
+        listing["cached_results"].extend(cached_results)
+        yield from pending
+
+
+def _split_batch_candidates(pending: Iterator[PdfObject]) -> Tuple[bool, Iterable[PdfObject]]:
+    """Decide si el folio va por modo batch con un prefijo acotado del listado.
+
+    Se consumen a lo sumo BATCH_MODE_MIN_DOCS documentos (o BATCH_MODE_MAX_DOCS_PER_REQUEST
+    si el criterio por cantidad está deshabilitado): el criterio por bytes se evalúa sobre
+    ese prefijo. El prefijo se devuelve encadenado al resto, que sigue en streaming. Si el
+    modo batch no está configurado el iterador se devuelve intacto.
+    """
+    if not BATCH_OUTPUT_URI:
+        return False, pending
+    prefix_limit = BATCH_MODE_MIN_DOCS or BATCH_MODE_MAX_DOCS_PER_REQUEST
+    buffered: List[PdfObject] = []
+    total_bytes = 0
+    for pdf in itertools.islice(pending, prefix_limit):
+        buffered.append(pdf)
+        total_bytes += pdf.size
+        if _should_use_batch_mode(len(buffered), total_bytes):
+            return True, itertools.chain(buffered, pending)
+    return False, itertools.chain(buffered, pending)
+
+
+def _process_documents_parallel(folio_id: str, documents: Iterable[PdfObject], 
+                                bucket_name: str, db: firestore.Client,
+                                writer: _FirestoreWriteBatcher) -> List[Dict[str, Any]]:
+    """Procesa múltiples documentos en paralelo en el scheduler compartido de la instancia.
+
+    documents puede ser un generador: cada documento se encola en cuanto se produce,
+    mientras el listado de la carpeta sigue avanzando. Los workers se reparten en
+    round-robin con los demás folios en curso en la instancia.
+    """
+    results = []
+    scheduler = _get_scheduler()
+    
+    # Cada tarea corre en una copia del contexto para heredar el span/timer del folio
+    future_to_doc = {
+        scheduler.submit(folio_id, _process_single_document, folio_id, pdf.name,
+                         pdf.generation, bucket_name, db, writer, pdf.metadata): pdf
+        for pdf in documents
+    }
+    
+    # Collect results as they complete
+    for future in as_completed(future_to_doc):
+        file_name = future_to_doc[future].name
+        try:
+            result = future.result()
+            results.append(result)
+            logger.info(f"Completed: {file_name} - Status: {result['status']}")
+        except Exception as e:
+            logger.error(f"Failed to process {file_name}: {e}")
+            results.append({
+                "file_name": file_name,
+                "status": "ERROR",
+                "error": str(e),
+            })
+    
+    return results
+
+
+def _await_leased_documents(folio_id: str, leased: List[PdfObject], bucket_name: str, db: firestore.Client,
+                            writer: _FirestoreWriteBatcher) -> Tuple[List[Dict[str, Any]], List[PdfObject]]:
+    """Espera a los documentos que procesa otra entrega, hasta LEASE_WAIT_SECONDS.
+
+    Cada LEASE_POLL_INTERVAL relee su estado: los terminados se suman a los resultados
+    del folio y los de lease vencido se retoman aquí. Las escrituras propias se confirman
+    antes de cada lectura, así la última entrega en terminar siempre ve el folio completo.
+    
+    Returns:
+        (resultados, documentos que siguen con lease de otra entrega)
+    """
+    documentos = db.collection("folios").document(folio_id).collection("documentos")
+    owner = _LEASE_OWNER.get()
+    resolved: List[Dict[str, Any]] = []
+    deadline = time.monotonic() + LEASE_WAIT_SECONDS
+    while leased:
+        writer.flush()
+        by_doc_id = {_make_doc_id(folio_id, pdf.name.split("/")[-1], pdf.generation): pdf for pdf in leased}
+        snaps = db.get_all([documentos.document(doc_id) for doc_id in by_doc_id],
+                           field_paths=["status", "doc_type", "lease_owner", "lease_expires_at"])
+        leased, expired = [], []
+        for snap in snaps:
+            pdf = by_doc_id[snap.id]
+            data = (snap.to_dict() or {}) if snap.exists else {}
+            if data.get("status") in ("DONE", "ERROR"):
+                resolved.append({
+                    "file_name": pdf.name,
+                    "gcs_uri": f"gs://{bucket_name}/{pdf.name}",
+                    "status": data["status"],
+                    "from_cache": True,
+                    "doc_type": data.get("doc_type", "UNKNOWN"),
+                })
+            elif _lease_is_live(data, owner):
+                leased.append(pdf)
+            else:
+                expired.append(pdf)
+        if expired:
+            logger.info(f"Resuming {len(expired)} documents with expired leases")
+            for result in _process_documents_parallel(folio_id, expired, bucket_name, db, writer):
+                if result.get("status") == "LEASED":
+                    leased.append(result["pdf"])
+                else:
+                    resolved.append(result)
+            continue
+        if not leased or time.monotonic() + LEASE_POLL_INTERVAL > deadline:
+            break
+        time.sleep(LEASE_POLL_INTERVAL)
+    return resolved, leased
+
+
+def _process_documents_batch(folio_id: str, documents: List[PdfObject], bucket_name: str,
+                             db: firestore.Client, writer: _FirestoreWriteBatcher) -> List[Dict[str, Any]]:
+    """Procesa un folio grande con batch_process_documents (Classifier y luego Extractor por tipo).
+
+    No descarga los PDFs: Document AI los lee de GCS y escribe su salida bajo
+    BATCH_OUTPUT_URI/{folio_id}/{run_id}/. Un documento que el Extractor no pudo
+    procesar se marca ERROR. Si la operación batch falla por completo, se recurre
+    al procesamiento online en paralelo.
+    
+    Classifier y Extractores comparten un solo plazo (BATCH_MODE_DEADLINE_SECONDS), que
+    queda por debajo del timeout de la petición; los leases cubren ese plazo.
+    """
+    results: List[Dict[str, Any]] = []
+    pdf_by_uri: Dict[str, PdfObject] = {}
+    for pdf in documents:
+        uri = f"gs://{bucket_name}/{pdf.name}"
+        file_id = pdf.name.split("/")[-1]
+        lease, data = _acquire_document_lease(
+            db, folio_id, _make_doc_id(folio_id, file_id, pdf.generation),
+            {"gcs_uri": uri, "generation": pdf.generation, "file_id": file_id},
+            lease_seconds=int(DOCUMENT_LEASE_SECONDS + BATCH_MODE_DEADLINE_SECONDS),
+        )
+        if lease == "ACQUIRED":
+            pdf_by_uri[uri] = pdf
+        elif lease == "LEASED":
+            results.append(_leased_result(pdf.name, uri, pdf.generation, pdf.metadata))
+        else:
+            results.append({"file_name": pdf.name, "gcs_uri": uri, "status": "DONE", "from_cache": True,
+                            "doc_type": data.get("doc_type", "UNKNOWN")})
+    documents = list(pdf_by_uri.values())
+    uris = list(pdf_by_uri)
+    output_base = f"{BATCH_OUTPUT_URI}/{folio_id}/{uuid.uuid4().hex[:12]}"
+    if not uris:
+        return results
+    
+    _json_log({
+        "event_type": "folder_batch_processing_start",
+        "folio_id": folio_id,
+        "total_docs": len(uris),
+        "total_bytes": sum(pdf.size for pdf in documents),
+        "output_uri": output_base,
+        "timestamp": _utc_iso(),
+    })
+    
+    deadline = time.monotonic() + BATCH_MODE_DEADLINE_SECONDS
     try:
-        # Verificar idempotencia
-        already_processed, cached = _check_document_processed(db, folio_id, doc_id)
-        if already_processed:
-            logger.info(f"Document already processed (from cache): {file_id}")
+        # Pre-clasificación por nombre/metadata (sin bytes); el resto se clasifica en una sola operación
+        classifications: Dict[str, Dict[str, Any]] = {}
+        for uri, pdf in pdf_by_uri.items():
+            inferred = _infer_document_type(pdf.name, pdf.metadata, None)
+            if inferred:
+                classifications[uri] = inferred
+        to_classify = [uri for uri in uris if uri not in classifications]
+        if CLASSIFIER_PROCESSOR_NAME and to_classify:
+            classifier_name = _processor_path(CLASSIFIER_PROCESSOR_NAME)
+            classified = _run_batch_process(classifier_name, to_classify, f"{output_base}/classification", deadline)
+            classifications.update({uri: _parse_classification(doc, classifier_name) for uri, doc in classified.items()})
+        for uri in to_classify:
+            classifications.setdefault(
+                uri, {"document_type": "UNKNOWN", "confidence": 0.0, "classifier_version": "not_configured"}
+            )
+        
+        # Agrupar por extractor y extraer cada grupo en su propia operación
+        groups: Dict[str, List[str]] = {}
+        for uri in uris:
+            groups.setdefault(_select_extractor(classifications[uri]["document_type"]), []).append(uri)
+        
+        extracted: Dict[str, Optional[documentai.Document]] = {}
+        extractor_names: Dict[str, str] = {}
+        for extractor_id, group_uris in groups.items():
+            extractor_name = _processor_path(extractor_id) if extractor_id else ""
+            extracted.update(_run_batch_process(extractor_name, group_uris, f"{output_base}/extraction-{extractor_id}",
+                                                deadline))
+            extractor_names.update({uri: extractor_name for uri in group_uris})
+    except Exception as e:
+        logger.error(f"Batch processing failed, falling back to online processing: {e}")
+        return results + _process_documents_parallel(folio_id, documents, bucket_name, db, writer)
+    
+    for uri, pdf in pdf_by_uri.items():
+        file_id = pdf.name.split("/")[-1]
+        doc_id = _make_doc_id(folio_id, file_id, pdf.generation)
+        classification = classifications[uri]
+        document = extracted.get(uri)
+        
+        if document is None and extractor_names.get(uri):
+            error_msg = "Document AI batch processing failed for document"
+            _persist_document_result(
+                writer, db, folio_id, doc_id, file_id, uri, pdf.generation,
+                classification, {}, "ERROR",
+                error={"code": "PROCESSING_ERROR", "message": error_msg}
+            )
+            _publish_to_dlq(folio_id, uri, "PROCESSING_ERROR", error_msg, 1, {"mode": "batch"})
+            results.append({"file_name": pdf.name, "gcs_uri": uri, "status": "ERROR", "error": error_msg})
+            continue
+        
+        extraction = _parse_extraction(document, extractor_names.get(uri, ""), classification["document_type"])
+        status = _persist_document_result(
+            writer, db, folio_id, doc_id, file_id, uri, pdf.generation,
+            classification, extraction, "DONE"
+        )
+        results.append({
+            "file_name": pdf.name,
+            "gcs_uri": uri,
+            "status": status,
+            "from_cache": False,
+            "doc_type": classification["document_type"],
+            "confidence": classification["confidence"],
+            "classification_source": classification.get("classification_source", "classifier"),
+        })
+    
+    return results
+
+
+async def _process_single_document_async(folio_id: str, file_name: str, generation: str, bucket_name: str,
+                                        db: firestore.AsyncClient,
+                                        writer: _AsyncFirestoreWriteBatcher,
+                                        object_metadata: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Equivalente async de _process_single_document (modo EXECUTION_MODE=asyncio).
+
+    La descarga de GCS y las transacciones del lease se delegan a threads (cliente
+    Firestore síncrono), porque google-cloud-storage no ofrece cliente async.
+    """
+    file_id = file_name.split("/")[-1]
+    doc_id = _make_doc_id(folio_id, file_id, generation)
+    gcs_uri = f"gs://{bucket_name}/{file_name}"
+    
+    with _instrumented("document", {"folio_id": folio_id, "doc_id": doc_id, "gcs_uri": gcs_uri}) as timer, \
+            _result_cache_session() as cache_session:
+        lease = None
+        try:
+            # Tomar el lease (verifica idempotencia y marca IN_PROGRESS)
+            sync_db = _get_firestore_client()
+            lease, cached = await asyncio.to_thread(_acquire_document_lease, sync_db, folio_id, doc_id, {
+                "gcs_uri": gcs_uri,
+                "generation": generation,
+                "file_id": file_id,
+            })
+            lease_at = time.monotonic()
+            if lease == "LEASED":
+                logger.info(f"Document leased by another delivery: {file_id}")
+                timer.status = "LEASED"
+                return _leased_result(file_name, gcs_uri, generation, object_metadata)
+            if lease == "DONE":
+                return {
+                    "file_name": file_name,
+                    "gcs_uri": gcs_uri,
+                    "status": "DONE",
+                    "from_cache": True,
+                    "doc_type": cached.get("doc_type", "UNKNOWN"),
+                }
+            
+            _json_log({
+                "event_type": "document_processing_start",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "generation": generation,
+                "timestamp": _utc_iso(),
+            })
+            
+            with timer.stage("download"):
+                content = await asyncio.to_thread(
+                    _fetch_document_content, _get_storage_client(), bucket_name, file_name, generation
+                )
+            timer.add_bytes(len(content))
+            with timer.stage("validate"):
+                is_valid, error_msg = _is_valid_pdf(content)
+            if not is_valid:
+                raise AppError(
+                    code="INVALID_PDF",
+                    message=error_msg,
+                    stage="VALIDATION",
+                    details={"file": file_name}
+                )
+            
+            lease_at = await asyncio.to_thread(_keep_document_lease, sync_db, folio_id, doc_id, lease_at)
+            with timer.stage("classify"):
+                inferred = _infer_document_type(file_name, object_metadata, content)
+                await asyncio.to_thread(cache_session.prefetch, content, inferred is None)
+                classification = inferred or await classify_document_async(gcs_uri, content)
+            _json_log({
+                "event_type": "document_classification_done",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "doc_type": classification["document_type"],
+                "confidence": classification["confidence"],
+                "classification_source": classification.get("classification_source", "classifier"),
+                "duration_ms": timer.duration_ms("classify"),
+                "timestamp": _utc_iso(),
+            })
+            
+            lease_at = await asyncio.to_thread(_keep_document_lease, sync_db, folio_id, doc_id, lease_at)
+            with timer.stage("extract"):
+                extraction = await extract_document_data_async(
+                    gcs_uri, classification["document_type"], content, classification
+                )
+            
+            with timer.stage("persist"):
+                cache_session.enqueue(writer, db)
+                # En un thread: un payload grande puede subirse a GCS
+                status = await asyncio.to_thread(
+                    _persist_document_result, writer, db, folio_id, doc_id, file_id, gcs_uri, generation,
+                    classification, extraction, "DONE"
+                )
+                await writer.maybe_aflush()
+            timer.status = status
+            
             _json_log({
-                "event_type": f"folio_{folio_id}_doc_{doc_id}_already_processed",
+                "event_type": "document_processing_done",
                 "folio_id": folio_id,
                 "doc_id": doc_id,
                 "gcs_uri": gcs_uri,
-                "generation": generation,
-                "doc_type": cached.get("doc_type", "UNKNOWN"),
+                "doc_type": classification["document_type"],
+                **timer.summary(),
                 "timestamp": _utc_iso(),
             })
+            
             return {
                 "file_name": file_name,
                 "gcs_uri": gcs_uri,
-                "status": "DONE",
-                "from_cache": True,
-                "doc_type": cached.get("doc_type", "UNKNOWN"),
+                "status": status,
+                "from_cache": False,
+                "doc_type": classification["document_type"],
+                "confidence": classification["confidence"],
+                "classification_source": classification.get("classification_source", "classifier"),
             }
         
-        # Marcar como IN_PROGRESS
-        doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
-        doc_ref.set({
-            "gcs_uri": gcs_uri,
-            "generation": generation,
-            "file_id": file_id,
-            "status": "IN_PROGRESS",
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        }, merge=True)
-        
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_processing_start",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "generation": generation,
-            "timestamp": _utc_iso(),
-        })
-        
-        # Validar PDF
-        storage_client = storage.Client()
-        is_valid, error_msg = _is_valid_pdf(file_name, storage_client, bucket_name)
-        if not is_valid:
-            raise AppError(
-                code="INVALID_PDF",
-                message=error_msg,
-                stage="VALIDATION",
-                details={"file": file_name}
+        except Exception as e:
+            lease_lost = isinstance(e, AppError) and e.code == "LEASE_LOST"
+            if not lease_lost and lease == "ACQUIRED":
+                lease_lost = await asyncio.to_thread(_document_lease_lost, _get_firestore_client(), folio_id, doc_id)
+            if lease_lost:
+                logger.warning(f"Lease lost for {file_id}, leaving it to the other delivery")
+                timer.status = "LEASED"
+                return _leased_result(file_name, gcs_uri, generation, object_metadata)
+            
+            logger.error(f"Error processing {file_id}: {e}")
+            timer.status = "ERROR"
+            
+            cache_session.enqueue(writer, db)
+            _persist_document_result(
+                writer, db, folio_id, doc_id, file_id, gcs_uri, generation,
+                {"document_type": "UNKNOWN", "confidence": 0.0},
+                {}, "ERROR",
+                error={"code": "PROCESSING_ERROR", "message": str(e)}
             )
-        
-        # Clasificar
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_classification_start",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "timestamp": _utc_iso(),
-        })
-        logger.info(f"Classifying: {file_id}")
-        classification = classify_document(gcs_uri)
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_classification_done",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "doc_type": classification["document_type"],
-            "confidence": classification["confidence"],
-            "timestamp": _utc_iso(),
-        })
-        
-        # Extraer
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_extraction_start",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "doc_type": classification["document_type"],
-            "timestamp": _utc_iso(),
-        })
-        logger.info(f"Extracting: {file_id}")
-        extraction = extract_document_data(gcs_uri, classification["document_type"])
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_extraction_done",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "doc_type": classification["document_type"],
-            "timestamp": _utc_iso(),
-        })
-        
-        # Persistir
-        _persist_document_result(
-            db, folio_id, doc_id, file_id, gcs_uri, generation,
-            classification, extraction, "DONE"
-        )
-        
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_processing_done",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "doc_type": classification["document_type"],
-            "timestamp": _utc_iso(),
-        })
-        
-        return {
-            "file_name": file_name,
-            "gcs_uri": gcs_uri,
-            "status": "DONE",
-            "from_cache": False,
-            "doc_type": classification["document_type"],
-            "confidence": classification["confidence"],
-        }
-        
-    except Exception as e:
-        logger.error(f"Error processing {file_id}: {e}")
-        
-        # Persistir error
-        _persist_document_result(
-            db, folio_id, doc_id, file_id, gcs_uri, generation,
-            {"document_type": "UNKNOWN", "confidence": 0.0},
-            {}, "ERROR",
-            error={"code": "PROCESSING_ERROR", "message": str(e)}
-        )
-        
-        # Publicar a DLQ
-        _publish_to_dlq(folio_id, gcs_uri, "PROCESSING_ERROR", str(e), MAX_RETRIES)
-        
-        _json_log({
-            "event_type": f"folio_{folio_id}_doc_{doc_id}_error",
-            "folio_id": folio_id,
-            "doc_id": doc_id,
-            "gcs_uri": gcs_uri,
-            "error_type": "PROCESSING_ERROR",
-            "error_message": str(e),
-            "timestamp": _utc_iso(),
-        })
-        
-        return {
-            "file_name": file_name,
-            "gcs_uri": gcs_uri,
-            "status": "ERROR",
-            "error": str(e),
-        }
+            await writer.maybe_aflush()
+            
+            await asyncio.to_thread(_publish_to_dlq, folio_id, gcs_uri, "PROCESSING_ERROR", str(e), MAX_RETRIES)
+            
+            _json_log({
+                "event_type": "document_error",
+                "folio_id": folio_id,
+                "doc_id": doc_id,
+                "gcs_uri": gcs_uri,
+                "error_type": "PROCESSING_ERROR",
+                "error_message": str(e),
+                "error_stage": e.stage if isinstance(e, AppError) else "",
+                **timer.summary(),
+                "timestamp": _utc_iso(),
+            })
+            
+            return {
+                "file_name": file_name,
+                "gcs_uri": gcs_uri,
+                "status": "ERROR",
+                "error": str(e),
+            }
 
 
-def _process_documents_parallel(folio_id: str, documents: List[Tuple[str, str]], 
-                                bucket_name: str, db: firestore.Client) -> List[Dict[str, Any]]:
-    """Procesa múltiples documentos en paralelo con ThreadPoolExecutor."""
-    results = []
+async def _process_documents_async(folio_id: str, documents: List[PdfObject], bucket_name: str,
+                                   previous_extractions: Optional[Dict[str, Dict[str, Any]]] = None
+                                   ) -> List[Dict[str, Any]]:
+    """Procesa documentos como corutinas concurrentes, acotadas por ASYNC_MAX_CONCURRENT_DOCS.
+
+    Todas las escrituras pendientes se confirman antes de retornar.
+    """
+    db = _get_firestore_async_client()
+    writer = _AsyncFirestoreWriteBatcher(db, folio_id, previous_extractions)
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_DOCS)
     
-    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOCS) as executor:
-        # Submit all tasks
-        future_to_doc = {
-            executor.submit(_process_single_document, folio_id, file_name, generation, bucket_name, db): (file_name, generation)
-            for file_name, generation in documents
-        }
-        
-        # Collect results as they complete
-        for future in as_completed(future_to_doc):
-            file_name, generation = future_to_doc[future]
+    async def _bounded(pdf: PdfObject) -> Dict[str, Any]:
+        async with semaphore:
             try:
-                result = future.result()
-                results.append(result)
-                logger.info(f"Completed: {file_name} - Status: {result['status']}")
+                return await _process_single_document_async(
+                    folio_id, pdf.name, pdf.generation, bucket_name, db, writer, pdf.metadata
+                )
             except Exception as e:
-                logger.error(f"Failed to process {file_name}: {e}")
-                results.append({
-                    "file_name": file_name,
-                    "status": "ERROR",
-                    "error": str(e),
-                })
+                logger.error(f"Failed to process {pdf.name}: {e}")
+                return {"file_name": pdf.name, "status": "ERROR", "error": str(e)}
     
-    return results
+    try:
+        results = await asyncio.gather(*(_bounded(pdf) for pdf in documents))
+    finally:
+        await writer.aflush()
+    
+    for result in results:
+        logger.info(f"Completed: {result['file_name']} - Status: {result['status']}")
+    return list(results)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FAN-OUT: Un documento por tarea, repartido entre instancias (DISPATCH_MODE=fanout)
+# El handler del sentinel lista la carpeta y publica un work item por PDF en
+# WORK_TOPIC_NAME; process_document_task procesa cada uno con _process_single_document
+# y un agregador transaccional cierra el folio cuando todos reportaron. Con
+# PUBSUB_EMULATOR_HOST el publisher usa el emulador de Pub/Sub.
+# ═══════════════════════════════════════════════════════════════════════════════
+class _LocalWorkQueue:
+    """Sustituto en proceso del tópico de work items: cada mensaje va al scheduler de la instancia."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+
+    def publish(self, folio_id: str, payload: bytes) -> Future:
+        # Contexto vacío: la tarea no hereda el timer ni el lease del handler que despacha
+        future = contextvars.Context().run(_get_scheduler().submit, folio_id, _handle_work_message, payload)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def join(self, timeout: Optional[float] = None) -> List[Tuple[str, int]]:
+        """Espera los work items publicados hasta ahora y retorna sus respuestas."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        return [future.result(timeout=timeout) for future in futures]
+
+
+def _get_local_work_queue() -> _LocalWorkQueue:
+    return _get_client("local_work_queue", _LocalWorkQueue)
+
+
+def _publish_work_item(item: Dict[str, Any]) -> Any:
+    """Publica un work item y retorna el future de la publicación."""
+    payload = json.dumps(item, ensure_ascii=False).encode("utf-8")
+    if not WORK_TOPIC_NAME:
+        return _get_local_work_queue().publish(item["folio_id"], payload)
+    publisher = _get_publisher_client()
+    topic_path = publisher.topic_path(PROJECT_ID, WORK_TOPIC_NAME)
+    return publisher.publish(topic_path, payload, folio_id=item["folio_id"], file_name=item["name"])
+
+
+def _count_completed_documents(db: firestore.Client, folio_id: str, statuses: Tuple[str, ...] = ("DONE", "ERROR")) -> int:
+    """Cuenta con una agregación count() los documentos que reportaron completitud con esos estados."""
+    documentos = db.collection("folios").document(folio_id).collection("documentos")
+    query = documentos.where(filter=firestore.FieldFilter("completion_status", "in", list(statuses)))
+    return int(query.count(alias="completed").get()[0][0].value)
+
+
+def _clear_completion_status(writer: _FirestoreWriteBatcher, db: firestore.Client, folio_id: str) -> int:
+    """Borra completion_status de los documentos de despachos anteriores del folio.
+
+    En una re-ejecución completa (folio en ERROR o reanudado) no hay diff incremental que
+    marque SUPERSEDED las generations reemplazadas; sin esto seguirían contando para el
+    cierre y el folio podría cerrarse antes de que terminen los work items nuevos. Los
+    documentos que siguen en la carpeta se vuelven a publicar y reportan de nuevo.
+    
+    Returns:
+        Cantidad de documentos limpiados.
+    """
+    documentos = db.collection("folios").document(folio_id).collection("documentos")
+    query = documentos.where(filter=firestore.FieldFilter("completion_status", "in", ["DONE", "ERROR"]))
+    cleared = 0
+    for snap in query.stream():
+        writer.set(snap.reference, {"completion_status": firestore.DELETE_FIELD}, merge=True)
+        cleared += 1
+    writer.flush()
+    return cleared
+
+
+def _finish_folio_if_complete(db: firestore.Client, folio_id: str) -> Optional[str]:
+    """Cierra el folio fan-out si todos sus documentos reportaron completitud.
+
+    El folio no lleva contadores por documento: cada work item deja completion_status en
+    su propio documento (idempotente ante re-entregas; un SUPERSEDED lo borra) y aquí se
+    cuentan con count() una vez terminado el despacho. Solo la transacción que cierra
+    escribe en el documento del folio, así que no hay contención por documento terminado.
+    
+    Returns:
+        Estado final si esta llamada cerró el folio, None en otro caso.
+    """
+    folio_ref = db.collection("folios").document(folio_id)
+    folio = folio_ref.get().to_dict() or {}
+    if folio.get("status") != "PROCESSING" or not folio.get("dispatch_complete"):
+        return None
+    completed = _count_completed_documents(db, folio_id)
+    if completed < folio.get("total_docs", 0):
+        return None
+    errors = _count_completed_documents(db, folio_id, ("ERROR",))
+    final_status = "DONE_WITH_ERRORS" if errors else "DONE"
+    
+    @firestore.transactional
+    def _close(transaction: Any) -> Optional[str]:
+        current = folio_ref.get(transaction=transaction).to_dict() or {}
+        if current.get("status") != "PROCESSING" or not current.get("dispatch_complete"):
+            return None
+        transaction.update(folio_ref, {
+            "status": final_status,
+            "completed_docs": completed,
+            "error_docs": errors,
+            "processed_docs": completed,
+            "finished_at": firestore.SERVER_TIMESTAMP,
+            "last_update_at": firestore.SERVER_TIMESTAMP,
+        })
+        return final_status
+    
+    return _close(db.transaction())
+
+
+def _finish_dispatch(db: firestore.Client, folio_id: str, total_docs: int) -> Optional[str]:
+    """Fija total_docs al terminar el listado; si los documentos ya reportaron, cierra el folio."""
+    db.collection("folios").document(folio_id).update({"total_docs": total_docs, "dispatch_complete": True})
+    return _finish_folio_if_complete(db, folio_id)
+
+
+def _log_fanout_completion(db: firestore.Client, folio_id: str, final_status: str) -> None:
+    folio = db.collection("folios").document(folio_id).get().to_dict() or {}
+    _json_log({
+        "event_type": "folder_processing_complete",
+        "folio_id": folio_id,
+        "bucket": folio.get("bucket", ""),
+        "folder_prefix": folio.get("folder_prefix", ""),
+        "total_docs": folio.get("total_docs", 0),
+        "successful": folio.get("completed_docs", 0) - folio.get("error_docs", 0),
+        "errors": folio.get("error_docs", 0),
+        "final_status": final_status,
+        "dispatch_mode": "fanout",
+        "timestamp": _utc_iso(),
+    })
+
+
+def _dispatch_folder(db: firestore.Client, folio_id: str, bucket_name: str, folder_prefix: str,
+                     known: Optional[Dict[str, Dict[str, Any]]] = None) -> int:
+    """Publica un work item por PDF de la carpeta y retorna el total de documentos.
+
+    Se publican todos los PDFs que pasan el preflight, no solo los pendientes: la tarea de
+    un documento ya DONE termina en el lease (sin Document AI) y solo confirma su
+    completitud. Los rechazados se persisten y reportan completitud aquí mismo.
+    
+    En modo incremental solo se publican los PDFs nuevos o cambiados; los sin cambios
+    reportan completitud sin re-procesarlos y los ausentes se marcan SUPERSEDED. En una
+    re-ejecución completa se borra antes la completitud de los despachos anteriores.
+    """
+    folio_ref = db.collection("folios").document(folio_id)
+    folio_ref.update({"dispatch_mode": "fanout", "dispatch_complete": False, "total_docs": 0})
+    
+    total_docs = 0
+    futures = []
+    writer = _FirestoreWriteBatcher(db, folio_id)
+    documentos = folio_ref.collection("documentos")
+    if known is None:
+        # Confirmado antes de publicar: un work item nuevo no debe perder su completitud
+        cleared = _clear_completion_status(writer, db, folio_id)
+        if cleared:
+            logger.info(f"Cleared completion status of {cleared} documents from a previous dispatch of {folio_id}")
+    previous_extractions = _previous_extractions(known)
+    seen: Set[str] = set()
+    pages = _iter_pdf_pages(bucket_name, folder_prefix)
+    while True:
+        with _timed_stage("list"):
+            page = next(pages, None)
+        if page is None:
+            break
+        total_docs += len(page)
+        if known is not None:
+            page, unchanged = _split_unchanged_documents(folio_id, page, known, seen)
+            # Los sin cambios de una corrida inline aún no tienen completion_status
+            for _, doc_id in unchanged:
+                if known[doc_id].get("completion_status") != known[doc_id]["status"]:
+                    writer.set(documentos.document(doc_id), {"completion_status": known[doc_id]["status"]}, merge=True)
+        with _timed_stage("preflight"):
+            accepted, rejected = _preflight_documents(page)
+            _reject_documents(writer, db, folio_id, bucket_name, rejected)
+            for pdf, _, _ in rejected:
+                doc_id = _make_doc_id(folio_id, pdf.name.split("/")[-1], pdf.generation)
+                writer.set(documentos.document(doc_id), {"completion_status": "ERROR"}, merge=True)
+        with _timed_stage("dispatch"):
+            for pdf in accepted:
+                item = {
+                    "folio_id": folio_id,
+                    "bucket": bucket_name,
+                    "folder_prefix": folder_prefix,
+                    "name": pdf.name,
+                    "generation": pdf.generation,
+                    "size": pdf.size,
+                    "metadata": pdf.metadata,
+                }
+                previous = previous_extractions.get(pdf.name.split("/")[-1])
+                if previous:
+                    item["previous_extraction"] = previous
+                futures.append(_publish_work_item(item))
+    
+    if WORK_TOPIC_NAME:
+        # Publicación confirmada antes de marcar el despacho como completo
+        with _timed_stage("dispatch"):
+            for future in futures:
+                future.result(timeout=30.0)
+    
+    if known is not None:
+        _supersede_documents(writer, db, folio_id, known, seen)
+    writer.flush()
+    
+    final_status = _finish_dispatch(db, folio_id, total_docs)
+    if final_status:
+        _log_fanout_completion(db, folio_id, final_status)
+    return total_docs
+
+
+def _parse_work_item(payload: bytes) -> Dict[str, Any]:
+    """Decodifica un work item; ValueError si está mal formado."""
+    try:
+        item = json.loads(payload)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Malformed work item: {e}")
+    if not isinstance(item, dict):
+        raise ValueError("Malformed work item: not a JSON object")
+    missing = [key for key in ("folio_id", "bucket", "name", "generation") if not item.get(key)]
+    if missing:
+        raise ValueError(f"Work item missing fields: {', '.join(missing)}")
+    return item
+
+
+def _handle_work_message(payload: bytes) -> Tuple[str, int]:
+    return _process_work_item(_parse_work_item(payload))
+
+
+def _process_work_item(item: Dict[str, Any]) -> Tuple[str, int]:
+    """Procesa un work item: documento, escrituras y completitud del folio.
+
+    La completitud (completion_status) se escribe en el mismo lote que el resultado del
+    documento; el folio se cierra contando documentos, sin contadores por work item.
+    503 = reintentar más tarde (otra entrega tiene el lease del documento).
+    """
+    folio_id = item["folio_id"]
+    _LEASE_OWNER.set(f"{INSTANCE_ID}/{uuid.uuid4().hex[:8]}")
+    
+    db = _get_firestore_client()
+    file_id = item["name"].split("/")[-1]
+    previous = item.get("previous_extraction")
+    # processed_docs del folio se fija al cerrarlo: el work item no escribe en el folio
+    writer = _FirestoreWriteBatcher(db, folio_id, {file_id: previous} if previous else None, track_processed=False)
+    result = _process_single_document(
+        folio_id, item["name"], item["generation"], item["bucket"], db, writer, item.get("metadata")
+    )
+    if result["status"] == "LEASED":
+        return "Retry - Document leased by another delivery", 503
+    
+    doc_id = _make_doc_id(folio_id, file_id, item["generation"])
+    doc_ref = db.collection("folios").document(folio_id).collection("documentos").document(doc_id)
+    writer.set(doc_ref, {"completion_status": result["status"]}, merge=True)
+    writer.flush()
+    final_status = _finish_folio_if_complete(db, folio_id)
+    if final_status:
+        logger.info(f"Folio {folio_id} completed by work item - Status: {final_status}")
+        _log_fanout_completion(db, folio_id, final_status)
+    return "OK", 200
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -678,11 +4316,34 @@ def process_folder_on_ready(cloud_event):
     Se activa cuando se crea un archivo 'is_ready' en GCS, lo que indica que
     una carpeta está lista para ser procesada completamente.
     """
+    if _is_discardable_event(cloud_event):
+        return "OK - Not is_ready file", 200
+    try:
+        return _handle_folder_event(cloud_event)
+    finally:
+        _flush_dlq()
+
+
+def _is_discardable_event(cloud_event) -> bool:
+    """Descarte temprano de eventos que no son is_ready, sin parsear el payload.
+
+    El trigger entrega cada object.finalize del bucket (cada PDF subido); el atributo
+    'subject' (objects/<name>) basta para descartarlos sin get_data(), clientes ni logs.
+    Sin subject se sigue el camino completo, que vuelve a validar el nombre del objeto.
+    """
+    subject = cloud_event.get("subject") or ""
+    if not subject.startswith("objects/"):
+        return False
+    return not _is_ready_sentinel(subject[len("objects/"):])[0]
+
+
+def _handle_folder_event(cloud_event):
     try:
         # Parse event data
         event_data = cloud_event.get_data()
         bucket_name = event_data.get("bucket", "")
         object_name = event_data.get("name", "")
+        sentinel_generation = str(event_data.get("generation") or "")
         event_id = cloud_event.get("id", "")
         
         logger.info(f"Event received: {event_id} - Object: {object_name}")
@@ -694,76 +4355,156 @@ def process_folder_on_ready(cloud_event):
             return "OK - Not is_ready file", 200
         
         logger.info(f"Processing folder: {folder_prefix} in bucket: {bucket_name}")
+        # Dueño de los leases de esta entrega (dos entregas en la misma instancia no comparten leases)
+        _LEASE_OWNER.set(f"{INSTANCE_ID}/{uuid.uuid4().hex[:8]}")
         
         # Generar folio_id
         folio_id = _make_folio_id(bucket_name, folder_prefix)
         
-        # Inicializar Firestore
+        # Inicializar Firestore y telemetría
         db = _get_firestore_client()
-        should_process = _ensure_folio_document(db, folio_id, bucket_name, folder_prefix)
-        if not should_process:
+        _get_client("telemetry", configure_telemetry)
+        run_mode = _ensure_folio_document(db, folio_id, bucket_name, folder_prefix, sentinel_generation)
+        if not run_mode:
             return "OK - Already processed", 200
         
-        # Log structured de inicio
-        _json_log({
-            "event_type": "folder_processing_start",
-            "folio_id": folio_id,
-            "bucket": bucket_name,
-            "folder_prefix": folder_prefix,
-            "event_id": event_id,
-            "timestamp": _utc_iso(),
-        })
-        
-        # Listar todos los PDFs en la carpeta
-        documents = _list_pdfs_in_folder(bucket_name, folder_prefix)
-        total_docs = len(documents)
-        
-        logger.info(f"Found {total_docs} PDF documents in folder")
-        
-        # Actualizar total_docs en Firestore
-        db.collection("folios").document(folio_id).update({
-            "total_docs": total_docs,
-        })
-        
-        if total_docs == 0:
-            logger.info("No documents to process")
-            db.collection("folios").document(folio_id).update({
-                "status": "DONE",
-                "finished_at": firestore.SERVER_TIMESTAMP,
+        with _instrumented("folio", {"folio_id": folio_id, "bucket": bucket_name, "folder_prefix": folder_prefix}) as folio_timer:
+            # Log structured de inicio
+            _json_log({
+                "event_type": "folder_processing_start",
+                "folio_id": folio_id,
+                "bucket": bucket_name,
+                "folder_prefix": folder_prefix,
+                "event_id": event_id,
+                "dispatch_mode": DISPATCH_MODE,
+                "run_mode": run_mode,
+                "sentinel_generation": sentinel_generation,
+                "timestamp": _utc_iso(),
             })
-            return "OK - No documents", 200
-        
-        # Procesar documentos en paralelo
-        results = _process_documents_parallel(folio_id, documents, bucket_name, db)
-        
-        # Determinar estado final
-        errors = [r for r in results if r.get("status") == "ERROR"]
-        if errors:
-            final_status = "DONE_WITH_ERRORS"
-        else:
-            final_status = "DONE"
-        
-        # Actualizar estado final del folio
-        db.collection("folios").document(folio_id).update({
-            "status": final_status,
-            "finished_at": firestore.SERVER_TIMESTAMP,
-        })
-        
-        # Log structured de finalización
-        _json_log({
-            "event_type": "folder_processing_complete",
-            "folio_id": folio_id,
-            "bucket": bucket_name,
-            "folder_prefix": folder_prefix,
-            "total_docs": total_docs,
-            "successful": len([r for r in results if r.get("status") == "DONE"]),
-            "errors": len(errors),
-            "final_status": final_status,
-            "timestamp": _utc_iso(),
-        })
-        
-        logger.info(f"Folder processing complete - Status: {final_status}")
-        return "OK", 200
+            
+            # Modo incremental: una sola consulta con lo ya registrado para el diff contra el listado
+            known = None
+            if run_mode == "incremental":
+                with folio_timer.stage("diff"):
+                    known = _load_folio_documents(db, folio_id)
+            
+            if DISPATCH_MODE == "fanout":
+                total_docs = _dispatch_folder(db, folio_id, bucket_name, folder_prefix, known)
+                _json_log({
+                    "event_type": "folder_dispatch_done",
+                    "folio_id": folio_id,
+                    "total_docs": total_docs,
+                    **folio_timer.summary(),
+                    "timestamp": _utc_iso(),
+                })
+                return "OK - Dispatched", 200
+            
+            # Listado en streaming: los documentos entran al pool mientras llegan más páginas.
+            # total_docs se recalcula de forma incremental por página.
+            folio_ref = db.collection("folios").document(folio_id)
+            folio_ref.update({"total_docs": 0})
+            listing: Dict[str, Any] = {"total_docs": 0, "cached_results": [], "rejected_results": [], "superseded": 0}
+            previous_extractions = _previous_extractions(known)
+            writer = _FirestoreWriteBatcher(db, folio_id, previous_extractions)
+            pending_iter = _stream_pending_documents(db, folio_id, bucket_name, folder_prefix, listing, writer, known)
+            use_batch, pending_iter = _split_batch_candidates(pending_iter)
+            
+            if use_batch:
+                new_results = _process_documents_batch(folio_id, list(pending_iter), bucket_name, db, writer)
+            elif EXECUTION_MODE == "asyncio":
+                pending = list(pending_iter)
+                new_results = _run_async(
+                    _process_documents_async(folio_id, pending, bucket_name, previous_extractions)
+                ) if pending else []
+            else:
+                new_results = _process_documents_parallel(folio_id, pending_iter, bucket_name, db, writer)
+            
+            total_docs = listing["total_docs"]
+            results = listing["cached_results"] + listing["rejected_results"] + new_results
+            logger.info(f"Found {total_docs} PDF documents in folder")
+            
+            # Documentos que procesa otra entrega: el folio no se cierra mientras sigan con lease
+            leased = [r["pdf"] for r in results if r.get("status") == "LEASED"]
+            results = [r for r in results if r.get("status") != "LEASED"]
+            if leased:
+                resolved, leased = _await_leased_documents(folio_id, leased, bucket_name, db, writer)
+                results += resolved
+            if leased:
+                writer.flush()
+                _json_log({
+                    "event_type": "folder_processing_deferred",
+                    "folio_id": folio_id,
+                    "leased_docs": len(leased),
+                    "completed_docs": len(results),
+                    "timestamp": _utc_iso(),
+                })
+                # Reintento de Eventarc: si la otra entrega cae, la re-entrega retoma sus documentos
+                return "Deferred - Documents leased by another delivery", 503
+            _json_log({
+                "event_type": "folder_precheck_done",
+                "folio_id": folio_id,
+                "total_docs": total_docs,
+                "already_processed": len(listing["cached_results"]),
+                "rejected": len(listing["rejected_results"]),
+                "superseded": listing["superseded"],
+                "pending": len(new_results),
+                "timestamp": _utc_iso(),
+            })
+            
+            if total_docs == 0:
+                logger.info("No documents to process")
+                # En modo incremental el writer puede traer documentos marcados SUPERSEDED
+                writer.flush({
+                    "status": "DONE",
+                    "total_docs": 0,
+                    "finished_at": firestore.SERVER_TIMESTAMP,
+                })
+                return "OK - No documents", 200
+            
+            # Determinar estado final
+            errors = [r for r in results if r.get("status") == "ERROR"]
+            if errors:
+                final_status = "DONE_WITH_ERRORS"
+            else:
+                final_status = "DONE"
+            folio_timer.status = final_status
+            
+            # Documentos clasificados sin llamar al Classifier (pre-clasificación local)
+            fast_path_docs = len([
+                r for r in results
+                if not r.get("from_cache") and r.get("classification_source", "classifier") != "classifier"
+            ])
+            classified_docs = len([r for r in results if not r.get("from_cache") and r.get("status") == "DONE"])
+            
+            # Vaciar escrituras pendientes y actualizar estado final del folio en el mismo commit
+            with folio_timer.stage("commit"):
+                writer.flush({
+                    "status": final_status,
+                    "total_docs": total_docs,
+                    "finished_at": firestore.SERVER_TIMESTAMP,
+                    "fast_path_docs": fast_path_docs,
+                })
+            
+            # Log structured de finalización
+            _json_log({
+                "event_type": "folder_processing_complete",
+                "folio_id": folio_id,
+                "bucket": bucket_name,
+                "folder_prefix": folder_prefix,
+                "total_docs": total_docs,
+                "successful": len([r for r in results if r.get("status") == "DONE"]),
+                "errors": len(errors),
+                "fast_path_docs": fast_path_docs,
+                "fast_path_ratio": round(fast_path_docs / classified_docs, 3) if classified_docs else 0.0,
+                "final_status": final_status,
+                "run_mode": run_mode,
+                **folio_timer.summary(),
+                "scheduler": _get_scheduler().stats() if EXECUTION_MODE != "asyncio" else None,
+                "timestamp": _utc_iso(),
+            })
+            
+            logger.info(f"Folder processing complete - Status: {final_status}")
+            return "OK", 200
         
     except Exception as e:
         logger.error(f"Fatal error processing folder: {e}")
@@ -773,3 +4514,43 @@ def process_folder_on_ready(cloud_event):
             "timestamp": _utc_iso(),
         })
         return f"Error: {e}", 500
+
+
+@functions_framework.cloud_event
+def process_document_task(cloud_event: CloudEvent) -> None:
+    """
+    Punto de entrada del modo fan-out: procesa un documento publicado en WORK_TOPIC_NAME.
+    
+    Se activa con un trigger Eventarc de Pub/Sub (messagePublished). functions_framework
+    ignora el valor de retorno de una función CloudEvent: para que Pub/Sub re-entregue el
+    mensaje (otra entrega tiene el lease del documento, o falló el procesamiento) se lanza
+    la excepción y el framework responde 500.
+    """
+    try:
+        message = (cloud_event.get_data() or {}).get("message", {})
+        item = _parse_work_item(base64.b64decode(message.get("data", "")))
+    except (ValueError, TypeError, AttributeError) as e:
+        # Mensaje mal formado: se confirma para que no se re-entregue indefinidamente
+        logger.error(f"Invalid work item: {e}")
+        return
+    # Cualquier error al procesar (incluido KeyError) se propaga para que Pub/Sub re-entregue
+    try:
+        _get_client("telemetry", configure_telemetry)
+        result, status_code = _process_work_item(item)
+    except Exception as e:
+        logger.error(f"Fatal error processing work item: {e}")
+        _json_log({
+            "event_type": "document_task_error",
+            "error": str(e),
+            "timestamp": _utc_iso(),
+        })
+        raise
+    finally:
+        _flush_dlq()
+    if status_code >= 500:
+        raise AppError(
+            code="DOCUMENT_LEASED",
+            message=result,
+            stage="LEASE",
+            details={"folio_id": item["folio_id"], "name": item["name"]}
+        )
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark de arranque en frío del microservicio.
+
+Cada corrida es un intérprete nuevo (como una instancia de Cloud Run que escala desde
+cero) y mide:
+
+- import del módulo: lo que paga cada cold start antes de atender el primer evento
+- primera respuesta a un evento que no es is_ready (se descarta sin tocar GCP)
+- primera respuesta a un is_ready de 3 PDFs con los dobles de fakes.py; incluye la
+  carga diferida de las librerías cliente de GCP
+
+También verifica que el import no cargue las librerías pesadas (Document AI, Firestore,
+Storage, Pub/Sub, api_core/grpc, asyncio): si alguna aparece, o si el import supera
+--max-import-ms, termina con código 1 para usarse como guardia de regresiones.
+
+Uso:
+    python benchmarks/bench_cold_start.py --runs 5
+    python benchmarks/bench_cold_start.py --max-import-ms 400 --json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Módulos que no deben cargarse al importar el servicio
+DEFERRED_MODULES = [
+    "google.cloud.documentai_v1",
+    "google.cloud.firestore",
+    "google.cloud.storage",
+    "google.cloud.pubsub_v1",
+    "google.api_core.exceptions",
+    "grpc",
+    "asyncio",
+]
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Tiempo de import y de primera respuesta en frío")
+    parser.add_argument("--runs", type=int, default=5, help="Intérpretes nuevos por medición")
+    parser.add_argument("--max-import-ms", type=float, default=0.0,
+                        help="Falla si la mediana del import supera este valor (0 = sin límite)")
+    parser.add_argument("--json", action="store_true", help="Imprimir el reporte como JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def _child() -> None:
+    """Una corrida en frío; imprime sus tiempos como JSON en stdout."""
+    os.environ.setdefault("GCP_PROJECT_ID", "bench-project")
+    os.environ.setdefault("DOCAI_RATE_LIMIT_QPS", "0")
+    sys.path.insert(0, REPO_ROOT)
+    sys.path.insert(0, BENCH_DIR)
+
+    started = time.perf_counter()
+    import apolo_procesamiento_inteligente as service
+    import_ms = (time.perf_counter() - started) * 1000
+    loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+
+    from cloudevents.http import CloudEvent
+
+    def _event(name: str) -> CloudEvent:
+        attributes = {
+            "type": "google.cloud.storage.object.v1.finalized",
+            "source": "//storage.googleapis.com/projects/_/buckets/cold-bucket",
+            "id": f"cold-{name}",
+            "subject": f"objects/{name}",
+        }
+        return CloudEvent(attributes, {"bucket": "cold-bucket", "name": name, "generation": "1"})
+
+    non_sentinel = _event("folio/doc_00001.pdf")
+    started = time.perf_counter()
+    service.process_folder_on_ready(non_sentinel)
+    reject_ms = (time.perf_counter() - started) * 1000
+    loaded_after_reject = [name for name in DEFERRED_MODULES if name in sys.modules]
+
+    started = time.perf_counter()
+    import fakes
+    stats = fakes.StatsRecorder()
+    storage = fakes.FakeStorageClient(stats)
+    db = fakes.FakeFirestore(stats)
+    service._CLIENTS.update({
+        "storage": storage,
+        "firestore": db,
+        "documentai": fakes.FakeDocumentAI(stats, latency=0.0, seed=7),
+        "publisher": fakes.FakePublisher(stats),
+    })
+    bucket = storage.bucket("cold-bucket")
+    for i in range(3):
+        bucket.add(f"folio/doc_{i:05d}.pdf", b"%PDF-1.7\n% cold start " + str(i).encode() * 64, generation=10 + i)
+    bucket.add("folio/is_ready", b"", generation=1, content_type=None)
+    status = service.process_folder_on_ready(_event("folio/is_ready"))
+    sentinel_ms = (time.perf_counter() - started) * 1000
+
+    print(json.dumps({
+        "import_ms": import_ms,
+        "reject_ms": reject_ms,
+        "sentinel_ms": sentinel_ms,
+        "loaded_on_import": loaded,
+        "loaded_after_reject": loaded_after_reject,
+        "sentinel_status": status[1] if isinstance(status, tuple) else status,
+    }))
+
+
+def _run_child() -> Dict[str, Any]:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        check=True, capture_output=True, text=True, cwd=REPO_ROOT,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def main() -> int:
+    args = _parse_args()
+    if args.child:
+        _child()
+        return 0
+
+    runs: List[Dict[str, Any]] = [_run_child() for _ in range(args.runs)]
+    metrics = ("import_ms", "reject_ms", "sentinel_ms", "process_ms")
+    report: Dict[str, Any] = {
+        "runs": args.runs,
+        "python": sys.version.split()[0],
+        **{
+            name: {
+                "p50": round(statistics.median(run[name] for run in runs), 1),
+                "max": round(max(run[name] for run in runs), 1),
+            }
+            for name in metrics
+        },
+        "loaded_on_import": sorted({m for run in runs for m in run["loaded_on_import"]}),
+        "loaded_after_reject": sorted({m for run in runs for m in run["loaded_after_reject"]}),
+        "sentinel_status": sorted({run["sentinel_status"] for run in runs}),
+    }
+    failures = []
+    if report["loaded_on_import"]:
+        failures.append(f"módulos pesados cargados en el import: {', '.join(report['loaded_on_import'])}")
+    if args.max_import_ms and report["import_ms"]["p50"] > args.max_import_ms:
+        failures.append(f"import p50 {report['import_ms']['p50']} ms > {args.max_import_ms} ms")
+    report["failures"] = failures
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Python {report['python']}  Corridas: {args.runs}")
+        labels = {
+            "import_ms": "import del módulo",
+            "reject_ms": "1ª respuesta (no is_ready)",
+            "sentinel_ms": "1ª respuesta (is_ready, 3 PDFs)",
+            "process_ms": "proceso completo",
+        }
+        print(f"\n  {'medición':<34} {'p50 ms':>9} {'max ms':>9}")
+        for name in metrics:
+            print(f"  {labels[name]:<34} {report[name]['p50']:>9} {report[name]['max']:>9}")
+        print(f"\nCargados en el import: {', '.join(report['loaded_on_import']) or 'ninguno'}")
+        print(f"Cargados tras descartar un evento: {', '.join(report['loaded_after_reject']) or 'ninguno'}")
+        for failure in failures:
+            print(f"FALLA: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
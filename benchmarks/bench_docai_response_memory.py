@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmark de memoria de las respuestas de Document AI, con y sin field mask.
+
+Construye la respuesta que devolvería Document AI para el Classifier y el Extractor
+(OCR, tokens, líneas, párrafos e imagen por página), la serializa como llega por la
+red y mide por documento, al deserializarla y convertirla con _parse_classification /
+_parse_extraction:
+
+- pico del heap de Python (tracemalloc)
+- memoria residente por respuesta en vuelo (RSS con --inflight respuestas retenidas, como
+  los workers concurrentes); incluye el arena de upb, que tracemalloc no ve
+
+La variante "masked" recibe la respuesta recortada por CLASSIFIER_FIELD_MASK /
+EXTRACTOR_FIELD_MASK.
+
+Uso:
+    python benchmarks/bench_docai_response_memory.py --pages 10 --tokens 600
+    PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python \\
+        python benchmarks/bench_docai_response_memory.py   # protobuf puro: todo queda en tracemalloc
+"""
+
+import argparse
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Pico de memoria por respuesta de Document AI")
+    parser.add_argument("--docs", type=int, default=20, help="Respuestas deserializadas por variante")
+    parser.add_argument("--pages", type=int, default=5, help="Páginas por documento")
+    parser.add_argument("--tokens", type=int, default=400, help="Tokens OCR por página")
+    parser.add_argument("--image-kb", type=int, default=64, help="Tamaño de la imagen de cada página en KB")
+    parser.add_argument("--entities", type=int, default=60, help="Entidades devueltas por el extractor")
+    parser.add_argument("--inflight", type=int, default=8,
+                        help="Respuestas retenidas a la vez para medir RSS (≈ MAX_CONCURRENT_DOCS)")
+    parser.add_argument("--json", action="store_true", help="Imprimir el reporte como JSON")
+    return parser.parse_args()
+
+
+def _rss_kb() -> float:
+    # /proc/self/statm: páginas residentes en el segundo campo (solo Linux)
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+    except (OSError, ValueError):
+        return 0.0
+
+
+def _measure(wire: bytes, parse: Callable[[Any], Any], docs: int, inflight: int) -> Dict[str, float]:
+    """Pico de memoria (sobre la línea base) y tiempo de deserializar + parsear una respuesta."""
+    from google.cloud import documentai_v1 as documentai
+    peaks: List[int] = []
+    seconds: List[float] = []
+    held: List[Any] = []
+    gc.collect()
+    rss_before = _rss_kb()
+    tracemalloc.start()
+    try:
+        for _ in range(max(docs, inflight)):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            started = time.perf_counter()
+            # Cada respuesta llega en su propio buffer, como la entrega gRPC
+            response = documentai.ProcessResponse.deserialize(bytes(memoryview(wire)))
+            parsed = parse(response.document)
+            seconds.append(time.perf_counter() - started)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            if len(held) < inflight:
+                held.append((response, parsed))
+            del response, parsed
+    finally:
+        tracemalloc.stop()
+    rss_per_doc = (_rss_kb() - rss_before) / inflight if inflight else 0.0
+    del held
+    gc.collect()
+    return {
+        "wire_kb": round(len(wire) / 1024, 1),
+        "peak_kb_p50": round(statistics.median(peaks) / 1024, 1),
+        "peak_kb_max": round(max(peaks) / 1024, 1),
+        "rss_kb_per_inflight_doc": round(max(0.0, rss_per_doc), 1),
+        "decode_parse_ms_p50": round(statistics.median(seconds) * 1000, 2),
+    }
+
+
+def main() -> int:
+    args = _parse_args()
+    os.environ.setdefault("GCP_PROJECT_ID", "bench-project")
+
+    import fakes
+    import apolo_procesamiento_inteligente as service
+    from google.cloud import documentai_v1 as documentai
+
+    docai = fakes.FakeDocumentAI(fakes.StatsRecorder(), latency=0.0, entities_per_doc=args.entities,
+                                 pages_per_doc=args.pages, seed=7)
+    calls = {
+        "classifier": (
+            fakes.add_page_layout(docai._build_document("classify", 0.1), args.tokens, args.image_kb),
+            service.CLASSIFIER_FIELD_MASK,
+            lambda document: service._parse_classification(document, "classifier"),
+        ),
+        "extractor": (
+            fakes.add_page_layout(docai._build_document("extract", 0.1), args.tokens, args.image_kb),
+            service.EXTRACTOR_FIELD_MASK,
+            lambda document: service._parse_extraction(document, "extractor", "ESTADO_RESULTADOS"),
+        ),
+    }
+
+    from google.protobuf.internal import api_implementation
+    report: Dict[str, Any] = {
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "protobuf_backend": api_implementation.Type(),
+    }
+    for call, (document, mask, parse) in calls.items():
+        full = documentai.ProcessResponse.serialize(documentai.ProcessResponse(document=document))
+        masked = documentai.ProcessResponse.serialize(
+            documentai.ProcessResponse(document=fakes.apply_field_mask(document, mask))
+        )
+        # masked primero: la variante full no hereda memoria ya reservada por el proceso
+        report[call] = {"field_mask": mask}
+        report[call]["masked"] = _measure(masked, parse, args.docs, args.inflight)
+        report[call]["full"] = _measure(full, parse, args.docs, args.inflight)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print(f"Páginas: {args.pages}  Tokens/página: {args.tokens}  Imagen: {args.image_kb} KB  "
+          f"Entidades: {args.entities}  Muestras: {args.docs}  protobuf: {report['protobuf_backend']}")
+    print(f"\n  {'llamada':<12} {'variante':<8} {'wire KB':>9} {'heap p50 KB':>12} {'heap max KB':>12} "
+          f"{'RSS/doc KB':>11} {'ms p50':>8}")
+    for call in calls:
+        for variant in ("full", "masked"):
+            row = report[call][variant]
+            print(f"  {call:<12} {variant:<8} {row['wire_kb']:>9} {row['peak_kb_p50']:>12} "
+                  f"{row['peak_kb_max']:>12} {row['rss_kb_per_inflight_doc']:>11} {row['decode_parse_ms_p50']:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmark del descarte de eventos que no son is_ready.
+
+El trigger de Eventarc entrega cada object.finalize del bucket; en buckets con mucho
+tráfico casi todos son PDFs subidos que el servicio descarta. Mide el costo por evento
+descartado en tres niveles:
+
+- fast:   process_folder_on_ready (descarte por el atributo subject, sin get_data ni logs)
+- parsed: _handle_folder_event (camino completo: get_data, logs y validación del nombre)
+- http:   POST CloudEvent en modo binario a la app de functions-framework (Flask), es decir
+          lo que cuesta cada entrega a la instancia incluyendo el framework
+
+Con µs/evento y la tasa de eventos del bucket se estima el CPU que consume el descarte
+en proceso (--events-per-sec) para compararlo con filtrar antes de que llegue al servicio.
+
+Uso:
+    python benchmarks/bench_event_rejection.py --events 20000
+    python benchmarks/bench_event_rejection.py --events-per-sec 50 --json
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Throughput del descarte de eventos no is_ready")
+    parser.add_argument("--events", type=int, default=10000, help="Eventos descartados por variante")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeticiones por variante (se reporta la mediana)")
+    parser.add_argument("--events-per-sec", type=float, default=20.0,
+                        help="Tasa de object.finalize del bucket para estimar vCPU en uso")
+    parser.add_argument("--json", action="store_true", help="Imprimir el reporte como JSON")
+    return parser.parse_args()
+
+
+def _attributes(i: int) -> Dict[str, str]:
+    name = f"PRE-2025-{i % 97:03d}/doc_{i:06d}.pdf"
+    return {
+        "specversion": "1.0",
+        "type": "google.cloud.storage.object.v1.finalized",
+        "source": "//storage.googleapis.com/projects/_/buckets/bench-bucket",
+        "id": f"evt-{i}",
+        "subject": f"objects/{name}",
+    }
+
+
+def _payload(i: int) -> Dict[str, Any]:
+    # Forma del StorageObjectData que entrega Eventarc (campos más comunes)
+    name = f"PRE-2025-{i % 97:03d}/doc_{i:06d}.pdf"
+    return {
+        "kind": "storage#object",
+        "id": f"bench-bucket/{name}/{1700000000000000 + i}",
+        "bucket": "bench-bucket",
+        "name": name,
+        "generation": str(1700000000000000 + i),
+        "metageneration": "1",
+        "contentType": "application/pdf",
+        "size": str(150000 + i),
+        "md5Hash": "1B2M2Y8AsgTpgAmY7PhCfg==",
+        "crc32c": "AAAAAA==",
+        "storageClass": "STANDARD",
+        "timeCreated": "2025-01-01T00:00:00.000Z",
+        "updated": "2025-01-01T00:00:00.000Z",
+    }
+
+
+def _time_variant(call: Callable[[int], Any], events: int, repeats: int) -> Dict[str, float]:
+    rates: List[float] = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for i in range(events):
+            call(i)
+        rates.append(events / (time.perf_counter() - started))
+    rate = statistics.median(rates)
+    return {"events_per_sec": round(rate, 1), "us_per_event": round(1e6 / rate, 2)}
+
+
+def main() -> int:
+    args = _parse_args()
+    os.environ.setdefault("GCP_PROJECT_ID", "bench-project")
+
+    import apolo_procesamiento_inteligente as service
+    from cloudevents.http import CloudEvent
+    import functions_framework
+
+    events = [CloudEvent(_attributes(i), _payload(i)) for i in range(args.events)]
+    app = functions_framework.create_app(
+        target="process_folder_on_ready",
+        source=os.path.join(REPO_ROOT, "apolo_procesamiento_inteligente.py"),
+        signature_type="cloudevent",
+    )
+    client = app.test_client()
+
+    # Los logs del camino completo se escriben como en producción, pero a /dev/null
+    # (después de create_app: cargar el source vuelve a ejecutar logging.basicConfig)
+    devnull = open(os.devnull, "w")
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(devnull)
+
+    bodies = [json.dumps(_payload(i)).encode() for i in range(args.events)]
+    headers = [
+        {f"ce-{key}": value for key, value in _attributes(i).items()} | {"Content-Type": "application/json"}
+        for i in range(args.events)
+    ]
+
+    def _http(i: int) -> None:
+        response = client.post("/", data=bodies[i], headers=headers[i])
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+    variants: Dict[str, Callable[[int], Any]] = {
+        "fast": lambda i: service.process_folder_on_ready(events[i]),
+        "parsed": lambda i: service._handle_folder_event(events[i]),
+        "http": _http,
+    }
+    report: Dict[str, Any] = {
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "initialized_clients": [],
+    }
+    for name, call in variants.items():
+        report[name] = _time_variant(call, args.events, args.repeats)
+        # vCPU ocupados en promedio solo para descartar eventos a la tasa indicada
+        report[name]["vcpu_at_rate"] = round(args.events_per_sec * report[name]["us_per_event"] / 1e6, 5)
+    report["initialized_clients"] = sorted(service._CLIENTS)
+    devnull.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print(f"Eventos: {args.events}  Repeticiones: {args.repeats}  Tasa del bucket: {args.events_per_sec}/s")
+    print(f"\n  {'variante':<8} {'eventos/s':>12} {'µs/evento':>11} {'vCPU a la tasa':>15}")
+    for name in variants:
+        row = report[name]
+        print(f"  {name:<8} {row['events_per_sec']:>12} {row['us_per_event']:>11} {row['vcpu_at_rate']:>15}")
+    print(f"\nClientes inicializados: {', '.join(report['initialized_clients']) or 'ninguno'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Benchmark del pipeline completo de process_folder_on_ready con dobles locales.
+
+Genera carpetas sintéticas en un GCS en memoria, ejecuta el entry point real y
+reporta throughput (docs/seg), percentiles por etapa del pipeline (las duraciones
+que mide _StageTimer en el servicio), pico de RSS y llamadas a APIs por documento. Document AI se simula con latencia, tasa de errores y 429
+configurables; Firestore puede ser el doble en memoria o el emulador local.
+
+Uso:
+    python benchmarks/bench_folder_pipeline.py --docs 200 --latency 0.3
+    python benchmarks/bench_folder_pipeline.py --mode asyncio --throttle-rate 0.05
+    python benchmarks/bench_folder_pipeline.py --dispatch fanout
+    FIRESTORE_EMULATOR_HOST=localhost:8080 \\
+        python benchmarks/bench_folder_pipeline.py --firestore emulator
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BUCKET = "bench-bucket"
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark de process_folder_on_ready con dobles locales")
+    parser.add_argument("--docs", type=int, default=100, help="PDFs por carpeta")
+    parser.add_argument("--folders", type=int, default=3, help="Carpetas a procesar (una invocación cada una)")
+    parser.add_argument("--doc-kb", type=int, default=200, help="Tamaño de cada PDF sintético en KB")
+    parser.add_argument("--pages", type=int, default=3, help="Páginas por documento")
+    parser.add_argument("--entities", type=int, default=40, help="Entidades devueltas por el extractor")
+    parser.add_argument("--typed-names", type=float, default=0.0,
+                        help="Fracción de archivos cuyo nombre revela el tipo de documento")
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia media de Document AI (seg)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Variación uniforme de latencia (seg)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de 503 por llamada")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probabilidad de 429 por llamada")
+    parser.add_argument("--gcs-latency", type=float, default=0.005, help="Latencia por descarga de GCS (seg)")
+    parser.add_argument("--firestore-latency", type=float, default=0.002, help="Latencia por RPC de Firestore (seg)")
+    parser.add_argument("--firestore", choices=["memory", "emulator"], default="memory")
+    parser.add_argument("--mode", choices=["threads", "asyncio"], default=None,
+                        help="EXECUTION_MODE (por defecto el del entorno)")
+    parser.add_argument("--dispatch", choices=["inline", "fanout"], default=None,
+                        help="DISPATCH_MODE; fanout usa la cola de work items en proceso")
+    parser.add_argument("--concurrency", type=int, default=None, help="MAX_CONCURRENT_DOCS")
+    parser.add_argument("--qps", type=float, default=0.0,
+                        help="DOCAI_RATE_LIMIT_QPS (0 = sin límite, para medir el pipeline)")
+    parser.add_argument("--page-layout", action="store_true",
+                        help="Respuestas de Document AI con OCR, tokens e imágenes (recortadas por field mask)")
+    parser.add_argument("--no-field-mask", action="store_true", help="DOCAI_FIELD_MASK_ENABLED=false")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="Imprimir el reporte como JSON")
+    return parser.parse_args()
+
+
+def _configure_env(args: argparse.Namespace) -> None:
+    """Las variables se leen al importar el módulo, así que se fijan antes."""
+    os.environ.setdefault("GCP_PROJECT_ID", "bench-project")
+    os.environ["DOCAI_RATE_LIMIT_QPS"] = str(args.qps)
+    os.environ.setdefault("RETRY_INITIAL_DELAY", "0.05")
+    os.environ.setdefault("RETRY_MAX_DELAY", "0.5")
+    if args.mode:
+        os.environ["EXECUTION_MODE"] = args.mode
+    if args.dispatch:
+        os.environ["DISPATCH_MODE"] = args.dispatch
+    if os.environ.get("DISPATCH_MODE", "").lower() == "fanout":
+        # Sin tópico los work items van a la cola en proceso y se esperan con join()
+        os.environ["WORK_TOPIC_NAME"] = ""
+    if args.no_field_mask:
+        os.environ["DOCAI_FIELD_MASK_ENABLED"] = "false"
+    if args.concurrency:
+        os.environ["MAX_CONCURRENT_DOCS"] = str(args.concurrency)
+        os.environ["ASYNC_MAX_CONCURRENT_DOCS"] = str(args.concurrency)
+    if args.firestore == "emulator" and not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("--firestore emulator requiere FIRESTORE_EMULATOR_HOST")
+
+
+def _synthetic_pdf(tag: str, size: int) -> bytes:
+    # El tag hace único el contenido para que la caché por hash no oculte llamadas
+    header = f"%PDF-1.7\n% bench document {tag}\n".encode()
+    body = (f"BT /F1 12 Tf ({tag}) Tj ET\n".encode()) * (max(0, size - len(header)) // 24 + 1)
+    return (header + body)[:size]
+
+
+def _populate_folder(storage, prefix: str, args: argparse.Namespace) -> None:
+    bucket = storage.bucket(BUCKET)
+    typed_every = int(round(1 / args.typed_names)) if args.typed_names > 0 else 0
+    for i in range(args.docs):
+        if typed_every and i % typed_every == 0:
+            name = f"{prefix}/estado_de_resultados_{i:05d}.pdf"
+        else:
+            name = f"{prefix}/doc_{i:05d}.pdf"
+        bucket.add(name, _synthetic_pdf(f"{prefix}/{i}", args.doc_kb * 1024), generation=1000 + i)
+    bucket.add(f"{prefix}/is_ready", b"", generation=1, content_type=None)
+
+
+def _event(prefix: str):
+    from cloudevents.http import CloudEvent
+    attributes = {
+        "type": "google.cloud.storage.object.v1.finalized",
+        "source": f"//storage.googleapis.com/projects/_/buckets/{BUCKET}",
+        "id": f"bench-{prefix}",
+        "subject": f"objects/{prefix}/is_ready",
+    }
+    return CloudEvent(attributes, {"bucket": BUCKET, "name": f"{prefix}/is_ready", "generation": "1"})
+
+
+def _record_stage_durations(service) -> Dict[str, List[float]]:
+    """Reemplaza _StageTimer por una subclase que guarda el total de cada etapa al cerrarse.
+
+    Las claves son "<scope>.<etapa>" (document.extract, folio.list, ...). Se registra solo
+    lo medido por el propio timer: lo que el folio suma de sus documentos no se duplica.
+    Las etapas medidas fuera de stage() (espera en el scheduler) son una muestra por tarea.
+    """
+    samples: Dict[str, List[float]] = defaultdict(list)
+    samples_lock = threading.Lock()
+
+    class _RecordingTimer(service._StageTimer):
+        def __init__(self, scope: str, attributes: Dict[str, Any]):
+            super().__init__(scope, attributes)
+            self.own: Dict[str, float] = {}
+
+        def _add_own(self, name: str, seconds: float) -> None:
+            with self._lock:
+                self.own[name] = self.own.get(name, 0.0) + seconds
+
+        @contextlib.contextmanager
+        def stage(self, name: str) -> Iterator[None]:
+            started = time.monotonic()
+            try:
+                with super().stage(name):
+                    yield
+            finally:
+                self._add_own(name, time.monotonic() - started)
+
+        def add_duration(self, name: str, seconds: float) -> None:
+            super().add_duration(name, seconds)
+            with samples_lock:
+                samples[f"{self.scope}.{name}"].append(seconds)
+
+        def finish(self, parent) -> None:
+            super().finish(parent)
+            with samples_lock:
+                for name, seconds in self.own.items():
+                    samples[f"{self.scope}.{name}"].append(seconds)
+                samples[f"{self.scope}.total"].append(self.elapsed())
+
+    service._StageTimer = _RecordingTimer
+    return samples
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _folio_status(service, folio_id: str) -> str:
+    folio = service._get_firestore_client().collection("folios").document(folio_id).get().to_dict() or {}
+    return folio.get("status", "MISSING")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def main() -> int:
+    args = _parse_args()
+    _configure_env(args)
+
+    import fakes
+    import apolo_procesamiento_inteligente as service
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stats = fakes.StatsRecorder()
+    storage = fakes.FakeStorageClient(stats, download_latency=args.gcs_latency)
+    docai = fakes.FakeDocumentAI(stats, latency=args.latency, latency_jitter=args.jitter,
+                                 error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                 entities_per_doc=args.entities, pages_per_doc=args.pages, seed=args.seed,
+                                 page_layout=args.page_layout)
+    docai_async = fakes.FakeDocumentAIAsync(stats, latency=args.latency, latency_jitter=args.jitter,
+                                            error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                            entities_per_doc=args.entities, pages_per_doc=args.pages,
+                                            seed=args.seed, page_layout=args.page_layout)
+    service._CLIENTS.update({
+        "storage": storage,
+        "documentai": docai,
+        "documentai_async": docai_async,
+        "publisher": fakes.FakePublisher(stats),
+    })
+    if args.firestore == "memory":
+        db = fakes.FakeFirestore(stats, latency=args.firestore_latency)
+        service._CLIENTS["firestore"] = db
+        service._CLIENTS["firestore_async"] = fakes.FakeAsyncFirestore(db)
+    stage_samples = _record_stage_durations(service)
+
+    folder_seconds: List[float] = []
+    statuses: List[Any] = []
+    work_statuses: List[Any] = []
+    folio_ids: List[str] = []
+    started = time.perf_counter()
+    for n in range(args.folders):
+        prefix = f"bench/folio_{int(time.time())}_{n:03d}"
+        _populate_folder(storage, prefix, args)
+        t0 = time.perf_counter()
+        statuses.append(service.process_folder_on_ready(_event(prefix)))
+        if service.DISPATCH_MODE == "fanout":
+            # La carpeta termina cuando el último work item cierra el folio
+            work_statuses.extend(service._get_local_work_queue().join())
+        folder_seconds.append(time.perf_counter() - t0)
+        folio_ids.append(service._make_folio_id(BUCKET, prefix))
+    elapsed = time.perf_counter() - started
+
+    total_docs = args.docs * args.folders
+    stages: Dict[str, Dict[str, float]] = {}
+    for stage, samples in sorted(stage_samples.items()):
+        stages[stage] = {
+            "count": len(samples),
+            "p50_ms": round(_percentile(samples, 50) * 1000, 2),
+            "p95_ms": round(_percentile(samples, 95) * 1000, 2),
+            "p99_ms": round(_percentile(samples, 99) * 1000, 2),
+        }
+    stages["folder"] = {
+        "count": len(folder_seconds),
+        "p50_ms": round(_percentile(folder_seconds, 50) * 1000, 2),
+        "p95_ms": round(_percentile(folder_seconds, 95) * 1000, 2),
+        "p99_ms": round(_percentile(folder_seconds, 99) * 1000, 2),
+    }
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "execution_mode": service.EXECUTION_MODE,
+        "dispatch_mode": service.DISPATCH_MODE,
+        "total_docs": total_docs,
+        "elapsed_seconds": round(elapsed, 3),
+        "docs_per_second": round(total_docs / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "responses": sorted({f"{status[1]} {status[0]}" for status in statuses}),
+        "work_item_responses": sorted({f"{status[1]} {status[0]}" for status in work_statuses}),
+        "folio_statuses": sorted({_folio_status(service, folio_id) for folio_id in folio_ids}),
+        "api_calls_per_doc": {
+            name: round(count / total_docs, 3)
+            for name, count in sorted(stats.calls.items())
+            if not name.startswith("gcs.bytes")
+        },
+        "bytes_downloaded": stats.calls.get("gcs.bytes_downloaded", 0),
+        "stages": stages,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print(f"Modo: {report['execution_mode']}  Despacho: {report['dispatch_mode']}  Docs: {total_docs}  Carpetas: {args.folders}")
+    print(f"Tiempo total: {report['elapsed_seconds']}s  Throughput: {report['docs_per_second']} docs/s")
+    print(f"Pico RSS: {report['peak_rss_mb']} MB  Respuestas: {', '.join(report['responses'])}")
+    if report["work_item_responses"]:
+        print(f"Work items: {', '.join(report['work_item_responses'])}")
+    print(f"Estado de los folios: {', '.join(report['folio_statuses'])}")
+    print("\nLlamadas por documento:")
+    for name, value in report["api_calls_per_doc"].items():
+        print(f"  {name:<36} {value:>8}")
+    print("\nLatencias por etapa (ms):")
+    print(f"  {'etapa':<36} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, row in stages.items():
+        print(f"  {stage:<36} {row['count']:>6} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,678 @@
+"""
+Dobles locales de GCS, Firestore, Document AI y Pub/Sub para los benchmarks.
+
+Se inyectan en el registro de clientes del microservicio (_CLIENTS), de modo que el
+pipeline real de process_folder_on_ready corre sin tocar GCP. Cada doble registra
+llamadas y latencias en un StatsRecorder compartido.
+"""
+
+import asyncio
+import base64
+import copy
+import fnmatch
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional, cast
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import documentai_v1 as documentai
+from google.cloud import firestore
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# MÉTRICAS: Contadores de llamadas y latencias por etapa
+# ═══════════════════════════════════════════════════════════════════════════════
+class StatsRecorder:
+    """Acumula contadores y muestras de latencia (segundos) de forma thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.calls[name] += amount
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies[stage].append(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.latencies.clear()
+
+
+class _Timed:
+    def __init__(self, stats: StatsRecorder, stage: str):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._stats.observe(self._stage, time.perf_counter() - self._started)
+        return False
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# GCS
+# ═══════════════════════════════════════════════════════════════════════════════
+def _checksum(data: bytes) -> str:
+    # GCS devuelve CRC32C en base64; el doble usa zlib.crc32, basta para distinguir contenidos
+    return base64.b64encode(zlib.crc32(data).to_bytes(4, "big")).decode()
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str, data: bytes = b"", generation: int = 1,
+                 metadata: Optional[Dict[str, str]] = None, content_type: Optional[str] = "application/pdf"):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+        self.metadata = metadata
+        self.content_type = content_type
+        self._data = data
+        self.size = len(data)
+        self.crc32c = _checksum(data)
+
+    def download_as_bytes(self, start: Optional[int] = None, end: Optional[int] = None,
+                          if_generation_match: Optional[int] = None, **kwargs) -> bytes:
+        stats = self.bucket.client.stats
+        stats.count("gcs.download")
+        with _Timed(stats, "gcs.download"):
+            live = self.bucket.objects.get(self.name)
+            if live is None:
+                raise api_exceptions.NotFound(self.name)
+            if if_generation_match is not None and live.generation != if_generation_match:
+                raise api_exceptions.PreconditionFailed(self.name)
+            if self.bucket.client.download_latency:
+                time.sleep(self.bucket.client.download_latency)
+            data = live._data
+            if start is not None:
+                data = data[start:(end + 1) if end is not None else None]
+            stats.count("gcs.bytes_downloaded", len(data))
+            return data
+
+    def upload_from_string(self, data: Any, content_type: Optional[str] = None, **kwargs) -> None:
+        self.bucket.client.stats.count("gcs.upload")
+        self._data = data.encode() if isinstance(data, str) else data
+        self.size = len(self._data)
+        self.crc32c = _checksum(self._data)
+        self.content_type = content_type
+        self.bucket.objects[self.name] = self
+
+
+class FakeBucket:
+    def __init__(self, client: "FakeStorageClient", name: str):
+        self.client = client
+        self.name = name
+        self.objects: Dict[str, FakeBlob] = {}
+
+    def blob(self, name: str, **kwargs) -> FakeBlob:
+        return self.objects.get(name) or FakeBlob(self, name)
+
+    def add(self, name: str, data: bytes, **kwargs) -> FakeBlob:
+        blob = FakeBlob(self, name, data, **kwargs)
+        self.objects[name] = blob
+        return blob
+
+    def list_blobs(self, **kwargs) -> "_FakeBlobIterator":
+        return self.client.list_blobs(self.name, **kwargs)
+
+
+class _FakeBlobIterator:
+    def __init__(self, stats: StatsRecorder, items: List[FakeBlob], page_size: int, page_latency: float):
+        self._stats = stats
+        self._items = items
+        self._page_size = page_size
+        self._page_latency = page_latency
+
+    @property
+    def pages(self) -> Iterator[Iterator[FakeBlob]]:
+        for i in range(0, len(self._items), self._page_size):
+            self._stats.count("gcs.list_page")
+            with _Timed(self._stats, "gcs.list_page"):
+                if self._page_latency:
+                    time.sleep(self._page_latency)
+            yield iter(self._items[i:i + self._page_size])
+
+    def __iter__(self) -> Iterator[FakeBlob]:
+        for page in self.pages:
+            yield from page
+
+
+class FakeStorageClient:
+    """Cliente GCS en memoria con latencia configurable por descarga y por página de listado."""
+
+    def __init__(self, stats: StatsRecorder, download_latency: float = 0.0, list_page_latency: float = 0.0):
+        self.stats = stats
+        self.download_latency = download_latency
+        self.list_page_latency = list_page_latency
+        self.buckets: Dict[str, FakeBucket] = {}
+
+    def bucket(self, name: str) -> FakeBucket:
+        if name not in self.buckets:
+            self.buckets[name] = FakeBucket(self, name)
+        return self.buckets[name]
+
+    def list_blobs(self, bucket_or_name: Any, prefix: Optional[str] = None, match_glob: Optional[str] = None,
+                   page_size: Optional[int] = None, **kwargs) -> _FakeBlobIterator:
+        bucket = self.bucket(getattr(bucket_or_name, "name", bucket_or_name))
+        self.stats.count("gcs.list")
+        items = [blob for name, blob in sorted(bucket.objects.items()) if name.startswith(prefix or "")]
+        if match_glob:
+            items = [blob for blob in items if fnmatch.fnmatchcase(blob.name, match_glob.replace("**", "*"))]
+        return _FakeBlobIterator(self.stats, items, page_size or 1000, self.list_page_latency)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FIRESTORE
+# ═══════════════════════════════════════════════════════════════════════════════
+def _apply_write(current: Optional[Dict[str, Any]], data: Dict[str, Any], merge: bool) -> Dict[str, Any]:
+    """Aplica un set/update resolviendo los sentinels que usa el microservicio."""
+    result = copy.deepcopy(current) if (merge and current) else {}
+    for key, value in data.items():
+        target = result
+        parts = key.split(".")
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        leaf = parts[-1]
+        if value is firestore.DELETE_FIELD:
+            target.pop(leaf, None)
+        elif value is firestore.SERVER_TIMESTAMP:
+            target[leaf] = time.time()
+        elif isinstance(value, firestore.Increment):
+            target[leaf] = (target.get(leaf) or 0) + value.value
+        else:
+            target[leaf] = copy.deepcopy(value)
+    return result
+
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str) -> Any:
+        # Como DocumentSnapshot.get real: un campo ausente lanza KeyError
+        if self._data is None:
+            return None
+        if field not in self._data:
+            raise KeyError(f"'{field}' is not contained in the data")
+        return copy.deepcopy(self._data[field])
+
+
+class FakeDocumentReference:
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction: Any = None, **kwargs) -> FakeSnapshot:
+        self._db.rpc("firestore.read")
+        return FakeSnapshot(self, self._db.read(self.path))
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> None:
+        self._db.rpc("firestore.write")
+        self._db.apply([("set", self, data, merge)])
+
+    def update(self, data: Dict[str, Any]) -> None:
+        self._db.rpc("firestore.write")
+        self._db.apply([("update", self, data, True)])
+
+    def create(self, data: Dict[str, Any]) -> None:
+        self._db.rpc("firestore.write")
+        self._db.apply([("create", self, data, False)])
+
+    def delete(self) -> None:
+        self._db.rpc("firestore.write")
+        self._db.apply([("delete", self, None, False)])
+
+
+class FakeCollectionReference:
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+
+    def document(self, document_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self._db, f"{self.path}/{document_id}")
+
+    def select(self, field_paths: List[str]) -> "FakeProjection":
+        return FakeProjection(self, field_paths)
+
+    def where(self, filter: Any = None, **kwargs) -> "FakeQuery":
+        return FakeQuery(self, [filter])
+
+    def stream(self, **kwargs) -> Iterator[FakeSnapshot]:
+        self._db.rpc("firestore.query")
+        depth = self.path.count("/") + 1
+        for path, data in self._db.items():
+            if path.startswith(self.path + "/") and path.count("/") == depth:
+                yield FakeSnapshot(FakeDocumentReference(self._db, path), data)
+
+
+class _FakeAggregationResult:
+    def __init__(self, alias: str, value: int):
+        self.alias = alias
+        self.value = value
+
+
+class FakeQuery:
+    """Consulta con where(filter=FieldFilter(...)) (operadores == e in) y agregación count()."""
+
+    _OPERATORS = {
+        "==": lambda value, expected: value == expected,
+        "in": lambda value, expected: value in expected,
+    }
+
+    def __init__(self, collection: FakeCollectionReference, filters: List[Any]):
+        self._collection = collection
+        self._filters = filters
+        self._count_alias: Optional[str] = None
+
+    def where(self, filter: Any = None, **kwargs) -> "FakeQuery":
+        return FakeQuery(self._collection, self._filters + [filter])
+
+    def _matches(self, data: Dict[str, Any]) -> bool:
+        return all(
+            field_filter.field_path in data
+            and self._OPERATORS[field_filter.op_string](data[field_filter.field_path], field_filter.value)
+            for field_filter in self._filters
+        )
+
+    def stream(self, **kwargs) -> Iterator[FakeSnapshot]:
+        for snap in self._collection.stream(**kwargs):
+            if self._matches(snap.to_dict() or {}):
+                yield snap
+
+    def count(self, alias: Optional[str] = None) -> "FakeQuery":
+        query = FakeQuery(self._collection, self._filters)
+        query._count_alias = alias or "count"
+        return query
+
+    def get(self, **kwargs) -> List[List[_FakeAggregationResult]]:
+        # Solo para count(): mismo formato que AggregationQuery.get()
+        return [[_FakeAggregationResult(self._count_alias or "count", sum(1 for _ in self.stream()))]]
+
+
+class FakeProjection:
+    """Consulta con select(): solo devuelve los campos pedidos."""
+
+    def __init__(self, collection: FakeCollectionReference, field_paths: List[str]):
+        self._collection = collection
+        self._fields = list(field_paths)
+
+    def stream(self, **kwargs) -> Iterator[FakeSnapshot]:
+        for snap in self._collection.stream(**kwargs):
+            data = {key: value for key, value in (snap.to_dict() or {}).items() if key in self._fields}
+            yield FakeSnapshot(snap.reference, data)
+
+
+class FakeWriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops: List[tuple] = []
+
+    def set(self, reference: FakeDocumentReference, data: Dict[str, Any], merge: bool = False) -> None:
+        self._ops.append(("set", reference, data, merge))
+
+    def update(self, reference: FakeDocumentReference, data: Dict[str, Any]) -> None:
+        self._ops.append(("update", reference, data, True))
+
+    def create(self, reference: FakeDocumentReference, data: Dict[str, Any]) -> None:
+        self._ops.append(("create", reference, data, False))
+
+    def delete(self, reference: FakeDocumentReference) -> None:
+        self._ops.append(("delete", reference, None, False))
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def commit(self, **kwargs) -> List[Any]:
+        self._db.rpc("firestore.commit")
+        self._db.apply(self._ops)
+        self._ops = []
+        return []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Transacción compatible con @firestore.transactional.
+
+    Retiene el lock del almacenamiento desde _begin hasta commit/rollback, así que las
+    transacciones concurrentes se serializan (equivalente a no tener contención).
+    """
+
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, db: "FakeFirestore"):
+        super().__init__(db)
+        self._id: Optional[bytes] = None
+
+    def _clean_up(self) -> None:
+        self._ops = []
+        self._id = None
+
+    def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        self._db.lock.acquire()
+        self._id = b"fake-transaction"
+
+    def _commit(self) -> List[Any]:
+        try:
+            return self.commit()
+        finally:
+            self._id = None
+            self._db.lock.release()
+
+    def _rollback(self) -> None:
+        if self._id is not None:
+            self._clean_up()
+            self._db.lock.release()
+
+
+class FakeFirestore:
+    """Firestore en memoria: documentos por path, WriteBatch atómico, transacciones y get_all."""
+
+    def __init__(self, stats: StatsRecorder, latency: float = 0.0):
+        self.stats = stats
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.documents: Dict[str, Dict[str, Any]] = {}
+
+    def rpc(self, name: str) -> None:
+        self.stats.count(name)
+        with _Timed(self.stats, name):
+            if self.latency:
+                time.sleep(self.latency)
+
+    def read(self, path: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return copy.deepcopy(self.documents.get(path))
+
+    def items(self) -> List[tuple]:
+        with self.lock:
+            return [(path, copy.deepcopy(data)) for path, data in self.documents.items()]
+
+    def apply(self, ops: List[tuple]) -> None:
+        with self.lock:
+            for op, reference, data, merge in ops:
+                if op == "update" and reference.path not in self.documents:
+                    raise api_exceptions.NotFound(reference.path)
+            for op, reference, data, merge in ops:
+                if op == "create" and reference.path in self.documents:
+                    raise api_exceptions.Conflict(reference.path)
+            for op, reference, data, merge in ops:
+                if op == "delete":
+                    self.documents.pop(reference.path, None)
+                else:
+                    self.documents[reference.path] = _apply_write(self.documents.get(reference.path), data, merge)
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, path)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, references: List[FakeDocumentReference], field_paths: Any = None,
+                transaction: Any = None, **kwargs) -> Iterator[FakeSnapshot]:
+        self.rpc("firestore.get_all")
+        return iter([FakeSnapshot(reference, self.read(reference.path)) for reference in references])
+
+
+class _FakeAsyncWriteBatch(FakeWriteBatch):
+    async def commit(self, **kwargs) -> List[Any]:
+        return await asyncio.to_thread(FakeWriteBatch.commit, self)
+
+
+class FakeAsyncFirestore(FakeFirestore):
+    """Vista async sobre el mismo almacenamiento que FakeFirestore."""
+
+    def __init__(self, base: FakeFirestore):
+        super().__init__(base.stats, base.latency)
+        self.lock = base.lock
+        self.documents = base.documents
+
+    def batch(self) -> _FakeAsyncWriteBatch:
+        return _FakeAsyncWriteBatch(self)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# DOCUMENT AI
+# ═══════════════════════════════════════════════════════════════════════════════
+def _layout(start: int, end: int, x: float, y: float) -> documentai.Document.Page.Layout:
+    return documentai.Document.Page.Layout(
+        text_anchor=documentai.Document.TextAnchor(text_segments=[
+            documentai.Document.TextAnchor.TextSegment(start_index=start, end_index=end)
+        ]),
+        confidence=0.98,
+        bounding_poly=documentai.BoundingPoly(normalized_vertices=[
+            documentai.NormalizedVertex(x=x, y=y),
+            documentai.NormalizedVertex(x=x + 0.05, y=y),
+            documentai.NormalizedVertex(x=x + 0.05, y=y + 0.01),
+            documentai.NormalizedVertex(x=x, y=y + 0.01),
+        ]),
+    )
+
+
+def add_page_layout(document: documentai.Document, tokens_per_page: int = 400, image_kb: int = 64) -> documentai.Document:
+    """Completa el Document como lo devuelve Document AI sin field mask.
+
+    Agrega el texto OCR y, por página, dimensiones, imagen, bloques, párrafos, líneas y tokens.
+    """
+    words = [f"palabra{i % 97}" for i in range(tokens_per_page)]
+    page_text = " ".join(words) + "\n"
+    text_parts = []
+    offset = 0
+    for page in document.pages:
+        tokens, lines = [], []
+        cursor = offset
+        for i, word in enumerate(words):
+            x, y = (i % 12) / 12.0, (i // 12) / max(1, tokens_per_page // 12 + 1)
+            tokens.append(documentai.Document.Page.Token(layout=_layout(cursor, cursor + len(word), x, y)))
+            cursor += len(word) + 1
+            if i % 12 == 11:
+                lines.append(documentai.Document.Page.Line(layout=_layout(cursor - 12 * (len(word) + 1), cursor, 0.0, y)))
+        page.dimension = documentai.Document.Page.Dimension(width=1700, height=2200, unit="pixels")
+        page.image = documentai.Document.Page.Image(content=bytes(image_kb * 1024), mime_type="image/png",
+                                                    width=1700, height=2200)
+        page.tokens = tokens
+        page.lines = lines
+        page.paragraphs = [documentai.Document.Page.Paragraph(layout=line.layout) for line in lines[::4]]
+        page.blocks = [documentai.Document.Page.Block(layout=line.layout) for line in lines[::8]]
+        page.layout = _layout(offset, offset + len(page_text), 0.0, 0.0)
+        text_parts.append(page_text)
+        offset += len(page_text)
+    document.text = "".join(text_parts)
+    return document
+
+
+def apply_field_mask(document: documentai.Document, paths: List[str]) -> documentai.Document:
+    """Recorta el Document como el servidor con ProcessRequest.field_mask.
+
+    Document AI admite campos de primer nivel ("entities") o de página ("pages.page_number").
+    """
+    if not paths:
+        return document
+    top_level = [path for path in paths if "." not in path]
+    page_fields = [path.split(".", 1)[1] for path in paths if path.startswith("pages.")]
+    trimmed = documentai.Document()
+    for name in top_level:
+        setattr(trimmed, name, getattr(document, name))
+    if page_fields and "pages" not in top_level:
+        trimmed.pages = [
+            documentai.Document.Page(**{name: getattr(page, name) for name in page_fields})
+            for page in document.pages
+        ]
+    return trimmed
+
+
+class FakeDocumentAI:
+    """Document AI simulado con latencia, tasa de errores e inyección de 429.
+
+    La respuesta del classifier devuelve ESTADO_RESULTADOS o ESTADO_SITUACION_FINANCIERA;
+    la del extractor devuelve `entities_per_doc` entidades con page_refs y bounding boxes.
+    Con `page_layout` la respuesta incluye además OCR, tokens e imágenes por página, y se
+    recorta según el field_mask del request como lo haría el servidor.
+    """
+
+    def __init__(self, stats: StatsRecorder, latency: float = 0.2, latency_jitter: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, entities_per_doc: int = 40,
+                 pages_per_doc: int = 3, seed: Optional[int] = None, page_layout: bool = False):
+        self.stats = stats
+        self.page_layout = page_layout
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.entities_per_doc = entities_per_doc
+        self.pages_per_doc = pages_per_doc
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._wire_cache: Dict[tuple, bytes] = {}
+
+    def _role(self, processor_name: str) -> str:
+        processor = processor_name.rsplit("/", 1)[-1]
+        return "classify" if "clasificador" in processor or "classifier" in processor else "extract"
+
+    def _draw(self) -> tuple:
+        with self._random_lock:
+            delay = max(0.0, self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter))
+            roll = self._random.random()
+            choice = self._random.random()
+        return delay, roll, choice
+
+    def _outcome(self, request: documentai.ProcessRequest) -> tuple:
+        role = self._role(request.name)
+        self.stats.count(f"documentai.{role}")
+        delay, roll, choice = self._draw()
+        if roll < self.throttle_rate:
+            self.stats.count(f"documentai.{role}.throttled")
+            return role, delay, api_exceptions.ResourceExhausted("Quota exceeded (simulated)")
+        if roll < self.throttle_rate + self.error_rate:
+            self.stats.count(f"documentai.{role}.error")
+            return role, delay, api_exceptions.ServiceUnavailable("Backend unavailable (simulated)")
+        return role, delay, choice
+
+    def _build_document(self, role: str, choice: float) -> documentai.Document:
+        pages = [documentai.Document.Page(page_number=i + 1) for i in range(self.pages_per_doc)]
+        if role == "classify":
+            doc_type = "ESTADO_RESULTADOS" if choice < 0.5 else "ESTADO_SITUACION_FINANCIERA"
+            entities = [documentai.Document.Entity(type_=doc_type, confidence=0.97)]
+            return documentai.Document(entities=entities, pages=pages)
+
+        entity_types = ["LINE_ITEM_NAME", "LINE_ITEM_VALUE", "COLUMN_YEAR", "SECTION_HEADER", "TOTAL_LABEL"]
+        entities = []
+        for i in range(self.entities_per_doc):
+            y = (i % 40) / 40.0
+            entity_type = entity_types[i % len(entity_types)] if i >= 3 else f"HEADER_FIELD_{i}"
+            mention = f"{(i + 1) * 1234.5:,.2f}" if entity_type == "LINE_ITEM_VALUE" else f"Concepto {i}"
+            entities.append(documentai.Document.Entity(
+                type_=entity_type,
+                mention_text=mention,
+                confidence=0.9,
+                page_anchor=documentai.Document.PageAnchor(page_refs=[
+                    documentai.Document.PageAnchor.PageRef(
+                        page=i % self.pages_per_doc,
+                        bounding_poly=documentai.BoundingPoly(normalized_vertices=[
+                            documentai.NormalizedVertex(x=0.1, y=y),
+                            documentai.NormalizedVertex(x=0.4, y=y),
+                            documentai.NormalizedVertex(x=0.4, y=y + 0.02),
+                            documentai.NormalizedVertex(x=0.1, y=y + 0.02),
+                        ]),
+                    )
+                ]),
+            ))
+        return documentai.Document(entities=entities, pages=pages)
+
+    def _response(self, request: documentai.ProcessRequest, role: str, choice: float) -> documentai.ProcessResponse:
+        if not self.page_layout:
+            return documentai.ProcessResponse(document=self._build_document(role, choice))
+        # Respuesta serializada una vez por variante; cada llamada la deserializa como el cliente gRPC
+        paths = tuple(request.field_mask.paths)
+        key = (role, role == "classify" and choice < 0.5, paths)
+        with self._random_lock:
+            wire = self._wire_cache.get(key)
+            if wire is None:
+                document = apply_field_mask(add_page_layout(self._build_document(role, choice)), list(paths))
+                wire = documentai.ProcessResponse.serialize(documentai.ProcessResponse(document=document))
+                self._wire_cache[key] = wire
+        return cast(documentai.ProcessResponse, documentai.ProcessResponse.deserialize(wire))
+
+    def get_processor(self, name: str, **kwargs: Any) -> documentai.Processor:
+        self.stats.count("documentai.get_processor")
+        return documentai.Processor(name=name, default_processor_version=f"{name}/processorVersions/bench-v1")
+
+    def process_document(self, request: documentai.ProcessRequest, **kwargs: Any) -> documentai.ProcessResponse:
+        role, delay, outcome = self._outcome(request)
+        with _Timed(self.stats, f"documentai.{role}"):
+            time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return self._response(request, role, outcome)
+
+
+class FakeDocumentAIAsync(FakeDocumentAI):
+    async def process_document(self, request: documentai.ProcessRequest, **kwargs: Any) -> documentai.ProcessResponse:
+        role, delay, outcome = self._outcome(request)
+        started = time.perf_counter()
+        await asyncio.sleep(delay)
+        self.stats.observe(f"documentai.{role}", time.perf_counter() - started)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return self._response(request, role, outcome)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PUB/SUB
+# ═══════════════════════════════════════════════════════════════════════════════
+class _FakePublishFuture:
+    def __init__(self, message_id: str):
+        self._message_id = message_id
+
+    def result(self, timeout: Optional[float] = None) -> str:
+        return self._message_id
+
+    def exception(self, timeout: Optional[float] = None) -> Optional[Exception]:
+        return None
+
+    def add_done_callback(self, callback: Any) -> None:
+        callback(self)
+
+
+class FakePublisher:
+    def __init__(self, stats: StatsRecorder):
+        self.stats = stats
+        self.messages: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def topic_path(self, project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic: str, data: bytes, **attributes: Any) -> _FakePublishFuture:
+        self.stats.count("pubsub.publish")
+        with self._lock:
+            self.messages.append((topic, data, attributes))
+            return _FakePublishFuture(str(len(self.messages)))
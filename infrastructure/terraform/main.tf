@@ -250,6 +250,31 @@ resource "google_storage_bucket" "pdf_bucket" {
   depends_on = [google_project_service.required_apis]
 }
 
+# Bucket dedicado a las extracciones que no caben en Firestore (EXTRACTION_SPILL_URI).
+# Va separado del bucket de PDFs: el trigger de Eventarc escucha todo object.finalize de aquél.
+resource "google_storage_bucket" "extractions_bucket" {
+  name          = "${local.bucket_full_name}-extracciones"
+  location      = var.bucket_location
+  storage_class = var.bucket_storage_class
+  project       = var.project_id
+
+  uniform_bucket_level_access = true
+
+  lifecycle_rule {
+    condition {
+      age = var.bucket_lifecycle_age
+    }
+    action {
+      type          = "SetStorageClass"
+      storage_class = "NEARLINE"
+    }
+  }
+
+  labels = local.common_labels
+
+  depends_on = [google_project_service.required_apis]
+}
+
 # ─────────────────────────────────────────────────────────────
 # Firestore Database - Base de Datos NoSQL
 # ─────────────────────────────────────────────────────────────
@@ -268,6 +293,19 @@ resource "google_firestore_database" "main" {
   depends_on = [google_project_service.required_apis]
 }
 
+# Política TTL para la caché de resultados de Document AI (cache_resultados.expires_at)
+resource "google_firestore_field" "result_cache_ttl" {
+  project    = var.project_id
+  database   = google_firestore_database.main.name
+  collection = "cache_resultados"
+  field      = "expires_at"
+
+  ttl_config {}
+
+  # Sin índices de campo único: la caché solo se lee por ID
+  index_config {}
+}
+
 # ─────────────────────────────────────────────────────────────
 # Artifact Registry Repository - Para imágenes Docker
 # ─────────────────────────────────────────────────────────────
@@ -350,6 +388,16 @@ resource "google_cloud_run_v2_service" "processor" {
         value = "8"
       }
 
+      env {
+        name  = "REQUEST_TIMEOUT_SECONDS"
+        value = tostring(var.cloudrun_timeout)
+      }
+
+      env {
+        name  = "EXTRACTION_SPILL_URI"
+        value = "gs://${google_storage_bucket.extractions_bucket.name}"
+      }
+
       env {
         name  = "MAX_RETRIES"
         value = "3"
@@ -88,6 +88,11 @@ output "pdf_bucket_self_link" {
   value       = google_storage_bucket.pdf_bucket.self_link
 }
 
+output "extractions_bucket_name" {
+  description = "Nombre del bucket de extracciones grandes (EXTRACTION_SPILL_URI)"
+  value       = google_storage_bucket.extractions_bucket.name
+}
+
 # ─────────────────────────────────────────────────────────────
 # Firestore Outputs
 # ─────────────────────────────────────────────────────────────